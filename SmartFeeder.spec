@@ -6,7 +6,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('templates', 'templates'), ('static', 'static'), ('instance', 'instance')],
-    hiddenimports=['flask', 'flask_cors', 'sqlite3', 'pytz'],
+    hiddenimports=['flask', 'sqlite3', 'waitress'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -1,224 +1,2239 @@
-from flask import Flask, jsonify, request, render_template, send_from_directory
-from flask_cors import CORS
+from flask import (Flask, Response, g, has_request_context, jsonify, make_response, request,
+                   render_template, send_file, send_from_directory)
 import sqlite3
 import os
+import atexit
 import time
 import threading
-from datetime import datetime, timedelta
-import pytz  
+import heapq
+import json
+import mmap
+import hashlib
+import io
+import logging
+import base64
+import csv
+import re
+import tempfile
+from bisect import bisect_left
+from functools import cache, wraps
+from collections import deque
+from itertools import islice
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
 
-# Add Philippine timezone
-PH_TZ = pytz.timezone('Asia/Manila')
+# Philippine time. Manila has no daylight saving time, so a fixed offset is
+# exact (no tz database needed) and doubles as a SQLite date modifier.
+PH_TZ = timezone(timedelta(hours=8), 'Asia/Manila')
+PH_OFFSET_MINUTES = int(PH_TZ.utcoffset(None).total_seconds() // 60)
+PH_SQL_OFFSET = f"{PH_OFFSET_MINUTES:+d} minutes"   # UTC -> Manila
+PH_SQL_TO_UTC = f"{-PH_OFFSET_MINUTES:+d} minutes"  # Manila -> UTC
+
+def ph_now():
+    """Current Manila time; every schedule date and due time is on this clock"""
+    return datetime.now(PH_TZ)
+
+def feed_time_hhmm(value):
+    """A feed time as zero-padded HH:MM, so times sort as strings; ValueError if it isn't one"""
+    return datetime.strptime(str(value), "%H:%M").strftime("%H:%M")
 
 # ------------------ App setup ------------------
-app = Flask(__name__, instance_relative_config=True)
-CORS(app)
+app = Flask(__name__, instance_path=os.environ.get('SMARTFEEDER_INSTANCE_PATH'),
+            instance_relative_config=True)
+
+app.config.from_mapping(
+    DB_POOL_SIZE=8,              # idle connections kept open for reuse
+    DB_BUSY_TIMEOUT=30,          # seconds to wait on a locked database
+    DB_CACHE_SIZE_KB=8192,       # page cache per connection
+    DB_MMAP_SIZE=64 * 1024 * 1024,
+    DB_STATEMENT_CACHE=256,      # prepared statements cached per connection
+    WEIGHT_FLUSH_INTERVAL=2.0,   # seconds between batched weight writes
+    WEIGHT_FLUSH_MAX_PENDING=500,  # flush early once this many readings are waiting
+    WEIGHT_RAW_SECONDS=6 * 3600,   # raw readings kept per module: a ring with one slot per second
+    WEIGHT_MINUTE_DAYS=7,          # per-minute min/max/avg kept this long
+    WEIGHT_HOUR_DAYS=400,          # per-hour min/max/avg kept this long
+    WEIGHT_SERIES_MAX_POINTS=1000, # most points one /modules/<id>/weights request returns
+    BATCH_MAX_MODULES=256,       # module limit for /check_schedule/batch
+    LONG_POLL_MAX_WAIT=55,       # seconds a /check_schedule long-poll may be held open
+    # Long-polls held at once by the WSGI server, each parking one of its
+    # request threads, so the plain Flask/waitress path only holds a handful.
+    # Past this, wait= is answered at once with "held": false and a
+    # Retry-After header. Keep it well below the server's thread count (the
+    # launcher uses a quarter of --threads). For fleets that long-poll, point
+    # devices at device_gateway.py (--gateway-port), which holds thousands
+    # of long-polls without a thread each.
+    LONG_POLL_MAX_WAITERS=4,
+    LONG_POLL_RETRY_AFTER=5,     # seconds an un-held long-poll is told to wait before polling again
+    CHANGE_FEED_BACKLOG=1000,    # recent changes kept for reconnecting /events clients
+    CHANGE_FEED_KEEPALIVE=15,    # seconds between /events keep-alive comments
+    # /events streams open at once. Each parks a request thread while its tab
+    # is open, so like LONG_POLL_MAX_WAITERS keep it well below the
+    # server's thread count (the launcher uses a quarter of --threads); past
+    # it the stream is refused with 503 and the page falls back to reloading.
+    CHANGE_FEED_MAX_STREAMS=4,
+    CHANGE_FEED_STREAM_SECONDS=300,  # a stream ends after this; the browser reconnects from Last-Event-ID
+    HISTORY_PAGE_MAX=500,        # largest page /history will return
+    PREVIEW_SIZES={"thumb": 160, "medium": 640},  # longest edge in pixels
+    PREVIEW_QUALITY=80,
+    PREVIEW_WORKERS=2,           # background threads rendering previews
+    UPLOAD_MAX_BYTES=4 * 1024 * 1024,  # larger images are refused with 413
+    UPLOAD_CHUNK_SIZE=64 * 1024,       # bytes read from the request at a time
+    ARCHIVE_AFTER_DAYS=7,        # loose snapshots older than this are packed
+    ARCHIVE_PACK_MAX_BYTES=256 * 1024 * 1024,  # start a new pack file past this size
+    ARCHIVE_BATCH=500,           # snapshots packed per transaction
+    ARCHIVE_INTERVAL=3600,       # seconds between background compaction runs
+    IMMUTABLE_MAX_AGE=365 * 24 * 3600,  # snapshots and versioned static files never change
+    RULE_WINDOW_DAYS=14,         # recurrence rules have pending rows this far ahead
+    RULE_MAX_DAYS=366,           # furthest ahead a schedule list may materialize rules
+    BULK_MAX_ROWS=50000,         # rows accepted by one /schedules/bulk request
+    BULK_CHUNK_ROWS=1000,        # rows staged per executemany while reading the body
+    IDEMPOTENCY_KEY_TTL=24 * 3600,  # seconds a /complete_schedule Idempotency-Key is remembered
+    # Minutes a due schedule may stay pending before its status becomes
+    # 'missed' and it is no longer dispensed. 0 (the default) never expires
+    # anything. Only schedules that come due while the server is running
+    # expire; ones already due at startup are left pending as before.
+    DISPATCH_GRACE_MINUTES=0,
+    # Set when several worker processes serve the same database (the launcher's
+    # --workers): in-process caches that other processes could not invalidate
+    # are bypassed, and weights are written through instead of buffered.
+    # The /events change feed only carries the serving process's own writes.
+    SHARED_PROCESSES=False,
+    LOG_LEVEL="INFO",            # DEBUG also logs every weight reading and snapshot
+    LOG_RATE_LIMIT=20,           # lines per event kind per LOG_RATE_INTERVAL; the rest are counted
+    LOG_RATE_INTERVAL=10,        # seconds
+)
+app.config.from_prefixed_env('SMARTFEEDER')
 
 DB_PATH = os.path.join(app.instance_path, 'animal_feeder.db')
+IMAGES_DIR = os.path.join(app.instance_path, 'images')
+PREVIEWS_DIR = os.path.join(app.instance_path, 'previews')
+PACKS_DIR = os.path.join(app.instance_path, 'packs')
+
+@app.after_request
+def allow_cross_origin(response):
+    """Open CORS for every route, preflights included (what flask_cors did with defaults)"""
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    if request.method == "OPTIONS" and "Access-Control-Request-Method" in request.headers:
+        response.headers["Access-Control-Allow-Methods"] = request.headers["Access-Control-Request-Method"]
+        if "Access-Control-Request-Headers" in request.headers:
+            response.headers["Access-Control-Allow-Headers"] = request.headers["Access-Control-Request-Headers"]
+    return response
+
+# ------------------ Logging ------------------
+class EventLog:
+    """Leveled key=value log lines with a per-event rate limit.
+
+    log.info("schedule_completed", schedule_id=3) writes
+    "event=schedule_completed schedule_id=3". At most LOG_RATE_LIMIT lines
+    of one event are written per LOG_RATE_INTERVAL; the next line written
+    after a window carries suppressed=<count> for the ones dropped.
+    """
+
+    def __init__(self, logger, limit, interval):
+        self.logger = logger
+        self.limit = limit
+        self.interval = interval
+        self._windows = {}  # event -> [window start, lines written, lines suppressed]
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    @staticmethod
+    def _value(value):
+        text = str(value)
+        if not text or any(ch in text for ch in ' "='):
+            return json.dumps(text)
+        return text
+
+    def log(self, level, event, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(event)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window else 0
+                window = self._windows[event] = [now, 0, 0]
+                if dropped:
+                    fields["suppressed"] = dropped
+            if window[1] >= self.limit:
+                window[2] += 1
+                self.suppressed += 1
+                return
+            window[1] += 1
+        line = " ".join(f"{key}={self._value(value)}" for key, value in (("event", event), *fields.items()))
+        self.logger.log(level, line)
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+def make_logger(level):
+    logger = logging.getLogger("smartfeeder")
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(str(level).upper())
+    return logger
+
+log = EventLog(make_logger(app.config['LOG_LEVEL']),
+               app.config['LOG_RATE_LIMIT'], app.config['LOG_RATE_INTERVAL'])
+
+# ------------------ Metrics ------------------
+class Histogram:
+    """Cumulative latency histogram with fixed Prometheus-style buckets"""
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    __slots__ = ("counts", "total", "count", "lock")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # the last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.total, self.count
+
+class Metrics:
+    """In-process aggregation behind /metrics.
+
+    Each observation is a bucket increment under a per-series lock; series
+    are keyed by route template or query name, never by raw path or values,
+    so the number of series stays small.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}        # (route, method) -> Histogram
+        self.responses = {}     # (route, method, status) -> count
+        self.queries = {}       # query name -> Histogram
+        self.query_rows = {}    # query name -> rows returned
+        self.query_errors = {}  # query name -> count
+        self.transactions = {}  # transaction name -> Histogram
+
+    def _histogram(self, series, key):
+        histogram = series.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = series.setdefault(key, Histogram())
+        return histogram
+
+    def _count(self, series, key, n=1):
+        with self._lock:
+            series[key] = series.get(key, 0) + n
+
+    def observe_request(self, route, method, status, seconds):
+        self._histogram(self.routes, (route, method)).observe(seconds)
+        self._count(self.responses, (route, method, status))
+
+    def observe_query(self, name, seconds, rows):
+        self._histogram(self.queries, name).observe(seconds)
+        if rows:
+            self._count(self.query_rows, name, rows)
+
+    def query_failed(self, name):
+        self._count(self.query_errors, name)
+
+    def observe_transaction(self, name, seconds):
+        self._histogram(self.transactions, name).observe(seconds)
+
+    @staticmethod
+    def _labels(**labels):
+        escaped = {key: str(value).replace("\\", "\\\\").replace('"', '\\"') for key, value in labels.items()}
+        return ",".join(f'{key}="{value}"' for key, value in escaped.items())
+
+    def _render_histograms(self, lines, metric, help_text, series, label_names):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} histogram")
+        with self._lock:
+            items = sorted(series.items())
+        for key, histogram in items:
+            key = key if isinstance(key, tuple) else (key,)
+            labels = self._labels(**dict(zip(label_names, key)))
+            counts, total, count = histogram.snapshot()
+            cumulative = 0
+            for bound, n in zip((*Histogram.BUCKETS, "+Inf"), counts):
+                cumulative += n
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{metric}_count{{{labels}}} {count}")
+
+    def _render_counters(self, lines, metric, help_text, series, label_names, kind="counter"):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        with self._lock:
+            items = sorted(series.items())
+        for key, value in items:
+            key = key if isinstance(key, tuple) else (key,)
+            labels = self._labels(**dict(zip(label_names, key)))
+            lines.append(f"{metric}{{{labels}}} {value}" if labels else f"{metric} {value}")
+
+    def render(self, gauges):
+        """Prometheus text exposition; gauges is {(metric, help, type): value}"""
+        lines = []
+        self._render_histograms(lines, "smartfeeder_http_request_duration_seconds",
+                                "Request latency by route template", self.routes, ("route", "method"))
+        self._render_counters(lines, "smartfeeder_http_responses_total",
+                              "Responses by route template and status", self.responses,
+                              ("route", "method", "status"))
+        self._render_histograms(lines, "smartfeeder_db_query_duration_seconds",
+                                "query_db latency by query name", self.queries, ("query",))
+        self._render_counters(lines, "smartfeeder_db_query_rows_total",
+                              "Rows returned by query name", self.query_rows, ("query",))
+        self._render_counters(lines, "smartfeeder_db_query_errors_total",
+                              "Failed queries by query name", self.query_errors, ("query",))
+        self._render_histograms(lines, "smartfeeder_db_transaction_duration_seconds",
+                                "Write transaction latency, lock waits included",
+                                self.transactions, ("transaction",))
+        for (metric, help_text, kind), value in gauges.items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def metric_name(name):
+    """Label for an unnamed query or transaction: the endpoint it ran under"""
+    if name:
+        return name
+    if has_request_context():
+        return request.endpoint or "unmatched"
+    return "background"
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get("request_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe_request(route, request.method, response.status_code,
+                                time.perf_counter() - started)
+    return response
 
 # ------------------ Database helper ------------------
-def query_db(query, args=(), one=False):
-    con = None
-    try:
-        con = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+class ConnectionPool:
+    """Keeps SQLite connections open between queries instead of reconnecting.
+
+    Connections are opened in WAL mode with tuned pragmas and handed out one
+    at a time; each keeps its own prepared-statement cache, so hot queries are
+    only compiled once per connection.
+
+    It also counts write-lock contention: an uncontended BEGIN IMMEDIATE takes
+    microseconds, while a blocked one sleeps in SQLite's busy handler for at
+    least a millisecond, so anything slower is counted as a lock wait.
+    """
+
+    LOCK_WAIT_MIN = 0.001  # seconds
+
+    def __init__(self, path, size, config):
+        self.path = path
+        self.size = size
+        self.config = config
+        self._idle = []
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.in_use = 0
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+        self.lock_timeouts = 0
+
+    def _connect(self):
+        con = sqlite3.connect(self.path,
+                              timeout=self.config['DB_BUSY_TIMEOUT'],
+                              check_same_thread=False,
+                              cached_statements=self.config['DB_STATEMENT_CACHE'])
         con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute(query, args)
-        rv = cur.fetchall()
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute(f"PRAGMA cache_size=-{int(self.config['DB_CACHE_SIZE_KB'])}")
+        con.execute(f"PRAGMA mmap_size={int(self.config['DB_MMAP_SIZE'])}")
+        con.execute("PRAGMA temp_store=MEMORY")
+        with self._lock:
+            self.opened += 1
+        return con
+
+    def acquire(self):
+        with self._lock:
+            self.in_use += 1
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except BaseException:
+            with self._lock:
+                self.in_use -= 1
+            raise
+
+    def release(self, con):
+        if con.in_transaction:
+            con.rollback()
+        with self._lock:
+            self.in_use -= 1
+            if len(self._idle) < self.size:
+                self._idle.append(con)
+                return
+        con.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for con in idle:
+            con.close()
+
+    def begin(self, con):
+        """BEGIN IMMEDIATE on con, counting how long it waited for another writer"""
+        start = time.perf_counter()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            with self._lock:
+                self.lock_timeouts += 1
+            raise
+        waited = time.perf_counter() - start
+        if waited >= self.LOCK_WAIT_MIN:
+            with self._lock:
+                self.lock_waits += 1
+                self.lock_wait_seconds += waited
+
+    def stats(self):
+        with self._lock:
+            return {"opened": self.opened, "idle": len(self._idle), "in_use": self.in_use,
+                    "lock_waits": self.lock_waits,
+                    "lock_wait_seconds": round(self.lock_wait_seconds, 3),
+                    "lock_timeouts": self.lock_timeouts}
+
+db_pool = ConnectionPool(DB_PATH, app.config['DB_POOL_SIZE'], app.config)
+
+@contextmanager
+def pooled_connection():
+    """A pooled connection held across several statements or transactions"""
+    con = db_pool.acquire()
+    try:
+        yield con
+    finally:
+        db_pool.release(con)
+
+@contextmanager
+def transaction(name=None, con=None):
+    """Run several statements on one pooled connection as a single commit.
+
+    con is a connection the caller already holds (from pooled_connection);
+    by default one is taken from the pool for the transaction. The time
+    from BEGIN to COMMIT is recorded under `name` (default: the current
+    endpoint) in /metrics.
+    """
+    start = time.perf_counter()
+    owned = con is None
+    if owned:
+        con = db_pool.acquire()
+    try:
+        db_pool.begin(con)
+        yield con
         con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    finally:
+        if owned:
+            db_pool.release(con)
+        metrics.observe_transaction(metric_name(name), time.perf_counter() - start)
+
+def query_db(query, args=(), one=False, name=None):
+    """Run one statement on a pooled connection; latency and rows go to /metrics under `name`"""
+    start = time.perf_counter()
+    con = db_pool.acquire()
+    try:
+        cur = con.execute(query, args)
+        rv = cur.fetchall()
+        if con.in_transaction:
+            con.commit()
+        metrics.observe_query(metric_name(name), time.perf_counter() - start, len(rv))
         return (rv[0] if rv else None) if one else rv
     except sqlite3.OperationalError as e:
-        if con:
+        if con.in_transaction:
             con.rollback()
+        metrics.query_failed(metric_name(name))
         raise e
     finally:
-        if con:
-            con.close()
+        db_pool.release(con)
 
 os.makedirs(app.instance_path, exist_ok=True)
 
-# ------------------ Table creation ------------------
-query_db("""
-CREATE TABLE IF NOT EXISTS camera (
-    cam_id TEXT PRIMARY KEY,
-    status TEXT NOT NULL
-)
-""")
-
-query_db("""
-CREATE TABLE IF NOT EXISTS modules (
-    module_id TEXT PRIMARY KEY,
-    cam_id TEXT NOT NULL,
-    status TEXT NOT NULL,
-    weight REAL,
-    FOREIGN KEY (cam_id) REFERENCES camera(cam_id)
+# ------------------ Feeding rollups ------------------
+# Per-module feed counts and amounts by Manila hour and day. They are kept
+# in step with history inside the same transaction as every write that can
+# change a feed total, and can always be rebuilt from history + schedules.
+ROLLUP_TABLES = {
+    "feed_rollup_hourly": f"strftime('%Y-%m-%d %H:00', h.created_at, '{PH_SQL_OFFSET}')",
+    "feed_rollup_daily": f"date(h.created_at, '{PH_SQL_OFFSET}')",
+}
+
+def apply_feed_rollups(con, where, args, sign=1):
+    """Add (sign=1) or remove (sign=-1) the history rows matching `where` from the rollups"""
+    for table, bucket in ROLLUP_TABLES.items():
+        con.execute(f"""
+            INSERT INTO {table} (module_id, bucket, feeds, amount)
+            SELECT s.module_id, {bucket}, ? * COUNT(*), ? * SUM(s.amount)
+            FROM history h
+            JOIN schedules s ON h.schedule_id = s.schedule_id
+            WHERE {where}
+            GROUP BY s.module_id, {bucket}
+            ON CONFLICT(module_id, bucket) DO UPDATE SET
+                feeds = feeds + excluded.feeds,
+                amount = amount + excluded.amount
+        """, (sign, sign) + tuple(args))
+
+def rebuild_feed_rollups(con):
+    for table in ROLLUP_TABLES:
+        con.execute(f"DELETE FROM {table}")
+    apply_feed_rollups(con, "1=1", ())
+
+# ------------------ Schema migrations ------------------
+SCHEDULES_TABLE = """
+CREATE TABLE schedules (
+    schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    module_id TEXT NOT NULL,
+    feed_date DATE NOT NULL,
+    feed_time TEXT NOT NULL,
+    amount REAL NOT NULL,
+    status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'done', 'cancelled')),
+    FOREIGN KEY (module_id) REFERENCES modules(module_id)
 )
-""")
+"""
 
-# ========== FIXED: Better migration for feed_date column ==========
-try:
-    result = query_db("SELECT sql FROM sqlite_master WHERE type='table' AND name='schedules'", one=True)
-   
+def _create_base_tables(con):
+    """Tables from before versioned migrations; safe on databases that already have them"""
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS camera (
+        cam_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL
+    )
+    """)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS modules (
+        module_id TEXT PRIMARY KEY,
+        cam_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        weight REAL,
+        FOREIGN KEY (cam_id) REFERENCES camera(cam_id)
+    )
+    """)
+
+    # Older databases have a schedules table without feed_date
+    result = con.execute(
+        "SELECT sql FROM sqlite_master WHERE type='table' AND name='schedules'").fetchone()
     if result and 'feed_date' not in result['sql']:
-        print("Migrating schedules table to add feed_date column...")
-        query_db("ALTER TABLE schedules RENAME TO schedules_old")
-        query_db("""
-        CREATE TABLE schedules (
-            schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            module_id TEXT NOT NULL,
-            feed_date DATE NOT NULL,
-            feed_time TEXT NOT NULL,
-            amount REAL NOT NULL,
-            status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'done', 'cancelled')),
-            FOREIGN KEY (module_id) REFERENCES modules(module_id)
-        )
-        """)
-        query_db("""
+        log.info("migrating_schedules", change="add feed_date")
+        con.execute("ALTER TABLE schedules RENAME TO schedules_old")
+        con.execute(SCHEDULES_TABLE)
+        con.execute("""
         INSERT INTO schedules (schedule_id, module_id, feed_date, feed_time, amount, status)
         SELECT schedule_id, module_id, date('now'), feed_time, amount,
                COALESCE(status, 'pending')
         FROM schedules_old
         """)
-        query_db("DROP TABLE schedules_old")
-        print("Migration completed successfully!")
+        con.execute("DROP TABLE schedules_old")
     elif not result:
-        query_db("""
-        CREATE TABLE schedules (
-            schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        con.execute(SCHEDULES_TABLE)
+
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS history (
+        history_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        schedule_id INTEGER,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (schedule_id) REFERENCES schedules(schedule_id)
+    )
+    """)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS image_metadata (
+        filename TEXT PRIMARY KEY,
+        camera_id TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        category TEXT NOT NULL CHECK(category IN ('during', 'after')),
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+def _unique_pending_slots(con):
+    """Cancel duplicate pending schedules, keeping the oldest, so the unique index can be built"""
+    cancelled = con.execute("""
+        UPDATE schedules SET status = 'cancelled'
+        WHERE status = 'pending' AND schedule_id NOT IN (
+            SELECT MIN(schedule_id) FROM schedules WHERE status = 'pending'
+            GROUP BY module_id, feed_date, feed_time)
+        RETURNING schedule_id
+    """).fetchall()
+    if cancelled:
+        log.warning("duplicate_schedules_cancelled", count=len(cancelled),
+                    schedule_ids=",".join(map(str, sorted(row[0] for row in cancelled))))
+    con.execute("""CREATE UNIQUE INDEX ux_schedules_pending_slot
+                   ON schedules(module_id, feed_date, feed_time) WHERE status = 'pending'""")
+
+def _add_missed_status(con):
+    """Rebuild schedules with 'missed' allowed: SQLite can't alter a CHECK constraint"""
+    con.execute("""
+    CREATE TABLE schedules_new (
+        schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        module_id TEXT NOT NULL,
+        feed_date DATE NOT NULL,
+        feed_time TEXT NOT NULL,
+        amount REAL NOT NULL,
+        status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'done', 'cancelled', 'missed')),
+        rule_id INTEGER REFERENCES schedule_rules(rule_id),
+        FOREIGN KEY (module_id) REFERENCES modules(module_id)
+    )
+    """)
+    con.execute("""
+    INSERT INTO schedules_new (schedule_id, module_id, feed_date, feed_time, amount, status, rule_id)
+    SELECT schedule_id, module_id, feed_date, feed_time, amount, status, rule_id FROM schedules
+    """)
+    # Keep AUTOINCREMENT from reusing ids of deleted schedules that history still names
+    con.execute("DELETE FROM sqlite_sequence WHERE name = 'schedules_new'")
+    con.execute("""
+    INSERT INTO sqlite_sequence (name, seq)
+    SELECT 'schedules_new', seq FROM sqlite_sequence WHERE name = 'schedules'
+    """)
+    con.execute("DROP TABLE schedules")
+    con.execute("ALTER TABLE schedules_new RENAME TO schedules")
+    # The indexes from migrations 2, 7 and 8 went with the old table
+    con.execute("""CREATE INDEX idx_schedules_due
+                   ON schedules(module_id, status, feed_date, feed_time, amount)""")
+    con.execute("CREATE INDEX idx_schedules_module_date ON schedules(module_id, feed_date, feed_time)")
+    con.execute("CREATE INDEX idx_schedules_date ON schedules(feed_date, feed_time)")
+    con.execute("CREATE INDEX idx_schedules_rule ON schedules(rule_id, feed_date) WHERE rule_id IS NOT NULL")
+    con.execute("""CREATE UNIQUE INDEX ux_schedules_pending_slot
+                   ON schedules(module_id, feed_date, feed_time) WHERE status = 'pending'""")
+
+def _create_feed_rollups(con):
+    for table in ROLLUP_TABLES:
+        con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
             module_id TEXT NOT NULL,
-            feed_date DATE NOT NULL,
-            feed_time TEXT NOT NULL,
-            amount REAL NOT NULL,
-            status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'done', 'cancelled')),
-            FOREIGN KEY (module_id) REFERENCES modules(module_id)
-        )
+            bucket TEXT NOT NULL,
+            feeds INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (module_id, bucket)
+        ) WITHOUT ROWID
         """)
-        print("Created new schedules table with feed_date column")
-    else:
-        print("Schedules table already has feed_date column, no migration needed")
-       
-except Exception as e:
-    print(f"Error during migration: {e}")
-    try:
-        query_db("""
-        CREATE TABLE IF NOT EXISTS schedules (
-            schedule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        con.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table}(bucket, module_id)")
+    rebuild_feed_rollups(con)
+
+def _backfill_snapshot_sizes(con):
+    """Size of snapshots stored before migration 4, from the files still on disk"""
+    rows = con.execute("SELECT DISTINCT storage_name FROM image_metadata WHERE size IS NULL").fetchall()
+    sizes = []
+    for row in rows:
+        try:
+            sizes.append((os.path.getsize(os.path.join(IMAGES_DIR, row['storage_name'])), row['storage_name']))
+        except OSError:
+            pass
+    con.executemany("UPDATE image_metadata SET size = ? WHERE storage_name = ? AND size IS NULL", sizes)
+
+# Each migration is (version, description, step). A step is either a list of
+# SQL statements or a function taking the open connection. Never edit a
+# migration that has shipped; append a new one instead.
+MIGRATIONS = [
+    (1, "base tables", _create_base_tables),
+    (2, "indexes for device polls, schedule lists, history and snapshots", [
+        # /check_schedule: equality on module/status/date, range + order on feed_time,
+        # amount included so the poll never reads the table itself
+        """CREATE INDEX IF NOT EXISTS idx_schedules_due
+           ON schedules(module_id, status, feed_date, feed_time, amount)""",
+        # /schedules filtered by module and/or date range, ordered by date and time
+        """CREATE INDEX IF NOT EXISTS idx_schedules_module_date
+           ON schedules(module_id, feed_date, feed_time)""",
+        """CREATE INDEX IF NOT EXISTS idx_schedules_date
+           ON schedules(feed_date, feed_time)""",
+        # /history and analytics
+        "CREATE INDEX IF NOT EXISTS idx_history_created ON history(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_history_schedule ON history(schedule_id)",
+        # /api/snapshots and /api/snapshots/<cam_id>
+        "CREATE INDEX IF NOT EXISTS idx_image_metadata_timestamp ON image_metadata(timestamp)",
+        """CREATE INDEX IF NOT EXISTS idx_image_metadata_camera
+           ON image_metadata(camera_id, timestamp)""",
+    ]),
+    (3, "hourly and daily feeding rollups", _create_feed_rollups),
+    (4, "snapshot size and checksum", [
+        "ALTER TABLE image_metadata ADD COLUMN size INTEGER",
+        "ALTER TABLE image_metadata ADD COLUMN sha256 TEXT",
+    ]),
+    (5, "snapshot pack files and retention policies", [
+        """CREATE TABLE snapshot_packs (
+            pack_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            size INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "ALTER TABLE image_metadata ADD COLUMN pack_id INTEGER REFERENCES snapshot_packs(pack_id)",
+        "ALTER TABLE image_metadata ADD COLUMN pack_offset INTEGER",
+        """CREATE INDEX idx_image_metadata_pack
+           ON image_metadata(pack_id) WHERE pack_id IS NOT NULL""",
+        # camera_id '*' is the default for cameras without a policy of their own
+        """CREATE TABLE snapshot_retention (
+            camera_id TEXT NOT NULL,
+            category TEXT NOT NULL CHECK(category IN ('during', 'after')),
+            delete_after_days INTEGER,
+            thin_after_days INTEGER,
+            thin_interval INTEGER,
+            PRIMARY KEY (camera_id, category)
+        )""",
+    ]),
+    (6, "shared snapshot storage and near-duplicate detection", [
+        # Rows with identical bytes share one stored file (or pack entry)
+        "ALTER TABLE image_metadata ADD COLUMN storage_name TEXT",
+        "UPDATE image_metadata SET storage_name = filename",
+        "CREATE INDEX idx_image_metadata_storage ON image_metadata(storage_name)",
+        "CREATE INDEX idx_image_metadata_sha256 ON image_metadata(sha256) WHERE sha256 IS NOT NULL",
+        "ALTER TABLE image_metadata ADD COLUMN dhash INTEGER",
+        "ALTER TABLE image_metadata ADD COLUMN similar_to TEXT",
+        """ALTER TABLE camera ADD COLUMN similar_frames TEXT NOT NULL DEFAULT 'keep'
+           CHECK(similar_frames IN ('keep', 'flag', 'skip'))""",
+        "ALTER TABLE camera ADD COLUMN similar_threshold INTEGER NOT NULL DEFAULT 4",
+    ]),
+    (7, "recurrence rules", [
+        # weekdays is a bitmask on strftime('%w'): bit 0 is Sunday, 127 every day
+        """CREATE TABLE schedule_rules (
+            rule_id INTEGER PRIMARY KEY AUTOINCREMENT,
             module_id TEXT NOT NULL,
-            feed_date DATE NOT NULL,
             feed_time TEXT NOT NULL,
             amount REAL NOT NULL,
-            status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'done', 'cancelled')),
+            start_date DATE NOT NULL,
+            end_date DATE,
+            every_days INTEGER NOT NULL DEFAULT 1 CHECK(every_days > 0),
+            weekdays INTEGER NOT NULL DEFAULT 127 CHECK(weekdays BETWEEN 1 AND 127),
+            materialized_until DATE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (module_id) REFERENCES modules(module_id)
+        )""",
+        "ALTER TABLE schedules ADD COLUMN rule_id INTEGER REFERENCES schedule_rules(rule_id)",
+        """CREATE INDEX idx_schedules_rule
+           ON schedules(rule_id, feed_date) WHERE rule_id IS NOT NULL""",
+    ]),
+    (8, "one pending schedule per module, date and time", _unique_pending_slots),
+    (9, "idempotency keys for schedule completion", [
+        """CREATE TABLE completion_keys (
+            idempotency_key TEXT PRIMARY KEY,
+            schedule_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        ) WITHOUT ROWID""",
+        "CREATE INDEX idx_completion_keys_created ON completion_keys(created_at)",
+    ]),
+    (10, "missed status for schedules never dispensed", _add_missed_status),
+    (11, "weight time series at raw, minute and hour resolution", [
+        # slot is the reading's unix time modulo WEIGHT_RAW_SECONDS, so each
+        # module has a fixed-size ring that is overwritten instead of pruned
+        """CREATE TABLE weight_raw (
+            module_id TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            weight REAL NOT NULL,
+            PRIMARY KEY (module_id, slot)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX idx_weight_raw_ts ON weight_raw(module_id, ts, weight)",
+        # bucket is the unix time the minute or hour starts; avg is sum / count
+        """CREATE TABLE weight_minute (
+            module_id TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            min REAL NOT NULL,
+            max REAL NOT NULL,
+            sum REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (module_id, bucket)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX idx_weight_minute_bucket ON weight_minute(bucket)",
+        """CREATE TABLE weight_hour (
+            module_id TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            min REAL NOT NULL,
+            max REAL NOT NULL,
+            sum REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (module_id, bucket)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX idx_weight_hour_bucket ON weight_hour(bucket)",
+    ]),
+    (12, "sizes of snapshots stored before migration 4", _backfill_snapshot_sizes),
+]
+
+def schema_version():
+    """Applied schema version, read without taking the write lock; 0 on a new database"""
+    try:
+        return query_db("SELECT COALESCE(MAX(version), 0) FROM schema_version", one=True,
+                        name="schema_version")[0]
+    except sqlite3.OperationalError:  # no schema_version table yet
+        return 0
+
+def migrate_db():
+    """Bring the database up to the latest schema version.
+
+    An up-to-date database costs one read on one pooled connection; the
+    write transaction is only opened when a migration is actually pending.
+    """
+    if schema_version() >= MIGRATIONS[-1][0]:
+        return
+    with transaction("migrate") as con:
+        con.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
         """)
-    except:
-        pass
-
-query_db("""
-CREATE TABLE IF NOT EXISTS history (
-    history_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    schedule_id INTEGER,
-    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (schedule_id) REFERENCES schedules(schedule_id)
-)
-""")
-
-query_db("""
-CREATE TABLE IF NOT EXISTS image_metadata (
-    filename TEXT PRIMARY KEY,
-    camera_id TEXT NOT NULL,
-    timestamp INTEGER NOT NULL,
-    category TEXT NOT NULL CHECK(category IN ('during', 'after')),
-    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-)
-""")
+        current = con.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+        applied = []
+        for version, description, step in MIGRATIONS:
+            if version <= current:
+                continue
+            if callable(step):
+                step(con)
+            else:
+                for statement in step:
+                    con.execute(statement)
+            con.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                        (version, description))
+            applied.append(version)
+
+    if applied:
+        query_db("PRAGMA optimize")
+        log.info("schema_migrated", versions=",".join(map(str, applied)))
+
+migrate_db()
+
+# ------------------ Change feed ------------------
+class ChangeFeed:
+    """Row-level changes for the dashboard, streamed to browsers over /events.
+
+    Routes publish() after they commit. The most recent events are kept so a
+    browser that reconnects with Last-Event-ID picks up where it left off;
+    anyone further behind is told to resync. Ids start from the boot time in
+    milliseconds, so ids from before a restart are always recognised as stale.
+
+    It also keeps a change counter per table, which list routes turn into
+    ETags (see conditional()). close() wakes and ends every open stream; it is
+    called when the server starts shutting down.
+    """
+
+    def __init__(self, backlog):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=backlog)
+        self.last_id = int(time.time() * 1000)
+        self.boot_id = self.last_id
+        self._versions = {}
+        self.closed = False
+
+    def touch(self, table):
+        """Bump a table's change counter without publishing an event"""
+        with self._cond:
+            self._versions[table] = self._versions.get(table, 0) + 1
+
+    def version(self, *tables):
+        with self._cond:
+            return tuple(self._versions.get(table, 0) for table in tables)
+
+    def publish(self, table, op, key, row=None):
+        with self._cond:
+            self._versions[table] = self._versions.get(table, 0) + 1
+            self.last_id += 1
+            data = json.dumps({"table": table, "op": op, "key": key, "row": row}, default=str)
+            self._events.append((self.last_id, data))
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def read(self, after, timeout):
+        """Events newer than id `after`, waiting up to timeout; None means resync"""
+        with self._cond:
+            if after == self.last_id and not self.closed:
+                self._cond.wait(timeout)
+            first_id = self._events[0][0] if self._events else self.last_id + 1
+            if after > self.last_id or after < first_id - 1:
+                return None
+            return list(islice(self._events, after - first_id + 1, None))
+
+change_feed = ChangeFeed(app.config['CHANGE_FEED_BACKLOG'])
+
+def conditional(*tables):
+    """Give a GET list route a strong ETag built from the tables it reads.
+
+    If-None-Match is answered with 304 before the view (and SQLite) runs.
+    The ETag is computed before the view so a write that lands mid-request
+    can only make the next ETag differ, never hide a change. Off with
+    SHARED_PROCESSES, since other processes' writes don't move the counters.
+    """
+    def decorator(view):
+        if app.config['SHARED_PROCESSES']:
+            return view
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            versions = "-".join(map(str, change_feed.version(*tables)))
+            query = hashlib.sha1(request.full_path.encode()).hexdigest()[:12]
+            etag = f"{change_feed.boot_id:x}-{versions}-{query}"
+           
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        return wrapper
+    return decorator
+
+# ------------------ Due-schedule index ------------------
+class DueScheduleIndex:
+    """In-memory copy of module status and today's pending schedules.
+
+    /check_schedule is answered from here. Every route that writes modules or
+    schedules calls invalidate_module() after committing, and the next poll
+    for that module reloads it with a single query. The whole index is
+    reloaded when the date changes. With cache=False (several worker
+    processes) every lookup reads SQLite instead.
+    """
+
+    LOAD_QUERY = """
+        SELECT m.module_id, m.status, s.schedule_id, s.feed_time, s.amount
+        FROM modules m
+        LEFT JOIN schedules s
+            ON s.module_id = m.module_id
+            AND m.status = 'active'
+            AND s.feed_date = ?
+            AND s.status = 'pending'
+    """
+
+    def __init__(self, cache=True):
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._day = None
+        self._modules = {}          # module_id -> (status, heap of (feed_time, schedule_id, amount))
+        self._stale = set()         # module_ids to reload on next use
+        self._generation = {}       # module_id -> bumped by every invalidation
+        self._schedule_modules = {} # schedule_id -> module_id, for today's pending schedules
+        self._listeners = {}        # module_id -> callbacks run after each invalidation
+        self._observers = []        # callbacks given every batch of invalidated module_ids
+
+    def _fetch(self, day, module_ids=None):
+        query, args = self.LOAD_QUERY, [day]
+        if module_ids is not None:
+            query += f" WHERE m.module_id IN ({','.join('?' * len(module_ids))})"
+            args.extend(module_ids)
+        loaded = {module_id: None for module_id in module_ids or ()}
+        for row in query_db(query, tuple(args), name="due_schedules"):
+            status, heap = loaded.get(row['module_id']) or (row['status'], [])
+            if row['schedule_id'] is not None:
+                # Rows stored before feed times were validated may read "7:05",
+                # which would sort after "10:00"; ones that aren't times at all
+                # are never dispensed
+                try:
+                    heap.append((feed_time_hhmm(row['feed_time']), row['schedule_id'], row['amount']))
+                except ValueError:
+                    log.warning("schedule_feed_time_invalid", schedule_id=row['schedule_id'],
+                                feed_time=row['feed_time'])
+            loaded[row['module_id']] = (status, heap)
+        for entry in loaded.values():
+            if entry:
+                heapq.heapify(entry[1])
+        return loaded
+
+    def _install(self, loaded, generations):
+        for module_id, entry in loaded.items():
+            if self._generation.get(module_id, 0) != generations.get(module_id, 0):
+                continue  # written again while we were reading; stay stale
+            old = self._modules.pop(module_id, None)
+            if old:
+                for _, schedule_id, _ in old[1]:
+                    self._schedule_modules.pop(schedule_id, None)
+            if entry:
+                self._modules[module_id] = entry
+                for _, schedule_id, _ in entry[1]:
+                    self._schedule_modules[schedule_id] = module_id
+            self._stale.discard(module_id)
+
+    def _ensure(self, day, module_ids):
+        """Load module_ids for day if they are stale, or everything on a new day"""
+        with self._lock:
+            full = self._day != day
+            stale = [] if full else [m for m in module_ids if m in self._stale]
+            if not full and not stale:
+                return
+            generations = dict(self._generation) if full else {m: self._generation.get(m, 0) for m in stale}
+
+        if full:
+            loaded = self._fetch(day)
+            with self._lock:
+                self._stale = {m for m, g in self._generation.items() if generations.get(m, 0) != g}
+                self._modules = {m: entry for m, entry in loaded.items() if entry}
+                self._schedule_modules = {schedule_id: m for m, (_, heap) in self._modules.items()
+                                          for _, schedule_id, _ in heap}
+                self._day = day
+            return
+
+        loaded = self._fetch(day, stale)
+        with self._lock:
+            if self._day == day:
+                self._install(loaded, generations)
+
+    def lookup(self, module_id, day):
+        """Return (status, next pending (feed_time, schedule_id, amount) or None)"""
+        return self.lookup_many([module_id], day)[module_id]
+
+    def lookup_many(self, module_ids, day):
+        """lookup() for several modules, loading any stale ones in one query"""
+        if not self.cache:
+            return {module_id: (entry[0], entry[1][0] if entry[1] else None) if entry else (None, None)
+                    for module_id, entry in self._fetch(day, module_ids).items()}
+        self._ensure(day, module_ids)
+        result, missed = {}, []
+        with self._lock:
+            for module_id in module_ids:
+                if self._day != day or module_id in self._stale:
+                    missed.append(module_id)
+                    continue
+                status, heap = self._modules.get(module_id) or (None, None)
+                result[module_id] = (status, heap[0] if heap else None)
+        if missed:
+            # Invalidated mid-read; answer these polls straight from SQLite
+            for module_id, entry in self._fetch(day, missed).items():
+                status, heap = entry or (None, None)
+                result[module_id] = (status, heap[0] if heap else None)
+        return result
+
+    def modules(self, day):
+        """Every module_id known on day, including ones written since the last load"""
+        self._ensure(day, [])
+        with self._lock:
+            return list(self._modules.keys() | self._stale)
+
+    def status(self, module_id):
+        return self.lookup(module_id, ph_now().strftime("%Y-%m-%d"))[0]
+
+    def invalidate_module(self, *module_ids):
+        module_ids = [module_id for module_id in module_ids if module_id is not None]
+        with self._lock:
+            for module_id in module_ids:
+                self._generation[module_id] = self._generation.get(module_id, 0) + 1
+                self._stale.add(module_id)
+        # Observers (the dispatch scheduler) update first, so woken
+        # long-polls already see the new decision
+        for observer in self._observers:
+            observer(module_ids)
+        self.notify(*module_ids)
+
+    def notify(self, *module_ids):
+        """Run module_ids' listeners without invalidating anything"""
+        with self._lock:
+            callbacks = [callback for module_id in module_ids
+                         for callback in self._listeners.get(module_id, ())]
+        for callback in callbacks:
+            callback()
+
+    def add_observer(self, callback):
+        """Call callback(module_ids) from the writing thread after every invalidation"""
+        self._observers.append(callback)
+
+    def add_listener(self, module_id, callback):
+        """Call callback (from the writing thread) whenever module_id is invalidated.
+
+        Callbacks must be cheap and must not block: set an Event, or hand off
+        to an event loop with call_soon_threadsafe.
+        """
+        with self._lock:
+            self._listeners.setdefault(module_id, set()).add(callback)
+
+    def remove_listener(self, module_id, callback):
+        with self._lock:
+            callbacks = self._listeners.get(module_id)
+            if callbacks:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._listeners[module_id]
+
+    def waiting(self):
+        with self._lock:
+            return sum(len(callbacks) for callbacks in self._listeners.values())
+
+    def invalidate_schedule(self, schedule_id):
+        with self._lock:
+            module_id = self._schedule_modules.get(schedule_id)
+        if module_id is not None:
+            self.invalidate_module(module_id)
+
+due_index = DueScheduleIndex(cache=not app.config['SHARED_PROCESSES'])
+
+# ------------------ Dispatch scheduler ------------------
+class DispatchScheduler:
+    """Dispense decisions for every module, worked out before the devices ask.
+
+    Each module's decision (status, response body, status code, and the
+    Manila time it next changes) sits in a ready table, so /check_schedule
+    is a dictionary lookup. A background thread keeps a heap of those change
+    times: when a schedule comes due it re-decides the module and wakes its
+    held long-polls. With DISPATCH_GRACE_MINUTES set, a schedule that came
+    due after the scheduler was created and is still pending that long after
+    its time is marked 'missed' instead of being dispensed late. Writes
+    re-decide their modules as they invalidate the due index. With
+    cache=False (several worker processes) every poll decides from SQLite and
+    expires what it finds overdue.
+    """
+
+    def __init__(self, index, grace_minutes, cache=True):
+        self.index = index
+        self.grace = timedelta(minutes=grace_minutes) if grace_minutes else None
+        self.since = ph_now().replace(second=0, microsecond=0)  # nothing due earlier expires
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._ready = {}     # module_id -> (status, body, code, changes_at)
+        self._timers = []    # heap of (changes_at timestamp, module_id); outdated ones are skipped
+        self._wake = threading.Event()
+        self._thread = None
+        self.missed = 0
+        index.add_observer(self._invalidated)
+
+    def _decide(self, status, next_schedule, now):
+        """Return (decision, None), or (None, schedule_id) when that schedule is past its grace window"""
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), PH_TZ)
+        if status != 'active':
+            return (status, {"error": "Invalid or inactive module_id"}, 404, None), None
+        if not next_schedule:
+            return (status, {"dispense": False}, 200, midnight), None
+       
+        feed_time, schedule_id, amount = next_schedule  # the index only holds valid HH:MM times
+        due = datetime.combine(now.date(), datetime.strptime(feed_time, "%H:%M").time(), PH_TZ)
+        if now < due:
+            return (status, {"dispense": False}, 200, due), None
+        expires = due + self.grace if self.grace and due >= self.since else midnight
+        if now >= expires:
+            return None, schedule_id
+        return (status, {
+            "dispense": True,
+            "amount": amount,
+            "schedule_id": schedule_id,
+            "scheduled_date": now.strftime("%Y-%m-%d"),
+            "scheduled_time": feed_time
+        }, 200, min(expires, midnight)), None
+
+    def _decide_many(self, module_ids, now):
+        decisions, overdue = {}, {}
+        lookups = self.index.lookup_many(module_ids, now.strftime("%Y-%m-%d"))
+        for module_id, (status, next_schedule) in lookups.items():
+            decision, schedule_id = self._decide(status, next_schedule, now)
+            if schedule_id is not None:
+                overdue[module_id] = schedule_id
+            else:
+                decisions[module_id] = decision
+        return decisions, overdue
+
+    def _install(self, decisions, overdue):
+        earliest = self._timers[0][0] if self._timers else None
+        for module_id in overdue:
+            self._ready.pop(module_id, None)
+        for module_id, decision in decisions.items():
+            if decision[0] is None:  # unknown module: not worth a table slot
+                self._ready.pop(module_id, None)
+                continue
+            old = self._ready.get(module_id)
+            self._ready[module_id] = decision
+            changes_at = decision[3]
+            if changes_at is not None and (old is None or old[3] != changes_at):
+                heapq.heappush(self._timers, (changes_at.timestamp(), module_id))
+        if self._timers and self._timers[0][0] != earliest:
+            self._wake.set()
+
+    def refresh(self, module_ids):
+        """Decide module_ids again (into the ready table when caching); returns their decisions"""
+        module_ids = list(module_ids)
+        if not module_ids:
+            return {}
+        now = ph_now()
+        if self.cache:
+            # One refresh at a time, so a slow one can't install older data over a newer one
+            with self._lock:
+                decisions, overdue = self._decide_many(module_ids, now)
+                self._install(decisions, overdue)
+        else:
+            decisions, overdue = self._decide_many(module_ids, now)
+        if overdue:
+            self.expire(overdue)
+            decisions.update(self.refresh(overdue))
+        return decisions
+
+    def _invalidated(self, module_ids):
+        if not self.cache:
+            return
+        try:
+            self.refresh(module_ids)
+        except Exception as e:
+            # The write already committed; let the next poll decide these
+            with self._lock:
+                for module_id in module_ids:
+                    self._ready.pop(module_id, None)
+            log.error("dispatch_refresh_failed", error=e)
+
+    def decisions(self, module_ids):
+        """(status, body, code, changes_at) per module: O(1) from the ready table when current"""
+        if not self.cache:
+            return self.refresh(module_ids)
+        self.start()
+        now = ph_now()
+        result = {module_id: self._ready.get(module_id) for module_id in module_ids}
+        outdated = [module_id for module_id, decision in result.items()
+                    if decision is None or (decision[3] is not None and decision[3] <= now)]
+        if outdated:
+            result.update(self.refresh(outdated))
+        return result
+
+    def decision(self, module_id):
+        return self.decisions([module_id])[module_id]
+
+    def expire(self, overdue=None):
+        """Mark pending schedules 'missed': overdue ({module_id: schedule_id}), or all past grace"""
+        if not self.grace:
+            return []
+        if overdue is None:
+            cutoff = ph_now() - self.grace
+            where = "(feed_date, feed_time) >= (?, ?) AND (feed_date, feed_time) < (?, ?)"
+            args = (self.since.strftime("%Y-%m-%d"), self.since.strftime("%H:%M"),
+                    cutoff.strftime("%Y-%m-%d"), cutoff.strftime("%H:%M"))
+        else:
+            where = f"schedule_id IN ({','.join('?' * len(overdue))})"
+            args = tuple(overdue.values())
+        with transaction("dispatch_expire") as con:
+            missed = con.execute(f"""
+                UPDATE schedules SET status = 'missed'
+                WHERE status = 'pending' AND {where}
+                RETURNING schedule_id, module_id, feed_date, feed_time
+            """, args).fetchall()
+       
+        for row in missed:
+            change_feed.publish("schedules", "update", row['schedule_id'],
+                                {"schedule_id": row['schedule_id'], "status": "missed"})
+        if missed:
+            self.missed += len(missed)
+            log.info("schedules_missed", count=len(missed),
+                     schedule_ids=",".join(str(row['schedule_id']) for row in missed[:20]))
+        # Reload even if a completion beat us to it, so the index can't keep offering it
+        self.index.invalidate_module(*{row['module_id'] for row in missed} | set(overdue or ()))
+        return missed
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="dispatch-scheduler", daemon=True)
+                    self._thread.start()
+
+    def _advance(self):
+        """Re-decide modules whose decision has reached its change time; wake their long-polls"""
+        now = ph_now()
+        with self._lock:
+            due = set()
+            while self._timers and self._timers[0][0] <= now.timestamp():
+                due.add(heapq.heappop(self._timers)[1])
+            before = {module_id: self._ready.get(module_id) for module_id in due}
+        # Skip timers for decisions that have been replaced since
+        due = [module_id for module_id, decision in before.items()
+               if decision is not None and decision[3] is not None and decision[3] <= now]
+        after = self.refresh(due)
+        changed = [module_id for module_id in due
+                   if module_id not in after or after[module_id][1:3] != before[module_id][1:3]]
+        self.index.notify(*changed)
+
+    def _run(self):
+        swept = None
+        while True:
+            try:
+                today = ph_now().date()
+                if swept != today:
+                    # Once a day (and at startup): expire what was left overdue,
+                    # then decide every module so their timers are set
+                    self.expire()
+                    self.refresh(self.index.modules(today.isoformat()))
+                    swept = today
+                self._advance()
+            except Exception as e:
+                log.error("dispatch_failed", error=e)
+            with self._lock:
+                self._wake.clear()
+                next_at = self._timers[0][0] if self._timers else float("inf")
+            midnight = datetime.combine(ph_now().date() + timedelta(days=1), datetime.min.time(), PH_TZ)
+            self._wake.wait(max(0.0, min(next_at, midnight.timestamp()) - time.time()))
+
+    def stats(self):
+        with self._lock:
+            return {"ready": len(self._ready), "timers": len(self._timers), "missed": self.missed}
+
+dispatch = DispatchScheduler(due_index, app.config['DISPATCH_GRACE_MINUTES'],
+                             cache=not app.config['SHARED_PROCESSES'])
+
+# ------------------ Recurrence rules ------------------
+WEEKDAYS = ("sun", "mon", "tue", "wed", "thu", "fri", "sat")
+
+def rule_matches(day):
+    """SQL condition: rule r has an occurrence on the date expression day"""
+    return f"""({day} >= r.start_date
+        AND (r.end_date IS NULL OR {day} <= r.end_date)
+        AND CAST(julianday({day}) - julianday(r.start_date) AS INTEGER) % r.every_days = 0
+        AND (r.weekdays >> CAST(strftime('%w', {day}) AS INTEGER)) & 1)"""
+
+MATERIALIZE_RULES = f"""
+    WITH RECURSIVE days(rule_id, day) AS (
+        SELECT rule_id, MAX(start_date, COALESCE(date(materialized_until, '+1 day'), start_date))
+        FROM schedule_rules
+        WHERE {{where}}
+        UNION ALL
+        SELECT d.rule_id, date(d.day, '+1 day')
+        FROM days d JOIN schedule_rules r ON r.rule_id = d.rule_id
+        WHERE d.day < MIN(COALESCE(r.end_date, :until), :until)
+    )
+    INSERT INTO schedules (module_id, feed_date, feed_time, amount, status, rule_id)
+    SELECT r.module_id, d.day, r.feed_time, r.amount, 'pending', r.rule_id
+    FROM days d JOIN schedule_rules r ON r.rule_id = d.rule_id
+    WHERE d.day <= MIN(COALESCE(r.end_date, :until), :until)
+    AND {rule_matches('d.day')}
+    AND NOT EXISTS (
+        SELECT 1 FROM schedules s
+        WHERE s.module_id = r.module_id AND s.feed_date = d.day AND s.feed_time = r.feed_time
+    )
+    RETURNING *
+"""
+
+class RuleMaterializer:
+    """Turns schedule_rules into concrete pending schedules a rolling window at a time.
+
+    Every rule has rows up to RULE_WINDOW_DAYS ahead. ensure() is called by
+    the device poll and the schedule list and only touches the database when
+    the window has moved on, or a list asks for dates further out. A
+    background thread keeps the window rolling when nothing is polling.
+    """
+
+    def __init__(self, window_days, max_days):
+        self.window_days = window_days
+        self.max_days = max_days
+        self._until = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def horizon(self, through=None):
+        """Date rows should exist through: the window end, or a later through date"""
+        today = ph_now().date()
+        target = today + timedelta(days=self.window_days)
+        if through:
+            try:
+                requested = date.fromisoformat(through)
+            except ValueError:
+                requested = target
+            target = max(target, min(requested, today + timedelta(days=self.max_days)))
+        target = target.isoformat()
+        return max(target, self._until) if self._until else target
+
+    def ensure(self, through=None):
+        target = self.horizon(through)
+        if self._until is not None and self._until >= target:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rule-materializer", daemon=True)
+                self._thread.start()
+            if self._until is not None and self._until >= target:
+                return
+            self.materialize(target)
+            self._until = target
+
+    def _run(self):
+        while True:
+            time.sleep(3600)
+            try:
+                self.ensure()
+            except Exception as e:
+                log.error("rule_materialize_failed", error=e)
+
+    def materialize(self, until, rule_id=None):
+        """Insert missing occurrences through until; returns the new schedule rows"""
+        where = "COALESCE(materialized_until, '') < MIN(COALESCE(end_date, :until), :until)"
+        params = {"until": until}
+        if rule_id is not None:
+            where += " AND rule_id = :rule_id"
+            params["rule_id"] = rule_id
+        with transaction("materialize_rules") as con:
+            rows = con.execute(MATERIALIZE_RULES.format(where=where), params).fetchall()
+            con.execute(f"""
+                UPDATE schedule_rules SET materialized_until = MIN(COALESCE(end_date, :until), :until)
+                WHERE {where}
+            """, params)
+        if rows:
+            due_index.invalidate_module(*{row['module_id'] for row in rows})
+            for row in rows:
+                change_feed.publish("schedules", "insert", row['schedule_id'], dict(row))
+        return rows
+
+rule_materializer = RuleMaterializer(app.config['RULE_WINDOW_DAYS'], app.config['RULE_MAX_DAYS'])
+
+def materialize_rules_first(view):
+    """Bring rule occurrences up to date before conditional() computes its ETag"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        rule_materializer.ensure(request.args.get('end_date'))
+        return view(*args, **kwargs)
+    return wrapper
+
+def parse_rule(data, partial=False):
+    """Return (rule columns, None) or (None, (error body, status code)).
+
+    With partial=True only the fields present are validated and returned,
+    for rule edits.
+    """
+    fields = {}
+    for key in ("module_id", "feed_time", "amount", "start_date"):
+        if data.get(key) not in (None, ""):
+            fields[key] = data[key]
+        elif not partial:
+            return None, ({"error": f"{key} is required"}, 400)
+    if "feed_time" in fields:
+        try:
+            fields["feed_time"] = feed_time_hhmm(fields["feed_time"])
+        except ValueError:
+            return None, ({"error": "Invalid feed_time format. Use HH:MM"}, 400)
+    for key in ("start_date", "end_date"):
+        if data.get(key):
+            try:
+                fields[key] = datetime.strptime(data[key], "%Y-%m-%d").date().isoformat()
+            except (TypeError, ValueError):
+                return None, ({"error": f"Invalid {key} format. Use YYYY-MM-DD"}, 400)
+        elif key == "end_date" and "end_date" in data:
+            fields["end_date"] = None
+    if "every_days" in data:
+        try:
+            fields["every_days"] = int(data["every_days"])
+        except (TypeError, ValueError):
+            fields["every_days"] = 0
+        if fields["every_days"] < 1:
+            return None, ({"error": "every_days must be a whole number of at least 1"}, 400)
+    if "weekdays" in data:
+        days = data["weekdays"] or WEEKDAYS
+        if not isinstance(days, list) or any(str(day).lower()[:3] not in WEEKDAYS for day in days):
+            return None, ({"error": f"weekdays must be a list of {', '.join(WEEKDAYS)}"}, 400)
+        fields["weekdays"] = sum(1 << WEEKDAYS.index(str(day).lower()[:3]) for day in set(days))
+    return fields, None
+
+def rule_json(row):
+    rule = dict(row)
+    rule["weekdays"] = [day for bit, day in enumerate(WEEKDAYS) if row["weekdays"] >> bit & 1]
+    return rule
+
+# ------------------ Weight time series ------------------
+class WeightSeries:
+    """Every weight reading, kept at three resolutions with their own retention.
+
+    weight_raw holds the last WEIGHT_RAW_SECONDS of readings per module as a
+    ring of one slot per second, so it never grows and is never pruned. The
+    same readings are folded into per-minute and per-hour min/max/sum/count
+    rows, kept for WEIGHT_MINUTE_DAYS and WEIGHT_HOUR_DAYS. query() reads
+    the coarsest resolution that still gives the detail asked for.
+    """
+
+    TIERS = (("raw", "weight_raw", 1), ("minute", "weight_minute", 60), ("hour", "weight_hour", 3600))
+
+    def __init__(self, raw_seconds, minute_days, hour_days):
+        self.raw_seconds = raw_seconds
+        self.retention = {"raw": raw_seconds, "minute": minute_days * 86400, "hour": hour_days * 86400}
+        self._next_prune = 0.0
+
+    def record(self, con, samples):
+        """Write (module_id, unix time, weight) readings inside the caller's transaction"""
+        con.executemany("""
+            INSERT INTO weight_raw (module_id, slot, ts, weight) VALUES (?, ?, ?, ?)
+            ON CONFLICT(module_id, slot) DO UPDATE SET ts = excluded.ts, weight = excluded.weight
+        """, [(module_id, ts % self.raw_seconds, ts, weight) for module_id, ts, weight in samples])
+        for _, table, resolution in self.TIERS[1:]:
+            buckets = {}
+            for module_id, ts, weight in samples:
+                key = (module_id, ts - ts % resolution)
+                low, high, total, count = buckets.get(key) or (weight, weight, 0.0, 0)
+                buckets[key] = (min(low, weight), max(high, weight), total + weight, count + 1)
+            con.executemany(f"""
+                INSERT INTO {table} (module_id, bucket, min, max, sum, count) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(module_id, bucket) DO UPDATE SET
+                    min = MIN(min, excluded.min),
+                    max = MAX(max, excluded.max),
+                    sum = sum + excluded.sum,
+                    count = count + excluded.count
+            """, [key + value for key, value in buckets.items()])
+        self.prune(con)
+
+    def prune(self, con):
+        """Delete minute and hour rows past their retention, at most once an hour"""
+        if time.monotonic() < self._next_prune:
+            return
+        self._next_prune = time.monotonic() + 3600
+        now = int(time.time())
+        for name, table, _ in self.TIERS[1:]:
+            con.execute(f"DELETE FROM {table} WHERE bucket < ?", (now - self.retention[name],))
+
+    def delete(self, con, module_id):
+        for _, table, _ in self.TIERS:
+            con.execute(f"DELETE FROM {table} WHERE module_id = ?", (module_id,))
+
+    def resolution(self, start, end, max_points):
+        """(tier name, table, seconds per point) for start <= t < end in at most max_points points.
+
+        The tier is the coarsest one no coarser than a point, among those
+        still holding data back to start (the hourly one if none do).
+        """
+        step = max(1, -(-(end - start) // max_points))
+        now = int(time.time())
+        covering = [tier for tier in self.TIERS if now - self.retention[tier[0]] <= start] or [self.TIERS[-1]]
+        name, table, seconds = ([tier for tier in covering if tier[2] <= step] or covering[:1])[-1]
+        return name, table, -(-step // seconds) * seconds
+
+    def query(self, module_id, start, end, max_points):
+        """Return (tier name, seconds per point, rows of time/min/max/avg/readings) for a range"""
+        name, table, step = self.resolution(start, end, max_points)
+        # Points start on Manila boundaries (midnight, for a step of a day)
+        point = f"((%s + {PH_OFFSET_MINUTES * 60}) / {step}) * {step} - {PH_OFFSET_MINUTES * 60}"
+        if name == "raw":
+            columns = f"{point % 'ts'} AS time, MIN(weight), MAX(weight), AVG(weight), COUNT(*)"
+            where = "ts >= ? AND ts < ?"
+        else:
+            columns = f"{point % 'bucket'} AS time, MIN(min), MAX(max), SUM(sum) / SUM(count), SUM(count)"
+            where = "bucket >= ? AND bucket < ?"
+        rows = query_db(f"""
+            SELECT {columns} FROM {table}
+            WHERE module_id = ? AND {where}
+            GROUP BY time ORDER BY time
+        """, (module_id, start, end), name=f"weight_series.{name}")
+        return name, step, rows
+
+weight_series = WeightSeries(app.config['WEIGHT_RAW_SECONDS'], app.config['WEIGHT_MINUTE_DAYS'],
+                             app.config['WEIGHT_HOUR_DAYS'])
+
+# ------------------ Weight write-behind buffer ------------------
+class WeightBuffer:
+    """Coalesces /weight_update readings in memory; the last reading per module wins.
+
+    Pending weights are written in one executemany transaction every
+    WEIGHT_FLUSH_INTERVAL seconds, or sooner once WEIGHT_FLUSH_MAX_PENDING
+    readings are waiting, and once more when the process exits. Every
+    reading, not just the last, goes to the weight time series in the same
+    transaction. With write_through=True (several worker processes) each
+    reading is written before put() returns. After a failed flush the
+    readings are kept and retried with exponential backoff, up to
+    MAX_RETRY_DELAY seconds apart.
+    """
+
+    BACKLOG_FLUSHES = 100  # unwritten readings kept while the database is failing, in flushes
+    MAX_RETRY_DELAY = 60   # seconds
+
+    def __init__(self, interval, max_pending, write_through=False):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.write_through = write_through
+        self._pending = {}
+        self._samples = []   # (module_id, unix time, weight) for every reading since the last flush
+        self._fresh = 0      # readings put since the last flush took its batch
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.received = 0
+        self.coalesced = 0
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    def put(self, module_id, weight):
+        with self._lock:
+            if module_id in self._pending:
+                self.coalesced += 1
+            self._pending[module_id] = weight
+            self._samples.append((module_id, int(time.time()), weight))
+            self.received += 1
+            self._fresh += 1
+            # Backlog kept from a failed flush doesn't count: the flusher is backing off
+            full = self._fresh >= self.max_pending
+            if self.write_through:
+                full = False
+            elif self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="weight-flush", daemon=True)
+                self._thread.start()
+        if self.write_through:
+            self.flush()
+            return
+        # GET /modules shows pending readings, so its ETag has to move now
+        change_feed.touch("modules")
+        if full:
+            self._wakeup.set()
+
+    def discard(self, module_id):
+        """Drop a pending reading, waiting out any flush already writing it"""
+        with self._flush_lock, self._lock:
+            self._pending.pop(module_id, None)
+            self._samples = [sample for sample in self._samples if sample[0] != module_id]
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                samples, self._samples = self._samples, []
+                self._fresh = 0
+            if not batch:
+                return 0
+            try:
+                with transaction("weight_flush") as con:
+                    cur = con.executemany("UPDATE modules SET weight=? WHERE module_id=?",
+                                          [(weight, module_id) for module_id, weight in batch.items()])
+                    written = cur.rowcount
+                    weight_series.record(con, samples)
+            except sqlite3.Error:
+                with self._lock:
+                    for module_id, weight in batch.items():
+                        self._pending.setdefault(module_id, weight)
+                    self._samples[:0] = samples
+                    backlog = self.max_pending * self.BACKLOG_FLUSHES
+                    if len(self._samples) > backlog:
+                        self.dropped += len(self._samples) - backlog
+                        del self._samples[:-backlog]
+                raise
+            with self._lock:
+                self.written += written
+                self.flushes += 1
+            for module_id, weight in batch.items():
+                change_feed.publish("modules", "update", module_id, {"module_id": module_id, "weight": weight})
+            return written
+
+    def stats(self):
+        with self._lock:
+            return {
+                "received": self.received,
+                "coalesced": self.coalesced,
+                "written": self.written,
+                "flushes": self.flushes,
+                "pending": len(self._pending),
+                "samples_pending": len(self._samples),
+                "samples_dropped": self.dropped,
+            }
+
+    def _run(self):
+        delay = self.interval
+        while True:
+            if delay > self.interval:
+                time.sleep(delay)  # backing off: a full buffer doesn't cut this short
+            else:
+                self._wakeup.wait(delay)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                delay = self.interval
+            except Exception as e:
+                delay = min(max(delay, 0.1) * 2, self.MAX_RETRY_DELAY)
+                log.error("weight_flush_failed", error=e, retry_in=round(delay, 1))
+
+weight_buffer = WeightBuffer(app.config['WEIGHT_FLUSH_INTERVAL'], app.config['WEIGHT_FLUSH_MAX_PENDING'],
+                             write_through=app.config['SHARED_PROCESSES'])
+atexit.register(weight_buffer.flush)
+
+# ------------------ Snapshot previews ------------------
+@cache
+def pillow():
+    """PIL.Image, imported on first use so startup doesn't pay for it; None without Pillow"""
+    try:
+        from PIL import Image
+    except ImportError:  # previews are optional; the gallery falls back to full-size images
+        return None
+    return Image
+
+class PreviewRenderer:
+    """Renders downscaled JPEG previews of snapshots on a background thread pool.
+
+    Uploads queue their previews and return at once; a preview requested
+    before it exists is queued too, and the full-size image is served until
+    it is ready. Without Pillow nothing is rendered. Previews are keyed by
+    storage name, so duplicate frames share them.
+    """
+
+    def __init__(self, images_dir, previews_dir, sizes, quality, workers):
+        self.images_dir = images_dir
+        self.previews_dir = previews_dir
+        self.sizes = sizes
+        self.quality = quality
+        self.workers = workers
+        self._executor = None
+        self._queued = set()
+        self._lock = threading.Lock()
+        self.rendered = 0
+        self.failed = 0
+
+    def path(self, size, filename):
+        return os.path.join(self.previews_dir, size, filename)
+
+    def submit(self, filename):
+        if pillow() is None:
+            return False
+        with self._lock:
+            if filename in self._queued:
+                return True
+            self._queued.add(filename)
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix="preview")
+        self._executor.submit(self._render, filename)
+        return True
+
+    def _render(self, filename):
+        try:
+            with pillow().open(os.path.join(self.images_dir, filename)) as image:
+                # Largest preview first; each smaller one is shrunk from the last
+                sizes = sorted(self.sizes.items(), key=lambda item: -item[1])
+                largest = sizes[0][1]
+                image.draft('RGB', (largest, largest))  # let the JPEG decoder downscale
+                preview = image.convert('RGB')
+            for size, pixels in sizes:
+                preview.thumbnail((pixels, pixels))
+                target = self.path(size, filename)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                temp = f"{target}.{threading.get_ident()}.tmp"
+                preview.save(temp, 'JPEG', quality=self.quality, optimize=True)
+                os.replace(temp, target)
+            with self._lock:
+                self.rendered += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            log.warning("preview_failed", storage_name=filename, error=e)
+        finally:
+            with self._lock:
+                self._queued.discard(filename)
+
+    def remove(self, filename):
+        for size in self.sizes:
+            try:
+                os.remove(self.path(size, filename))
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self):
+        """Wait for queued renders to finish"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": pillow() is not None, "queued": len(self._queued),
+                    "rendered": self.rendered, "failed": self.failed}
+
+previews = PreviewRenderer(IMAGES_DIR, PREVIEWS_DIR, app.config['PREVIEW_SIZES'],
+                           app.config['PREVIEW_QUALITY'], app.config['PREVIEW_WORKERS'])
+
+def dhash(path):
+    """64-bit difference hash of an image, or None without Pillow.
+
+    Neighbouring pixels of a 9x8 grayscale thumbnail are compared, so small
+    changes in lighting or JPEG noise flip few bits. Returned as a signed
+    value to fit an SQLite INTEGER.
+    """
+    Image = pillow()
+    if Image is None:
+        return None
+    with Image.open(path) as image:
+        image.draft('L', (64, 64))
+        pixels = list(image.convert('L').resize((9, 8)).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits - (1 << 64) if bits >= 1 << 63 else bits
+
+def hamming(a, b):
+    return bin((a ^ b) & ((1 << 64) - 1)).count('1')
+
+# ------------------ Snapshot archive ------------------
+class SnapshotArchive:
+    """Moves aged snapshots out of IMAGES_DIR into append-only pack files.
+
+    compact() appends loose snapshots older than ARCHIVE_AFTER_DAYS to the
+    newest pack and records pack_id, offset and size in image_metadata
+    (once per stored file, for every row sharing it);
+    /snapshots then slices them out of a memory map of the pack. Packs are
+    never rewritten: one is removed once retention has deleted every frame
+    in it. apply_retention() deletes or thins old frames per camera and
+    category according to snapshot_retention. Runs of either are serialized,
+    across worker processes too under SHARED_PROCESSES, so two compactions
+    never claim the same files or append at the same pack offset.
+    """
+
+    def __init__(self, images_dir, packs_dir, config):
+        self.images_dir = images_dir
+        self.packs_dir = packs_dir
+        self.config = config
+        self._maps = {}
+        self._map_lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._thread = None
+        self.packed = 0
+        self.removed = 0
+
+    def pack_path(self, pack_id):
+        return os.path.join(self.packs_dir, f"pack-{pack_id:06d}.pack")
+
+    def read(self, pack_id, offset, size):
+        with self._map_lock:
+            mapped = self._maps.get(pack_id)
+            if mapped is None or offset + size > len(mapped):
+                # First read, or the pack has grown since it was mapped
+                if mapped is not None:
+                    mapped.close()
+                with open(self.pack_path(pack_id), 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[pack_id] = mapped
+            return mapped[offset:offset + size]
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the archive for one compaction or retention run"""
+        with self._run_lock:
+            if not self.config['SHARED_PROCESSES']:
+                yield
+                return
+            import fcntl  # worker processes only exist where gunicorn runs, never on Windows
+            os.makedirs(self.packs_dir, exist_ok=True)
+            with open(os.path.join(self.packs_dir, "archive.lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def start(self):
+        """Run compaction and retention every ARCHIVE_INTERVAL seconds"""
+        with self._map_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="snapshot-archive", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.config['ARCHIVE_INTERVAL'])
+            try:
+                self.compact()
+                self.apply_retention()
+            except Exception as e:
+                log.error("archive_failed", error=e)
+
+    def compact(self):
+        """Pack loose snapshots older than ARCHIVE_AFTER_DAYS; returns how many were packed"""
+        cutoff = int(time.time() - self.config['ARCHIVE_AFTER_DAYS'] * 86400)
+        packed = 0
+        last = (-1, '')
+        with self.exclusive():
+            while True:
+                rows = query_db("""
+                    SELECT filename, timestamp, storage_name FROM image_metadata
+                    WHERE pack_id IS NULL AND timestamp < ? AND (timestamp, filename) > (?, ?)
+                    ORDER BY timestamp, filename
+                    LIMIT ?
+                """, (cutoff, *last, self.config['ARCHIVE_BATCH']))
+                if not rows:
+                    break
+                last = (rows[-1]['timestamp'], rows[-1]['filename'])
+                packed += self._pack_batch(list(dict.fromkeys(row['storage_name'] for row in rows)))
+        with self._map_lock:
+            self.packed += packed
+        return packed
+
+    def _pack_batch(self, storage_names):
+        os.makedirs(self.packs_dir, exist_ok=True)
+        pack = query_db("SELECT pack_id, size FROM snapshot_packs ORDER BY pack_id DESC LIMIT 1", one=True)
+        if pack is None or pack['size'] >= self.config['ARCHIVE_PACK_MAX_BYTES']:
+            pack = query_db("INSERT INTO snapshot_packs DEFAULT VALUES RETURNING pack_id, size", one=True)
+        pack_id = pack['pack_id']
+
+        updates = []
+        with open(self.pack_path(pack_id), 'ab') as out:
+            # Append after whatever is on disk, even bytes a crash left unindexed
+            offset = out.seek(0, os.SEEK_END)
+            for storage_name in storage_names:
+                try:
+                    with open(os.path.join(self.images_dir, storage_name), 'rb') as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    continue
+                out.write(data)
+                updates.append((pack_id, offset, len(data), storage_name))
+                offset += len(data)
+            out.flush()
+            os.fsync(out.fileno())
+
+        with transaction("archive_pack") as con:
+            con.executemany("""
+                UPDATE image_metadata SET pack_id=?, pack_offset=?, size=?
+                WHERE storage_name=? AND pack_id IS NULL
+            """, updates)
+            con.execute("UPDATE snapshot_packs SET size=? WHERE pack_id=?", (offset, pack_id))
+        # The index points at the pack now, so the loose copies can go
+        for *_, storage_name in updates:
+            try:
+                os.remove(os.path.join(self.images_dir, storage_name))
+            except FileNotFoundError:
+                pass
+        return len(updates)
+
+    def apply_retention(self):
+        """Delete or thin old snapshots per snapshot_retention; returns how many were removed"""
+        now = int(time.time())
+        removed = []
+        with self.exclusive():
+            with transaction("archive_retention") as con:
+                for policy in con.execute("SELECT * FROM snapshot_retention").fetchall():
+                    if policy['camera_id'] == '*':
+                        scope = """camera_id NOT IN (SELECT camera_id FROM snapshot_retention
+                                                     WHERE category = :category AND camera_id != '*')"""
+                    else:
+                        scope = "camera_id = :camera_id"
+                    params = dict(policy)
+                    if policy['delete_after_days'] is not None:
+                        params['cutoff'] = now - policy['delete_after_days'] * 86400
+                        removed += con.execute(f"""
+                            DELETE FROM image_metadata
+                            WHERE {scope} AND category = :category AND timestamp < :cutoff
+                            RETURNING filename, storage_name, pack_id
+                        """, params).fetchall()
+                    if policy['thin_after_days'] is not None and policy['thin_interval']:
+                        # Keep the first frame in every thin_interval-second window
+                        params['cutoff'] = now - policy['thin_after_days'] * 86400
+                        removed += con.execute(f"""
+                            DELETE FROM image_metadata WHERE rowid IN (
+                                SELECT rowid FROM (
+                                    SELECT rowid, ROW_NUMBER() OVER (
+                                        PARTITION BY camera_id, timestamp / :thin_interval
+                                        ORDER BY timestamp, filename) AS n
+                                    FROM image_metadata
+                                    WHERE {scope} AND category = :category AND timestamp < :cutoff
+                                ) WHERE n > 1)
+                            RETURNING filename, storage_name, pack_id
+                        """, params).fetchall()
+                self.forget(con, removed)
+        for row in removed:
+            change_feed.publish("snapshots", "delete", row['filename'])
+        with self._map_lock:
+            self.removed += len(removed)
+        return len(removed)
+
+    def forget(self, con, rows):
+        """Clean up after image_metadata rows (filename, storage_name, pack_id) deleted on con.
+
+        Call inside the deleting transaction: files are released while it
+        holds the write lock, so no upload can start sharing one meanwhile.
+        """
+        for storage_name in {row['storage_name'] for row in rows}:
+            if con.execute("SELECT 1 FROM image_metadata WHERE storage_name = ? LIMIT 1",
+                           (storage_name,)).fetchone():
+                continue  # still shared by another row
+            try:
+                os.remove(os.path.join(self.images_dir, storage_name))
+            except FileNotFoundError:
+                pass
+            previews.remove(storage_name)
+
+        # Empty packs go, except the newest, which compaction may be appending to
+        for pack_id in {row['pack_id'] for row in rows if row['pack_id'] is not None}:
+            empty = con.execute("""
+                DELETE FROM snapshot_packs
+                WHERE pack_id = ?
+                AND pack_id < (SELECT MAX(pack_id) FROM snapshot_packs)
+                AND NOT EXISTS (SELECT 1 FROM image_metadata WHERE pack_id = ?)
+                RETURNING pack_id
+            """, (pack_id, pack_id)).fetchone()
+            if empty:
+                with self._map_lock:
+                    mapped = self._maps.pop(pack_id, None)
+                    if mapped is not None:
+                        mapped.close()
+                os.remove(self.pack_path(pack_id))
+
+    def stats(self):
+        with self._map_lock:
+            return {"packed": self.packed, "removed": self.removed, "mapped_packs": len(self._maps)}
+
+snapshot_archive = SnapshotArchive(IMAGES_DIR, PACKS_DIR, app.config)
 
 # ------------------ ESP32/DEVICE ROUTES ------------------
 @app.route("/health")
 def health_check():
-    """mDNS/health check endpoint for devices"""
+    """mDNS/health check endpoint for devices; also the launcher's readiness check"""
+    try:
+        query_db("SELECT 1", name="health")
+    except sqlite3.Error as e:
+        return f"Database unavailable: {e}", 503
     return "mDNS OK"
 
+def poll_module(module_id):
+    """One /check_schedule decision: (body, status code, seconds until it could change)"""
+    _, body, code, changes_at = dispatch.decision(module_id)
+    if changes_at is None:
+        return body, code, app.config['LONG_POLL_MAX_WAIT']
+    return body, code, max((changes_at - ph_now()).total_seconds(), 0.05)
+
+def long_poll_wake(remaining, until_due):
+    """Seconds a held long-poll sleeps before checking again (if nothing wakes it)"""
+    wake = min(remaining, until_due)
+    if app.config['SHARED_PROCESSES']:
+        wake = min(wake, 1.0)  # writes in other processes don't fire listeners
+    return wake
+
+# Taken without blocking by each held long-poll on the WSGI path
+long_poll_slots = threading.BoundedSemaphore(app.config['LONG_POLL_MAX_WAITERS'])
+
+def parse_wait(wait):
+    """Long-poll wait in seconds from the request, capped at LONG_POLL_MAX_WAIT"""
+    try:
+        return max(0.0, min(float(wait or 0), app.config['LONG_POLL_MAX_WAIT']))
+    except ValueError:
+        return 0.0
+
+def parse_weight(weight):
+    """Return (weight_value, None) or (None, (error body, status code))"""
+    try:
+        weight_value = float(weight)
+        if weight_value < 0 or weight_value > 10000:
+            return None, ({"error": "Invalid weight value"}, 400)
+    except (TypeError, ValueError):
+        return None, ({"error": "Weight must be a number"}, 400)
+    return weight_value, None
+
+def record_weight(module_id, weight_value, status):
+    """Buffer a validated reading; response body and status code for /weight_update"""
+    if status is None:
+        return {"error": "Module not registered. Please register module first."}, 403
+   
+    weight_buffer.put(module_id, weight_value)
+    log.debug("weight_received", module_id=module_id, weight=weight_value)
+    return {
+        "success": True,
+        "message": f"Weight updated for {module_id}: {weight_value}g",
+        "current_status": status
+    }, 200
+
 @app.route("/check_schedule", methods=["POST"])
 def check_schedule():
-    """Check if a module should dispense food now"""
+    """Check if a module should dispense food now.
+
+    Devices may send wait=<seconds> to long-poll: the response is held until
+    a schedule becomes due or the wait expires, instead of polling in a loop.
+    Each held poll parks a server thread, so once LONG_POLL_MAX_WAITERS are
+    held, further ones are answered straight away with "held": false and a
+    Retry-After header, so devices back off instead of re-polling at once.
+    device_gateway.py holds long-polls without that limit.
+    """
     module_id = request.form.get("module_id")
    
     if not module_id:
         return jsonify({"error": "Missing module_id"}), 400
    
-    module = query_db("""
-        SELECT module_id FROM modules
-        WHERE module_id=? AND status='active'
-    """, (module_id,), one=True)
+    rule_materializer.ensure()
+    wait = parse_wait(request.form.get("wait"))
+    if not wait:
+        body, code, _ = poll_module(module_id)
+        return jsonify(body), code
+    if not long_poll_slots.acquire(blocking=False):
+        body, code, until_due = poll_module(module_id)
+        if code != 200 or body["dispense"]:
+            return jsonify(body), code
+        # Every slot is taken: tell the device this answer wasn't held
+        response = jsonify({**body, "held": False})
+        retry_after = min(until_due, app.config['LONG_POLL_RETRY_AFTER'])
+        response.headers["Retry-After"] = str(max(1, round(retry_after)))
+        return response, code
    
-    if not module:
-        return jsonify({"error": "Invalid or inactive module_id"}), 404
+    # Long-poll: hold the request until a schedule is due, the module's
+    # schedules change, or the wait runs out. The listener is registered
+    # before the first check so no change can slip in between.
+    deadline = time.monotonic() + wait
+    changed = threading.Event()
+    due_index.add_listener(module_id, changed.set)
+    try:
+        while True:
+            changed.clear()
+            body, code, until_due = poll_module(module_id)
+            remaining = deadline - time.monotonic()
+            if code != 200 or body["dispense"] or remaining <= 0:
+                return jsonify(body), code
+            changed.wait(long_poll_wake(remaining, until_due))
+    finally:
+        due_index.remove_listener(module_id, changed.set)
+        long_poll_slots.release()
+
+@app.route("/check_schedule/batch", methods=["POST"])
+def check_schedule_batch():
+    """Poll several modules at once, optionally reporting their weights too.
+
+    Body: {"modules": [{"module_id": "M1", "weight": 512.5}, {"module_id": "M2"}]}
+    or {"module_ids": ["M1", "M2"]}. Each result carries the same body and
+    status code that /check_schedule (and /weight_update, when a weight was
+    sent) would have returned for that module.
+    """
+    data = request.get_json(silent=True) or {}
+    entries = data.get("modules")
+    if entries is None:
+        entries = [{"module_id": module_id} for module_id in data.get("module_ids") or []]
    
-    now = datetime.now()
-    current_date = now.strftime("%Y-%m-%d")
-    current_time = now.strftime("%H:%M")
+    if not isinstance(entries, list) or not entries:
+        return jsonify({"error": "Missing modules"}), 400
+    if len(entries) > app.config['BATCH_MAX_MODULES']:
+        return jsonify({"error": f"At most {app.config['BATCH_MAX_MODULES']} modules per batch"}), 400
+    if not all(isinstance(entry, dict) and entry.get("module_id") for entry in entries):
+        return jsonify({"error": "Every entry needs a module_id"}), 400
    
-    row = query_db("""
-        SELECT schedule_id, amount, feed_time, feed_date FROM schedules
-        WHERE module_id=?
-        AND feed_date=?
-        AND feed_time<=?
-        AND status='pending'
-        ORDER BY feed_time ASC
-        LIMIT 1
-    """, (module_id, current_date, current_time), one=True)
+    rule_materializer.ensure()
+    module_ids = list(dict.fromkeys(str(entry["module_id"]) for entry in entries))
+    decisions = dispatch.decisions(module_ids)
    
-    if row:
-        return jsonify({
-            "dispense": True,
-            "amount": row['amount'],
-            "schedule_id": row['schedule_id'],
-            "scheduled_date": row['feed_date'],
-            "scheduled_time": row['feed_time']
-        })
-    else:
-        return jsonify({"dispense": False})
+    results = []
+    for entry in entries:
+        module_id = str(entry["module_id"])
+        status, body, code, _ = decisions[module_id]
+        result = {"module_id": module_id, "status": code, "schedule": body}
+       
+        if entry.get("weight") is not None:
+            weight_value, error = parse_weight(entry["weight"])
+            weight_body, weight_code = error or record_weight(module_id, weight_value, status)
+            result["weight_update"] = {"status": weight_code, "result": weight_body}
+       
+        results.append(result)
    
+    return jsonify({"results": results})
+   
+COMPLETED = {"success": True, "message": "Schedule completed successfully"}
+
+def replay_completion(seen, schedule_id):
+    """Response to a completion retried with an Idempotency-Key that was already used"""
+    if str(seen['schedule_id']) != str(schedule_id):
+        return jsonify({"error": f"Idempotency-Key was already used for schedule {seen['schedule_id']}"}), 422
+    response = jsonify({**COMPLETED, "schedule_id": schedule_id})
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+_next_key_purge = 0.0
+
+def purge_completion_keys(con):
+    """Forget idempotency keys older than IDEMPOTENCY_KEY_TTL, at most once a minute"""
+    global _next_key_purge
+    if time.monotonic() < _next_key_purge:
+        return
+    _next_key_purge = time.monotonic() + 60
+    con.execute("DELETE FROM completion_keys WHERE created_at < ?",
+                (int(time.time()) - app.config['IDEMPOTENCY_KEY_TTL'],))
+
 @app.route("/complete_schedule", methods=["POST"])
 def complete_schedule():
-    """Mark a schedule as done and add to history"""
+    """Mark a schedule as done and add to history, exactly once.
+
+    The status change, the history row and the rollups are one transaction,
+    and only a schedule that is still pending passes the UPDATE, so
+    concurrent or repeated calls can never add a second history row. A
+    device may send an Idempotency-Key header (or idempotency_key field):
+    retrying with the same key returns the original success response
+    without writing anything, and a key already used for another schedule
+    is refused with 422, even when both calls race.
+    """
     schedule_id = request.form.get("schedule_id")
-    module_id = request.form.get("module_id")
+    module_id = request.form.get("module_id") or None
+    key = request.headers.get("Idempotency-Key") or request.form.get("idempotency_key")
    
     if not schedule_id:
         return jsonify({"error": "Missing schedule_id"}), 400
    
-    schedule = query_db("""
-        SELECT schedule_id, module_id, status FROM schedules
-        WHERE schedule_id=?
-    """, (schedule_id,), one=True)
-   
-    if not schedule:
-        return jsonify({"error": "Schedule not found"}), 404
-   
-    if schedule['status'] == 'done':
-        return jsonify({"error": "Schedule already completed"}), 400
-   
-    if module_id and schedule['module_id'] != module_id:
-        return jsonify({"error": "Module ID mismatch"}), 403
+    if key:
+        seen = query_db("SELECT schedule_id FROM completion_keys WHERE idempotency_key = ?",
+                        (key,), one=True, name="complete_schedule.key")
+        if seen:
+            return replay_completion(seen, schedule_id)
    
-    query_db("""
-        UPDATE schedules SET status='done'
-        WHERE schedule_id=?
-    """, (schedule_id,))
+    try:
+        with transaction() as con:
+            # A device that dispensed just before the grace window closed may report it just after
+            done = con.execute("""
+                UPDATE schedules SET status='done'
+                WHERE schedule_id=? AND status IN ('pending', 'missed') AND module_id=COALESCE(?, module_id)
+                RETURNING schedule_id, module_id, feed_date, feed_time, amount, status
+            """, (schedule_id, module_id)).fetchone()
+       
+            if done is None:
+                # Nothing was pending; a retry carrying the key may have just won the race
+                seen = key and con.execute("SELECT schedule_id FROM completion_keys WHERE idempotency_key = ?",
+                                           (key,)).fetchone()
+                if seen:
+                    return replay_completion(seen, schedule_id)
+                schedule = con.execute("SELECT module_id, status FROM schedules WHERE schedule_id=?",
+                                       (schedule_id,)).fetchone()
+                if not schedule:
+                    return jsonify({"error": "Schedule not found"}), 404
+                if schedule['status'] == 'done':
+                    return jsonify({"error": "Schedule already completed"}), 400
+                if module_id and schedule['module_id'] != module_id:
+                    return jsonify({"error": "Module ID mismatch"}), 403
+                return jsonify({"error": "Schedule was cancelled"}), 400
+       
+            history = con.execute(f"""
+                INSERT INTO history (schedule_id) VALUES (?)
+                RETURNING history_id, datetime(created_at, '{PH_SQL_OFFSET}') AS created_at
+            """, (done['schedule_id'],)).fetchone()
+            apply_feed_rollups(con, "h.history_id = ?", (history['history_id'],))
+            if key:
+                con.execute("""
+                    INSERT INTO completion_keys (idempotency_key, schedule_id, created_at)
+                    VALUES (?, ?, ?)
+                """, (key, done['schedule_id'], int(time.time())))
+                purge_completion_keys(con)
+    except sqlite3.IntegrityError:
+        # The same key completed another schedule while this call waited for
+        # the write lock; everything above was rolled back
+        seen = key and query_db("SELECT schedule_id FROM completion_keys WHERE idempotency_key = ?",
+                                (key,), one=True)
+        if not seen:
+            raise
+        return replay_completion(seen, schedule_id)
    
-    query_db("""
-        INSERT INTO history (schedule_id) VALUES (?)
-    """, (schedule_id,))
+    due_index.invalidate_module(done['module_id'])
+    change_feed.publish("schedules", "update", done['schedule_id'],
+                        {"schedule_id": done['schedule_id'], "status": "done"})
+    change_feed.publish("history", "insert", history['history_id'], {**dict(history), **dict(done)})
    
-    print(f"Schedule {schedule_id} completed by module {schedule['module_id']}")
+    log.info("schedule_completed", schedule_id=schedule_id, module_id=done['module_id'])
    
-    return jsonify({
-        "success": True,
-        "message": "Schedule completed successfully",
-        "schedule_id": schedule_id
-    })
+    return jsonify({**COMPLETED, "schedule_id": schedule_id})
 
 @app.route("/weight_update", methods=["POST"])
 def weight_update():
@@ -229,106 +2244,256 @@ def weight_update():
     if not module_id or weight is None:
         return jsonify({"error": "Missing module_id or weight"}), 400
    
-    try:
-        weight_value = float(weight)
-        if weight_value < 0 or weight_value > 10000:
-            return jsonify({"error": "Invalid weight value"}), 400
-    except ValueError:
-        return jsonify({"error": "Weight must be a number"}), 400
-   
-    print(f"Weight update - Device: {module_id}, Weight: {weight_value}g")
+    weight_value, error = parse_weight(weight)
+    if error:
+        body, code = error
+        return jsonify(body), code
    
-    existing = query_db("""
-        SELECT module_id, status FROM modules WHERE module_id=?
-    """, (module_id,), one=True)
-   
-    if existing:
-        query_db("""
-            UPDATE modules
-            SET weight=?
-            WHERE module_id=?
-        """, (weight_value, module_id))
-       
-        return jsonify({
-            "success": True,
-            "message": f"Weight updated for {module_id}: {weight_value}g",
-            "current_status": existing['status']
-        })
-    else:
-        return jsonify({
-            "error": "Module not registered. Please register module first."
-        }), 403
+    body, code = record_weight(module_id, weight_value, dispatch.decision(module_id)[0])
+    return jsonify(body), code
 
 @app.route('/api/snapshots/<filename>', methods=['DELETE'])
 def delete_snapshot(filename):
-    image_dir = 'instance/images'
+    image_dir = IMAGES_DIR
     try:
-        filepath = os.path.join(image_dir, filename)
-       
-        if not os.path.exists(filepath):
-            return jsonify({'success': False, 'error': 'File not found'}), 404
-       
         if '..' in filename or '/' in filename or '\\' in filename:
             return jsonify({'success': False, 'error': 'Invalid filename'}), 400
        
-        os.remove(filepath)
-        query_db("DELETE FROM image_metadata WHERE filename = ?", (filename,))
+        with transaction() as con:
+            rows = con.execute("""
+                DELETE FROM image_metadata WHERE filename = ?
+                RETURNING filename, storage_name, pack_id
+            """, (filename,)).fetchall()
+            if not rows:
+                if not os.path.exists(os.path.join(image_dir, filename)):
+                    return jsonify({'success': False, 'error': 'File not found'}), 404
+                rows = [{'filename': filename, 'storage_name': filename, 'pack_id': None}]
+            snapshot_archive.forget(con, rows)
+        change_feed.publish("snapshots", "delete", filename)
        
-        print(f"Deleted image: {filename}")
+        log.info("snapshot_deleted", filename=filename)
        
         return jsonify({'success': True, 'message': f'Image {filename} deleted successfully'})
     except Exception as e:
-        print(f"Error deleting image {filename}: {str(e)}")
+        log.error("snapshot_delete_failed", filename=filename, error=e)
         return jsonify({'success': False, 'error': str(e)}), 500
        
+def store_image(stream, expected_sha256=None):
+    """Stream an upload into IMAGES_DIR under its content hash.
+
+    Returns ((storage_name, size, sha256, spare), None) or
+    (None, (error body, status code)). The body is copied in
+    UPLOAD_CHUNK_SIZE pieces to a temp file and hashed on the way, then
+    renamed into place as <sha256>.jpg. When identical bytes were already
+    stored there, the temp file is kept instead and its path returned as
+    spare, for the caller to remove once a row refers to the stored copy.
+    """
+    limit = app.config['UPLOAD_MAX_BYTES']
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    os.makedirs(IMAGES_DIR, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp = tempfile.mkstemp(dir=IMAGES_DIR, prefix='.upload-', suffix='.part')
+    spare = None
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    return None, ({"error": f"Image larger than {limit} bytes"}, 413)
+                digest.update(chunk)
+                out.write(chunk)
+
+        if size == 0:
+            return None, ({"error": "No image data"}, 400)
+        sha256 = digest.hexdigest()
+        if expected_sha256 and expected_sha256.lower() != sha256:
+            return None, ({"error": "Checksum mismatch", "sha256": sha256}, 400)
+
+        storage_name = f"{sha256}.jpg"
+        filepath = os.path.join(IMAGES_DIR, storage_name)
+        if os.path.exists(filepath):
+            spare = temp
+            return (storage_name, size, sha256, spare), None
+        os.replace(temp, filepath)
+        return (storage_name, size, sha256, None), None
+    finally:
+        if spare is None and os.path.exists(temp):
+            os.remove(temp)
+
+def claim_filename(con, camera_id, timestamp):
+    """First free CAM_ts.jpg, CAM_ts_1.jpg, ... name; call inside transaction()"""
+    base = f"{camera_id}_{timestamp}"
+    n = 0
+    while True:
+        filename = f"{base}.jpg" if n == 0 else f"{base}_{n}.jpg"
+        if not con.execute("SELECT 1 FROM image_metadata WHERE filename = ?", (filename,)).fetchone():
+            return filename
+        n += 1
+
+def dedup_stats(camera_id=None):
+    """Frames against distinct stored files, overall or for one camera.
+
+    Frames of unknown size (stored before migration 4, file since gone)
+    count as frames but not towards bytes or the ratio.
+    """
+    where, args = ("WHERE camera_id = ?", (camera_id,)) if camera_id else ("", ())
+    row = query_db(f"""
+        SELECT COUNT(*) AS frames,
+               COUNT(DISTINCT storage_name) AS stored,
+               COALESCE(SUM(size), 0) AS bytes,
+               (SELECT COALESCE(SUM(size), 0) FROM (
+                    SELECT MAX(size) AS size FROM image_metadata {where} GROUP BY storage_name
+               )) AS stored_bytes,
+               COUNT(similar_to) AS similar
+        FROM image_metadata {where}
+    """, args * 2, one=True, name="dedup_stats")
+    stats = dict(row)
+    stats['ratio'] = round(row['bytes'] / row['stored_bytes'], 3) if row['stored_bytes'] else 1.0
+    return stats
+
 @app.route("/upload_image", methods=["POST"])
 def upload_image():
-    """Receive image from ESP32-CAM"""  
-    camera_id = request.form.get("camera_id")
-    category = request.form.get("category", "during")
+    """Receive image from ESP32-CAM.
+
+    Either multipart form data (camera_id, category, image file) or a raw
+    image/jpeg body with camera_id and category in the query string. An
+    optional X-Content-SHA256 header is checked against the received bytes.
+
+    Frames whose bytes are already stored share that copy. When the camera's
+    similar_frames setting is 'flag' or 'skip', a frame within
+    similar_threshold bits (dHash) of the camera's previous frame in the same
+    category is marked with similar_to, or not stored at all.
+    """
+    raw = request.mimetype == 'image/jpeg'
+    fields = request.args if raw else request.form
+    camera_id = fields.get("camera_id")
+    category = fields.get("category", "during")
    
     if not camera_id:
         return jsonify({"error": "Missing camera_id"}), 400
+    if category not in ('during', 'after'):
+        return jsonify({"error": "category must be 'during' or 'after'"}), 400
+
+    limit = app.config['UPLOAD_MAX_BYTES']
+    if raw and request.content_length and request.content_length > limit:
+        return jsonify({"error": f"Image larger than {limit} bytes"}), 413
    
     camera = query_db("""
-        SELECT cam_id FROM camera
+        SELECT cam_id, similar_frames, similar_threshold FROM camera
         WHERE cam_id=? AND status='active'
-    """, (camera_id,), one=True)
+    """, (camera_id,), one=True, name="upload_image.camera")
    
     if not camera:
         return jsonify({"error": "Invalid or inactive camera_id"}), 404
    
-    image = request.files.get('image')
-    if not image:
-        return jsonify({"error": "No image data"}), 400
-   
-    images_dir = os.path.join(app.instance_path, 'images')
-    os.makedirs(images_dir, exist_ok=True)
-   
-    timestamp = int(time.time())
-    filename = f"{camera_id}_{timestamp}.jpg"
-    filepath = os.path.join(images_dir, filename)
-   
-    image.save(filepath)
-    file_size = os.path.getsize(filepath)
+    if raw:
+        stream = request.stream
+    else:
+        image = request.files.get('image')
+        if not image:
+            return jsonify({"error": "No image data"}), 400
+        stream = image.stream
    
-    query_db("""
-        INSERT OR REPLACE INTO image_metadata (filename, camera_id, timestamp, category)
-        VALUES (?, ?, ?, ?)
-    """, (filename, camera_id, timestamp, category))
+    stored, error = store_image(stream, request.headers.get('X-Content-SHA256'))
+    if error:
+        body, code = error
+        return jsonify(body), code
+    storage_name, file_size, sha256, spare = stored
+    stored_name, placed = storage_name, spare is None
+    try:
+        frame_hash = None
+        if camera['similar_frames'] != 'keep' and os.path.exists(os.path.join(IMAGES_DIR, storage_name)):
+            try:
+                frame_hash = dhash(os.path.join(IMAGES_DIR, storage_name))
+            except Exception as e:
+                log.warning("snapshot_hash_failed", storage_name=storage_name, error=e)
+
+        timestamp = int(time.time())
+        similar_to = None
+        with transaction() as con:
+            # Identical bytes stored before (perhaps already packed): share them
+            same = con.execute("""
+                SELECT storage_name, pack_id, pack_offset, dhash FROM image_metadata
+                WHERE sha256 = ?
+                ORDER BY storage_name = ? DESC
+                LIMIT 1
+            """, (sha256, storage_name)).fetchone()
+            pack_id = pack_offset = None
+            # Whether this upload's own copy is redundant
+            shared = same is not None and (same['storage_name'] != storage_name or same['pack_id'] is not None)
+            if same:
+                storage_name, pack_id, pack_offset = same['storage_name'], same['pack_id'], same['pack_offset']
+                if frame_hash is None:
+                    frame_hash = same['dhash']
+            if pack_id is None and not os.path.exists(os.path.join(IMAGES_DIR, storage_name)):
+                # A delete released the stored copy after store_image found it; the
+                # write lock keeps another from releasing this upload's copy now
+                storage_name, shared = stored_name, False
+                if not placed:
+                    os.replace(spare, os.path.join(IMAGES_DIR, storage_name))
+                    placed = True
+
+            if frame_hash is not None:
+                previous = con.execute("""
+                    SELECT filename, dhash FROM image_metadata
+                    WHERE camera_id = ? AND category = ?
+                    ORDER BY timestamp DESC, rowid DESC
+                    LIMIT 1
+                """, (camera_id, category)).fetchone()
+                if (previous and previous['dhash'] is not None
+                        and hamming(previous['dhash'], frame_hash) <= camera['similar_threshold']):
+                    similar_to = previous['filename']
+
+            skipped = similar_to is not None and camera['similar_frames'] == 'skip'
+            if not skipped:
+                filename = claim_filename(con, camera_id, timestamp)
+                con.execute("""
+                    INSERT INTO image_metadata
+                        (filename, camera_id, timestamp, category, size, sha256,
+                         storage_name, pack_id, pack_offset, dhash, similar_to)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (filename, camera_id, timestamp, category, file_size, sha256,
+                      storage_name, pack_id, pack_offset, frame_hash, similar_to))
+            if placed and (skipped or shared):
+                # Nothing refers to the copy this upload wrote
+                os.remove(os.path.join(IMAGES_DIR, stored_name))
+    finally:
+        if spare and os.path.exists(spare):
+            os.remove(spare)
+
+    if skipped:
+        log.debug("snapshot_skipped", camera_id=camera_id, similar_to=similar_to)
+        return jsonify({"success": True, "skipped": True, "similar_to": similar_to,
+                        "camera_id": camera_id, "category": category}), 200
+
+    change_feed.publish("snapshots", "insert", filename, {
+        "filename": filename, "camera_id": camera_id, "timestamp": timestamp, "category": category
+    })
+    if placed and not shared:
+        previews.submit(storage_name)
+    snapshot_archive.start()
    
-    print(f"Saved: {filename}, Size: {file_size} bytes, Camera: {camera_id}, Category: {category}")
+    log.debug("snapshot_saved", filename=filename, size=file_size, camera_id=camera_id, category=category)
    
     return jsonify({
         "success": True,
         "filename": filename,
         "size": file_size,
+        "sha256": sha256,
+        "duplicate": same is not None,
+        "similar_to": similar_to,
         "camera_id": camera_id,
         "category": category
     }), 200
 
 # ------------------ CAMERA ROUTES ------------------
 @app.route("/cameras", methods=["GET"])
+@conditional("cameras")
 def get_cameras():
     rows = query_db("SELECT * FROM camera")
     return jsonify([dict(row) for row in rows])
@@ -338,21 +2503,35 @@ def add_camera():
     data = request.get_json()
     query_db("INSERT INTO camera (cam_id, status) VALUES (?, ?)",
              (data["cam_id"], data["status"]))
+    change_feed.publish("cameras", "insert", data["cam_id"],
+                        {"cam_id": data["cam_id"], "status": data["status"]})
     return jsonify({"success": True})
 
 @app.route("/cameras/<cam_id>", methods=["PUT"])
 def update_camera(cam_id):
+    """Update status and/or the near-duplicate settings (similar_frames, similar_threshold)"""
     data = request.get_json()
-    query_db("UPDATE camera SET status = ? WHERE cam_id = ?",
-             (data["status"], cam_id))
+    fields = {key: data[key] for key in ("status", "similar_frames", "similar_threshold") if key in data}
+    if not fields:
+        return jsonify({"error": "Nothing to update"}), 400
+    if fields.get("similar_frames", "keep") not in ("keep", "flag", "skip"):
+        return jsonify({"error": "similar_frames must be 'keep', 'flag' or 'skip'"}), 400
+    if "similar_threshold" in fields and not (isinstance(fields["similar_threshold"], int)
+                                              and 0 <= fields["similar_threshold"] <= 64):
+        return jsonify({"error": "similar_threshold must be a whole number from 0 to 64"}), 400
+    query_db(f"UPDATE camera SET {', '.join(f'{key} = ?' for key in fields)} WHERE cam_id = ?",
+             (*fields.values(), cam_id))
+    change_feed.publish("cameras", "update", cam_id, {"cam_id": cam_id, **fields})
     return jsonify({"success": True})
 
 @app.route("/cameras/<cam_id>", methods=["DELETE"])
 def delete_camera(cam_id):
     query_db("DELETE FROM camera WHERE cam_id = ?", (cam_id,))
+    change_feed.publish("cameras", "delete", cam_id)
     return jsonify({"success": True})
 
 @app.route('/api/snapshots', methods=['GET'])
+@conditional("snapshots")
 def get_snapshots():
     try:
         rows = query_db("""
@@ -372,20 +2551,71 @@ def get_snapshots():
        
         return jsonify({
             'success': True,
-            'images': images_with_metadata
+            'images': images_with_metadata,
+            'dedup': dedup_stats()
         })
     except Exception as e:
-        print(f"Error loading snapshots: {str(e)}")
+        log.error("snapshots_failed", error=e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def immutable(response):
+    """Mark a response as cacheable forever; its URL never points at other bytes"""
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['IMMUTABLE_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/snapshots/<filename>')
 def serve_snapshot(filename):
+    """Snapshot bytes with a content ETag, Range support and a forever cache policy.
+
+    Loose files go through send_file, which hands the open file to the
+    server's wsgi.file_wrapper (sendfile under waitress or gunicorn), or to
+    the front-end proxy when USE_X_SENDFILE is set. Packed frames are sliced
+    from the pack's memory map.
+    """
+    stored = query_db("""
+        SELECT storage_name, pack_id, pack_offset, size, sha256, timestamp FROM image_metadata
+        WHERE filename = ?
+    """, (filename,), one=True)
+    etag = (stored and stored['sha256']) or True
     try:
-        return send_from_directory('instance/images', filename)
+        if stored and stored['pack_id'] is not None:
+            data = snapshot_archive.read(stored['pack_id'], stored['pack_offset'], stored['size'])
+            response = send_file(io.BytesIO(data), mimetype='image/jpeg', conditional=True,
+                                 etag=stored['sha256'] or hashlib.sha256(data).hexdigest(),
+                                 last_modified=stored['timestamp'])
+        else:
+            response = send_from_directory(IMAGES_DIR, stored['storage_name'] if stored else filename,
+                                           conditional=True, etag=etag)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 404
+    return immutable(response)
+
+@app.route('/previews/<size>/<filename>')
+def serve_preview(size, filename):
+    """Downscaled snapshot (size is a PREVIEW_SIZES key, e.g. thumb or medium)"""
+    if size not in previews.sizes:
+        return jsonify({'success': False, 'error': 'Unknown preview size'}), 404
+    stored = query_db("SELECT storage_name FROM image_metadata WHERE filename = ?", (filename,), one=True)
+    storage_name = stored['storage_name'] if stored else filename
+    if os.path.exists(previews.path(size, storage_name)):
+        return immutable(send_from_directory(os.path.join(PREVIEWS_DIR, size), storage_name,
+                                             conditional=True))
+    # Not rendered yet (or Pillow is missing): queue it and send the original,
+    # which must not be cached under the preview URL
+    if os.path.basename(storage_name) == storage_name and os.path.exists(os.path.join(IMAGES_DIR, storage_name)):
+        previews.submit(storage_name)
+    response = serve_snapshot(filename)
+    if isinstance(response, Response):
+        response.cache_control.immutable = False
+        response.cache_control.max_age = 0
+        response.cache_control.no_cache = True
+    return response
 
 @app.route('/api/snapshots/<cam_id>', methods=['GET'])
+@conditional("snapshots")
 def get_camera_snapshots(cam_id):
     try:
         rows = query_db("""
@@ -407,43 +2637,162 @@ def get_camera_snapshots(cam_id):
         return jsonify({
             'success': True,
             'cam_id': cam_id,
-            'images': camera_images
+            'images': camera_images,
+            'dedup': dedup_stats(cam_id)
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# ------------------ ARCHIVE ROUTES ------------------
+@app.route("/api/archive", methods=["GET"])
+def get_archive():
+    """Pack usage and retention policies"""
+    packs = query_db("SELECT COUNT(*) AS packs, COALESCE(SUM(size), 0) AS bytes FROM snapshot_packs", one=True)
+    frames = query_db("""
+        SELECT COUNT(pack_id) AS packed, COUNT(*) - COUNT(pack_id) AS loose FROM image_metadata
+    """, one=True)
+    policies = query_db("SELECT * FROM snapshot_retention ORDER BY camera_id, category")
+    return jsonify({
+        "packs": packs['packs'],
+        "pack_bytes": packs['bytes'],
+        "packed": frames['packed'],
+        "loose": frames['loose'],
+        "retention": [dict(row) for row in policies]
+    })
+
+@app.route("/api/archive/compact", methods=["POST"])
+def compact_archive():
+    """Run compaction and retention now instead of waiting for the background job"""
+    packed = snapshot_archive.compact()
+    removed = snapshot_archive.apply_retention()
+    return jsonify({"success": True, "packed": packed, "removed": removed})
+
+@app.route("/api/archive/retention", methods=["PUT"])
+def set_retention():
+    """Create or replace the policy for one camera (or '*') and category"""
+    data = request.get_json() or {}
+    camera_id = data.get("camera_id", "*")
+    category = data.get("category")
+    if category not in ('during', 'after'):
+        return jsonify({"error": "category must be 'during' or 'after'"}), 400
+    try:
+        limits = [None if data.get(key) is None else int(data[key])
+                  for key in ("delete_after_days", "thin_after_days", "thin_interval")]
+    except (TypeError, ValueError):
+        return jsonify({"error": "Retention values must be whole numbers"}), 400
+    if any(value is not None and value < 0 for value in limits):
+        return jsonify({"error": "Retention values cannot be negative"}), 400
+
+    row = query_db("""
+        INSERT OR REPLACE INTO snapshot_retention
+            (camera_id, category, delete_after_days, thin_after_days, thin_interval)
+        VALUES (?, ?, ?, ?, ?)
+        RETURNING *
+    """, (camera_id, category, *limits), one=True)
+    return jsonify({"success": True, "retention": dict(row)})
+
+@app.route("/api/archive/retention/<camera_id>/<category>", methods=["DELETE"])
+def delete_retention(camera_id, category):
+    query_db("DELETE FROM snapshot_retention WHERE camera_id=? AND category=?", (camera_id, category))
+    return jsonify({"success": True})
+
 # ------------------ MODULE ROUTES ------------------
 @app.route("/modules", methods=["GET"])
+@conditional("modules")
 def get_modules():
     rows = query_db("SELECT * FROM modules")
-    return jsonify([dict(row) for row in rows])
+    pending = weight_buffer.pending()
+    modules = [dict(row) for row in rows]
+    for module in modules:
+        if module['module_id'] in pending:
+            module['weight'] = pending[module['module_id']]
+    return jsonify(modules)
 
 @app.route("/modules", methods=["POST"])
 def add_module():
     data = request.get_json()
-    query_db("""
+    row = query_db("""
         INSERT INTO modules (module_id, cam_id, status, weight)
         VALUES (?, ?, ?, ?)
-    """, (data["module_id"], data["cam_id"], data["status"], data["weight"]))
+        RETURNING *
+    """, (data["module_id"], data["cam_id"], data["status"], data["weight"]), one=True)
+    due_index.invalidate_module(data["module_id"])
+    change_feed.publish("modules", "insert", data["module_id"], dict(row))
     return jsonify({"success": True})
 
 @app.route("/modules/<module_id>", methods=["PUT"])
 def update_module(module_id):
     data = request.get_json()
-    query_db("""
+    weight_buffer.discard(module_id)
+    row = query_db("""
         UPDATE modules
         SET cam_id = ?, status = ?, weight = ?
         WHERE module_id = ?
-    """, (data["cam_id"], data["status"], data["weight"], module_id))
+        RETURNING *
+    """, (data["cam_id"], data["status"], data["weight"], module_id), one=True)
+    due_index.invalidate_module(module_id)
+    if row:
+        change_feed.publish("modules", "update", module_id, dict(row))
     return jsonify({"success": True})
 
 @app.route("/modules/<module_id>", methods=["DELETE"])
 def delete_module(module_id):
-    query_db("DELETE FROM modules WHERE module_id = ?", (module_id,))
+    weight_buffer.discard(module_id)
+    with transaction() as con:
+        con.execute("DELETE FROM modules WHERE module_id = ?", (module_id,))
+        # Its rules would otherwise keep generating schedules
+        con.execute("DELETE FROM schedule_rules WHERE module_id = ?", (module_id,))
+        weight_series.delete(con, module_id)
+    due_index.invalidate_module(module_id)
+    change_feed.publish("modules", "delete", module_id)
     return jsonify({"success": True})
 
+def parse_ph_time(value):
+    """Unix time for an ISO date or datetime, read as Manila time unless it has an offset"""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=PH_TZ)
+    return int(moment.timestamp())
+
+@app.route("/modules/<module_id>/weights", methods=["GET"])
+def get_module_weights(module_id):
+    """Hopper weight over time: min, max and average per point.
+
+    Query: start and end (ISO date or datetime, Manila time unless an offset
+    is given, end exclusive; default the last 24 hours) and points (default
+    and limit WEIGHT_SERIES_MAX_POINTS). The response names the resolution
+    that was read and the seconds each point covers.
+    """
+    try:
+        end = parse_ph_time(request.args['end']) if request.args.get('end') else int(time.time())
+        start = parse_ph_time(request.args['start']) if request.args.get('start') else end - 86400
+        points = int(request.args.get('points', app.config['WEIGHT_SERIES_MAX_POINTS']))
+    except ValueError:
+        return jsonify({"error": "Invalid start, end or points"}), 400
+    if start >= end or points < 1:
+        return jsonify({"error": "start must be before end, and points at least 1"}), 400
+   
+    resolution, step, rows = weight_series.query(module_id, start, end,
+                                                 min(points, app.config['WEIGHT_SERIES_MAX_POINTS']))
+    return jsonify({
+        "module_id": module_id,
+        "resolution": resolution,
+        "step": step,
+        "points": [{
+            "time": datetime.fromtimestamp(row[0], PH_TZ).isoformat(),
+            "min": row[1],
+            "max": row[2],
+            "avg": row[3],
+            "readings": row[4]
+        } for row in rows]
+    })
+
 # ------------------ SCHEDULE ROUTES ------------------
+SLOT_TAKEN = "A pending schedule already exists for that module, date and time"
+
 @app.route("/schedules", methods=["GET"])
+@materialize_rules_first
+@conditional("schedules")
 def get_schedules():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
@@ -475,127 +2824,591 @@ def add_schedule():
    
     if not data.get("feed_date"):
         return jsonify({"error": "feed_date is required"}), 400
+    try:
+        feed_time = feed_time_hhmm(data.get("feed_time"))
+    except ValueError:
+        return jsonify({"error": "Invalid feed_time format. Use HH:MM"}), 400
    
-    query_db("""
-        INSERT INTO schedules (module_id, feed_date, feed_time, amount, status)
-        VALUES (?, ?, ?, ?, ?)
-    """, (
-        data["module_id"],
-        data["feed_date"],
-        data["feed_time"],
-        data["amount"],
-        data.get("status", "pending")
-    ))
+    try:
+        row = query_db("""
+            INSERT INTO schedules (module_id, feed_date, feed_time, amount, status)
+            VALUES (?, ?, ?, ?, ?)
+            RETURNING *
+        """, (
+            data["module_id"],
+            data["feed_date"],
+            feed_time,
+            data["amount"],
+            data.get("status", "pending")
+        ), one=True)
+    except sqlite3.IntegrityError:
+        return jsonify({"error": SLOT_TAKEN}), 409
+    due_index.invalidate_module(data["module_id"])
+    change_feed.publish("schedules", "insert", row['schedule_id'], dict(row))
     return jsonify({"success": True})
 
 @app.route("/schedules/recurring", methods=["POST"])
 def add_recurring_schedule():
-    """Add a recurring schedule for multiple days"""
+    """Add a recurrence rule and materialize its first RULE_WINDOW_DAYS of schedules.
+
+    Optional: end_date, or days_ahead (default 7, null for no end);
+    every_days (every N days from start_date); weekdays, e.g. ["mon", "thu"].
+    """
     data = request.get_json()
+    fields, error = parse_rule(data)
+    if error:
+        body, code = error
+        return jsonify(body), code
    
-    if not data.get("feed_time"):
-        return jsonify({"error": "feed_time is required"}), 400
+    if "end_date" not in data:
+        days_ahead = data.get("days_ahead", 7)  # Default to 7 days
+        if days_ahead is not None:  # only null means no end
+            try:
+                days_ahead = int(days_ahead)
+            except (TypeError, ValueError):
+                days_ahead = 0
+            if days_ahead < 1:
+                return jsonify({"error": "days_ahead must be at least 1 day, or null for no end"}), 400
+            fields["end_date"] = (date.fromisoformat(fields["start_date"])
+                                  + timedelta(days=days_ahead - 1)).isoformat()
    
-    if not data.get("amount"):
-        return jsonify({"error": "amount is required"}), 400
+    columns = ", ".join(fields)
+    rule = query_db(f"""
+        INSERT INTO schedule_rules ({columns}) VALUES ({", ".join("?" * len(fields))})
+        RETURNING *
+    """, tuple(fields.values()), one=True)
+    change_feed.publish("schedule_rules", "insert", rule['rule_id'], rule_json(rule))
+    created = rule_materializer.materialize(rule_materializer.horizon(), rule['rule_id'])
    
-    # ========== FIX: Use start_date from request ==========
-    if not data.get("start_date"):
-        return jsonify({"error": "start_date is required"}), 400
-   
-    module_id = data["module_id"]
-    feed_time = data["feed_time"]
-    amount = data["amount"]
-    days_ahead = data.get("days_ahead", 7)  # Default to 7 days
-   
-    # Parse the selected start date from the request
-    try:
-        start_date = datetime.strptime(data["start_date"], "%Y-%m-%d").date()
-    except ValueError:
-        return jsonify({"error": "Invalid start_date format. Use YYYY-MM-DD"}), 400
+    return jsonify({
+        "success": True,
+        "rule_id": rule['rule_id'],
+        "created_count": len(created),
+        "dates": [row['feed_date'] for row in created]
+    })
+
+@app.route("/schedules/rules", methods=["GET"])
+@conditional("schedule_rules")
+def get_schedule_rules():
+    module_id = request.args.get('module_id')
+    if module_id:
+        rows = query_db("SELECT * FROM schedule_rules WHERE module_id = ? ORDER BY rule_id", (module_id,))
+    else:
+        rows = query_db("SELECT * FROM schedule_rules ORDER BY rule_id")
+    return jsonify([rule_json(row) for row in rows])
+
+@app.route("/schedules/rules/<int:rule_id>", methods=["PUT"])
+def update_schedule_rule(rule_id):
+    """Edit a rule; its pending schedules from today on follow the edit.
+
+    Occurrences the new pattern no longer covers are removed, the rest are
+    retimed in one statement, and any new dates are materialized.
+    """
+    fields, error = parse_rule(request.get_json() or {}, partial=True)
+    if error:
+        body, code = error
+        return jsonify(body), code
+    if not fields:
+        return jsonify({"error": "Nothing to update"}), 400
    
-    created_schedules = []
+    today = ph_now().strftime("%Y-%m-%d")
+    with transaction() as con:
+        rule = con.execute(f"""
+            UPDATE schedule_rules
+            SET {", ".join(f"{key} = ?" for key in fields)}, materialized_until = date(?, '-1 day')
+            WHERE rule_id = ?
+            RETURNING *
+        """, (*fields.values(), today, rule_id)).fetchone()
+        if rule is None:
+            return jsonify({"error": "Rule not found"}), 404
+        removed = con.execute(f"""
+            DELETE FROM schedules
+            WHERE rule_id = ? AND status = 'pending' AND feed_date >= ?
+            AND (
+                NOT EXISTS (
+                    SELECT 1 FROM schedule_rules r
+                    WHERE r.rule_id = schedules.rule_id AND {rule_matches('schedules.feed_date')}
+                )
+                -- the retimed occurrence would land on another pending schedule
+                OR EXISTS (
+                    SELECT 1 FROM schedules o JOIN schedule_rules r ON r.rule_id = schedules.rule_id
+                    WHERE o.status = 'pending' AND o.schedule_id != schedules.schedule_id
+                    AND o.module_id = r.module_id AND o.feed_date = schedules.feed_date
+                    AND o.feed_time = r.feed_time
+                )
+            )
+            RETURNING schedule_id, module_id
+        """, (rule_id, today)).fetchall()
+        updated = con.execute("""
+            UPDATE schedules
+            SET module_id = r.module_id, feed_time = r.feed_time, amount = r.amount
+            FROM schedule_rules r
+            WHERE r.rule_id = schedules.rule_id
+            AND schedules.rule_id = ? AND schedules.status = 'pending' AND schedules.feed_date >= ?
+            RETURNING *
+        """, (rule_id, today)).fetchall()
    
-    # Create schedules starting from the selected date
-    for day_offset in range(days_ahead):
-        schedule_date = start_date + timedelta(days=day_offset)
-        feed_date = schedule_date.strftime("%Y-%m-%d")
-       
-        # Check if schedule already exists for this date/time/module
-        existing = query_db("""
-            SELECT schedule_id FROM schedules
-            WHERE module_id=? AND feed_date=? AND feed_time=?
-        """, (module_id, feed_date, feed_time), one=True)
-       
-        if not existing:
-            query_db("""
-                INSERT INTO schedules (module_id, feed_date, feed_time, amount, status)
-                VALUES (?, ?, ?, ?, 'pending')
-            """, (module_id, feed_date, feed_time, amount))
-            created_schedules.append(feed_date)
+    # Modules the rule used to belong to as well as its current one
+    due_index.invalidate_module(rule['module_id'], *{row['module_id'] for row in removed})
+    for row in removed:
+        change_feed.publish("schedules", "delete", row['schedule_id'])
+    for row in updated:
+        change_feed.publish("schedules", "update", row['schedule_id'], dict(row))
+    created = rule_materializer.materialize(rule_materializer.horizon(), rule_id)
+    change_feed.publish("schedule_rules", "update", rule_id, rule_json(rule))
    
     return jsonify({
         "success": True,
-        "created_count": len(created_schedules),
-        "dates": created_schedules
+        "rule": rule_json(rule),
+        "updated_count": len(updated),
+        "removed_count": len(removed),
+        "created_count": len(created)
     })
 
+@app.route("/schedules/rules/<int:rule_id>", methods=["DELETE"])
+def delete_schedule_rule(rule_id):
+    """Delete a rule and its pending schedules from today on; earlier ones are kept"""
+    today = ph_now().strftime("%Y-%m-%d")
+    with transaction() as con:
+        removed = con.execute("""
+            DELETE FROM schedules
+            WHERE rule_id = ? AND status = 'pending' AND feed_date >= ?
+            RETURNING schedule_id, module_id
+        """, (rule_id, today)).fetchall()
+        con.execute("UPDATE schedules SET rule_id = NULL WHERE rule_id = ?", (rule_id,))
+        con.execute("DELETE FROM schedule_rules WHERE rule_id = ?", (rule_id,))
+   
+    due_index.invalidate_module(*{row['module_id'] for row in removed})
+    for row in removed:
+        change_feed.publish("schedules", "delete", row['schedule_id'])
+    change_feed.publish("schedule_rules", "delete", rule_id)
+    return jsonify({"success": True, "removed_count": len(removed)})
+
 @app.route("/schedules/<int:schedule_id>", methods=["PUT"])
 def update_schedule(schedule_id):
     data = request.get_json()
-    query_db("""
-        UPDATE schedules
-        SET module_id = ?, feed_date = ?, feed_time = ?, amount = ?, status = ?
-        WHERE schedule_id = ?
-    """, (
-        data["module_id"],
-        data["feed_date"],
-        data["feed_time"],
-        data["amount"],
-        data["status"],
-        schedule_id
-    ))
+    try:
+        feed_time = feed_time_hhmm(data.get("feed_time"))
+    except ValueError:
+        return jsonify({"error": "Invalid feed_time format. Use HH:MM"}), 400
+    # Completed feeds are re-counted under the schedule's new module and amount
+    try:
+        with transaction() as con:
+            apply_feed_rollups(con, "h.schedule_id = ?", (schedule_id,), -1)
+            rows = con.execute("""
+                UPDATE schedules
+                SET module_id = ?, feed_date = ?, feed_time = ?, amount = ?, status = ?
+                WHERE schedule_id = ?
+                RETURNING *
+            """, (
+                data["module_id"],
+                data["feed_date"],
+                feed_time,
+                data["amount"],
+                data["status"],
+                schedule_id
+            )).fetchall()
+            apply_feed_rollups(con, "h.schedule_id = ?", (schedule_id,))
+    except sqlite3.IntegrityError:
+        return jsonify({"error": SLOT_TAKEN}), 409
+    row = rows[0] if rows else None
+    due_index.invalidate_schedule(schedule_id)
+    due_index.invalidate_module(data["module_id"])
+    if row:
+        change_feed.publish("schedules", "update", schedule_id, dict(row))
     return jsonify({"success": True})
 
 @app.route("/schedules/<int:schedule_id>", methods=["DELETE"])
 def delete_schedule(schedule_id):
-    query_db("DELETE FROM schedules WHERE schedule_id = ?", (schedule_id,))
+    with transaction() as con:
+        apply_feed_rollups(con, "h.schedule_id = ?", (schedule_id,), -1)
+        con.execute("DELETE FROM schedules WHERE schedule_id = ?", (schedule_id,))
+    due_index.invalidate_schedule(schedule_id)
+    change_feed.publish("schedules", "delete", schedule_id)
     return jsonify({"success": True})
 
+# ------------------ Bulk schedule import ------------------
+BULK_OPS = {"upsert", "create", "update", "cancel", "delete"}
+BULK_FIELDS = ("op", "schedule_id", "module_id", "feed_date", "feed_time", "amount", "status")
+
+class BulkRejected(Exception):
+    """An atomic bulk request had failing rows; carries the per-row results"""
+
+    def __init__(self, results):
+        super().__init__("bulk request rejected")
+        self.results = results
+
+def read_bulk_rows():
+    """Yield raw row dicts from a JSON, NDJSON or CSV body.
+
+    NDJSON and CSV are decoded line by line from the request stream, so a
+    large plan is never held in memory; JSON is {"operations": [...]} or a
+    bare list.
+    """
+    mimetype = request.mimetype
+    if mimetype in ("application/x-ndjson", "application/jsonl", "application/ndjson"):
+        for line in io.TextIOWrapper(request.stream, encoding="utf-8"):
+            if line.strip():
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    item = "Line is not valid JSON"
+                yield item
+    elif mimetype == "text/csv":
+        yield from csv.DictReader(io.TextIOWrapper(request.stream, encoding="utf-8", newline=""))
+    else:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            data = data.get("operations")
+        if not isinstance(data, list):
+            raise ValueError("Body must be a JSON list of operations, NDJSON or CSV")
+        yield from data
+
+def parse_bulk_row(line, item):
+    """Staging tuple for one bulk row; invalid rows carry their error instead"""
+    if not isinstance(item, dict):
+        return (line, "invalid", None, None, None, None, None, None,
+                item if isinstance(item, str) else "Row must be an object")
+    values = {key: (None if item.get(key) in (None, "") else item[key]) for key in BULK_FIELDS}
+    op = str(values["op"] or "upsert").lower()
+
+    def row(error=None):
+        return (line, op, values["schedule_id"], values["module_id"], values["feed_date"],
+                values["feed_time"], values["amount"], values["status"], error)
+
+    if op not in BULK_OPS:
+        return row(f"op must be one of {', '.join(sorted(BULK_OPS))}")
+    try:
+        if values["schedule_id"] is not None:
+            values["schedule_id"] = int(values["schedule_id"])
+        if values["feed_date"] is not None:
+            values["feed_date"] = datetime.strptime(str(values["feed_date"]), "%Y-%m-%d").strftime("%Y-%m-%d")
+        if values["feed_time"] is not None:
+            values["feed_time"] = feed_time_hhmm(values["feed_time"])
+        if values["amount"] is not None:
+            values["amount"] = float(values["amount"])
+    except (TypeError, ValueError):
+        return row("Invalid schedule_id, feed_date (YYYY-MM-DD), feed_time (HH:MM) or amount")
+    if values["module_id"] is not None:
+        values["module_id"] = str(values["module_id"])
+    if values["status"] not in (None, "pending", "done", "cancelled", "missed"):
+        return row("status must be pending, done, cancelled or missed")
+
+    has_slot = all(values[key] is not None for key in ("module_id", "feed_date", "feed_time"))
+    if op in ("upsert", "create"):
+        if not has_slot or values["amount"] is None:
+            return row(f"{op} needs module_id, feed_date, feed_time and amount")
+        if values["status"] not in (None, "pending"):
+            return row(f"{op} only creates pending schedules")
+    elif op == "update":
+        if values["schedule_id"] is None:
+            return row("update needs schedule_id")
+    elif values["schedule_id"] is None and not has_slot:
+        return row(f"{op} needs schedule_id, or module_id, feed_date and feed_time")
+    return row()
+
+def apply_bulk(con, events):
+    """Apply the staged rows in bulk_rows with set-based statements.
+
+    Order within one request: creates, upserts, then updates, cancels and
+    deletes. Each statement's RETURNING rows go into events for publishing
+    after commit; results are written back onto the staged rows.
+    """
+    id_ops = "('update', 'cancel', 'delete')"
+    slot = """s.module_id = bulk_rows.module_id AND s.feed_date = bulk_rows.feed_date
+              AND s.feed_time = bulk_rows.feed_time"""
+
+    # Creates: a slot that already has a pending schedule is an error, as it
+    # is for POST /schedules; the first create per slot in this request wins
+    con.execute(f"""
+        UPDATE bulk_rows SET error = '{SLOT_TAKEN}'
+        WHERE op = 'create' AND error IS NULL
+        AND EXISTS (SELECT 1 FROM schedules s WHERE s.status = 'pending' AND {slot})
+    """)
+    for row in con.execute("""
+        INSERT INTO schedules (module_id, feed_date, feed_time, amount, status)
+        SELECT module_id, feed_date, feed_time, amount, 'pending' FROM bulk_rows
+        WHERE op = 'create' AND error IS NULL
+        ORDER BY line
+        ON CONFLICT (module_id, feed_date, feed_time) WHERE status = 'pending' DO NOTHING
+        RETURNING *
+    """).fetchall():
+        events.append(("insert", row))
+    con.execute(f"""
+        UPDATE bulk_rows SET result = 'created', result_id = s.schedule_id
+        FROM schedules s
+        WHERE bulk_rows.op = 'create' AND bulk_rows.error IS NULL AND s.status = 'pending' AND {slot}
+        AND bulk_rows.line = (
+            SELECT MIN(b.line) FROM bulk_rows b
+            WHERE b.op = 'create' AND b.error IS NULL AND b.module_id = bulk_rows.module_id
+            AND b.feed_date = bulk_rows.feed_date AND b.feed_time = bulk_rows.feed_time)
+    """)
+    con.execute(f"""
+        UPDATE bulk_rows SET error = '{SLOT_TAKEN}'
+        WHERE op = 'create' AND error IS NULL AND result IS NULL
+    """)
+
+    # Upserts: note which slots were already taken, then insert-or-update in one go
+    con.execute(f"""
+        UPDATE bulk_rows SET result = 'updated', result_id = s.schedule_id
+        FROM schedules s
+        WHERE bulk_rows.op = 'upsert' AND bulk_rows.error IS NULL AND s.status = 'pending' AND {slot}
+    """)
+    existing = {row[0] for row in con.execute(
+        "SELECT result_id FROM bulk_rows WHERE op = 'upsert' AND result_id IS NOT NULL")}
+    for row in con.execute("""
+        INSERT INTO schedules (module_id, feed_date, feed_time, amount, status)
+        SELECT module_id, feed_date, feed_time, amount, 'pending' FROM bulk_rows
+        WHERE op = 'upsert' AND error IS NULL
+        ORDER BY line
+        ON CONFLICT (module_id, feed_date, feed_time) WHERE status = 'pending'
+        DO UPDATE SET amount = excluded.amount
+        RETURNING *
+    """).fetchall():
+        events.append(("update" if row['schedule_id'] in existing else "insert", row))
+    con.execute(f"""
+        UPDATE bulk_rows SET result = 'created', result_id = s.schedule_id
+        FROM schedules s
+        WHERE bulk_rows.op = 'upsert' AND bulk_rows.error IS NULL AND bulk_rows.result IS NULL
+        AND s.status = 'pending' AND {slot}
+    """)
+
+    # cancel/delete by slot: find the pending schedule in that slot, upserts included
+    con.execute(f"""
+        UPDATE bulk_rows SET schedule_id = (
+            SELECT s.schedule_id FROM schedules s WHERE s.status = 'pending' AND {slot})
+        WHERE error IS NULL AND op IN ('cancel', 'delete') AND schedule_id IS NULL
+    """)
+    con.execute(f"""
+        UPDATE bulk_rows SET error = 'schedule_id appears more than once in this request'
+        WHERE error IS NULL AND op IN {id_ops} AND line > (
+            SELECT MIN(b.line) FROM bulk_rows b
+            WHERE b.schedule_id = bulk_rows.schedule_id AND b.op IN {id_ops} AND b.error IS NULL)
+    """)
+
+    # Updates by id; OR IGNORE leaves rows whose new slot is taken untouched
+    targets = "SELECT schedule_id FROM bulk_rows WHERE op = ? AND error IS NULL"
+    apply_feed_rollups(con, f"h.schedule_id IN ({targets})", ("update",), -1)
+    updated = con.execute("""
+        UPDATE OR IGNORE schedules
+        SET module_id = COALESCE(b.module_id, schedules.module_id),
+            feed_date = COALESCE(b.feed_date, schedules.feed_date),
+            feed_time = COALESCE(b.feed_time, schedules.feed_time),
+            amount = COALESCE(b.amount, schedules.amount),
+            status = COALESCE(b.status, schedules.status)
+        FROM bulk_rows b
+        WHERE b.op = 'update' AND b.error IS NULL AND schedules.schedule_id = b.schedule_id
+        RETURNING *
+    """).fetchall()
+    apply_feed_rollups(con, f"h.schedule_id IN ({targets})", ("update",))
+    events.extend(("update", row) for row in updated)
+
+    cancelled = con.execute(f"""
+        UPDATE schedules SET status = 'cancelled'
+        WHERE status = 'pending' AND schedule_id IN ({targets})
+        RETURNING *
+    """, ("cancel",)).fetchall()
+    events.extend(("update", row) for row in cancelled)
+
+    apply_feed_rollups(con, f"h.schedule_id IN ({targets})", ("delete",), -1)
+    deleted = con.execute(f"""
+        DELETE FROM schedules WHERE schedule_id IN ({targets})
+        RETURNING *
+    """, ("delete",)).fetchall()
+    events.extend(("delete", row) for row in deleted)
+
+    for op, rows, result in (("update", updated, "updated"), ("cancel", cancelled, "cancelled"),
+                             ("delete", deleted, "deleted")):
+        con.executemany(f"""
+            UPDATE bulk_rows SET result = '{result}', result_id = schedule_id
+            WHERE op = '{op}' AND error IS NULL AND schedule_id = ?
+        """, [(row['schedule_id'],) for row in rows])
+    con.execute(f"""
+        UPDATE bulk_rows SET error = CASE
+            WHEN schedule_id IS NULL THEN 'No pending schedule in that slot'
+            WHEN NOT EXISTS (SELECT 1 FROM schedules s WHERE s.schedule_id = bulk_rows.schedule_id)
+                THEN 'Schedule not found'
+            WHEN op = 'cancel' THEN 'Schedule is not pending'
+            ELSE '{SLOT_TAKEN}' END
+        WHERE error IS NULL AND result IS NULL
+    """)
+
+@app.route("/schedules/bulk", methods=["POST"])
+def bulk_schedules():
+    """Create, update, cancel or delete many schedules in one transaction.
+
+    Rows: {"op": "upsert" | "create" | "update" | "cancel" | "delete",
+    "schedule_id", "module_id", "feed_date", "feed_time", "amount", "status"}.
+    upsert (the default) is keyed on module_id, feed_date and feed_time and
+    inserts a pending schedule or changes the pending one's amount; create
+    does the same but fails if that slot already has a pending schedule.
+    update needs schedule_id; cancel and delete take schedule_id or the slot. The body is a JSON list, NDJSON or CSV with those columns.
+
+    Rows that fail are reported and the rest applied, unless ?atomic=1, in
+    which case any failure rolls the whole request back with status 409.
+    """
+    atomic = request.args.get("atomic", "").lower() in ("1", "true", "yes")
+    limit = app.config["BULK_MAX_ROWS"]
+    chunk_size = app.config["BULK_CHUNK_ROWS"]
+    events = []
+    try:
+        with pooled_connection() as con:
+            con.execute("""
+                CREATE TEMP TABLE bulk_rows (
+                    line INTEGER PRIMARY KEY, op TEXT NOT NULL, schedule_id INTEGER,
+                    module_id TEXT, feed_date TEXT, feed_time TEXT, amount REAL, status TEXT,
+                    error TEXT, result TEXT, result_id INTEGER
+                )
+            """)
+            try:
+                # Staging only writes the connection's temp database, so no write
+                # lock is held while a slow client is still sending the body
+                rows = (parse_bulk_row(line, item) for line, item in enumerate(read_bulk_rows(), 1))
+                staged = 0
+                while True:
+                    chunk = list(islice(rows, chunk_size))
+                    if not chunk:
+                        break
+                    staged += len(chunk)
+                    if staged > limit:
+                        return jsonify({"error": f"At most {limit} rows per request"}), 413
+                    con.executemany("""
+                        INSERT INTO bulk_rows (line, op, schedule_id, module_id, feed_date,
+                                               feed_time, amount, status, error)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, chunk)
+                    con.commit()
+                if not staged:
+                    return jsonify({"error": "No rows"}), 400
+
+                with transaction(con=con):
+                    apply_bulk(con, events)
+                    results = [{key: row[key] for key in row.keys() if row[key] is not None}
+                               for row in con.execute("""
+                                   SELECT line, op, result, result_id AS schedule_id, error
+                                   FROM bulk_rows ORDER BY line
+                               """)]
+                    if atomic and any("error" in result for result in results):
+                        raise BulkRejected([result if "error" in result else
+                                            {"line": result["line"], "op": result["op"], "result": "rolled_back"}
+                                            for result in results])
+            finally:
+                if con.in_transaction:
+                    con.rollback()
+                con.execute("DROP TABLE IF EXISTS temp.bulk_rows")
+    except BulkRejected as rejected:
+        return jsonify({"success": False, "atomic": True, "results": rejected.results}), 409
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"error": str(e)}), 400
+
+    due_index.invalidate_module(*{row['module_id'] for _, row in events})
+    for op, row in events:
+        if op == "delete":
+            change_feed.publish("schedules", "delete", row['schedule_id'])
+        else:
+            change_feed.publish("schedules", op, row['schedule_id'], dict(row))
+
+    summary = {}
+    for result in results:
+        outcome = result.get("result", "error")
+        summary[outcome] = summary.get(outcome, 0) + 1
+    return jsonify({"success": "error" not in summary, "summary": summary, "results": results})
+
 # ------------------ HISTORY ROUTES ------------------
+# created_at is stored in UTC and converted to Manila time by SQLite itself
+HISTORY_SELECT = f"""
+    SELECT h.history_id, datetime(h.created_at, '{PH_SQL_OFFSET}') AS created_at,
+           s.schedule_id, s.module_id, s.feed_date, s.feed_time, s.amount, s.status
+    FROM history h
+    LEFT JOIN schedules s ON h.schedule_id = s.schedule_id
+"""
+
+def encode_history_cursor(row):
+    raw = f"{row['created_at']}|{row['history_id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_history_cursor(cursor):
+    """(Manila created_at, history_id) from a cursor; raises ValueError if malformed"""
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_at, history_id = raw.rsplit("|", 1)
+    datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+    return created_at, int(history_id)
+
+def publish_history(history_id):
+    row = query_db(HISTORY_SELECT + " WHERE h.history_id = ?", (history_id,), one=True)
+    if row:
+        change_feed.publish("history", "insert", history_id, dict(row))
+
 @app.route("/history", methods=["GET"])
+@conditional("history", "schedules")
 def get_history():
-    rows = query_db("""
-        SELECT h.history_id, h.created_at, s.schedule_id, s.module_id, s.feed_date, s.feed_time, s.amount, s.status
-        FROM history h
-        LEFT JOIN schedules s ON h.schedule_id = s.schedule_id
-        ORDER BY h.created_at DESC
-    """)
+    """Feeding history, newest first.
+
+    Without limit the full list is returned as before. With limit (and the
+    next_cursor from the previous page as cursor) it returns one page:
+    {"items": [...], "next_cursor": "..." or null}. module_id, start_date and
+    end_date (Manila dates, YYYY-MM-DD) filter either form.
+    """
+    conditions, params = [], []
    
-    result = []
-    for row in rows:
-        row_dict = dict(row)
-       
-        if row_dict['created_at']:
-            utc_time = datetime.strptime(row_dict['created_at'], '%Y-%m-%d %H:%M:%S')
-            utc_time = pytz.utc.localize(utc_time)
-            ph_time = utc_time.astimezone(PH_TZ)
-            row_dict['created_at'] = ph_time.strftime('%Y-%m-%d %H:%M:%S')
-       
-        result.append(row_dict)
+    if request.args.get('module_id'):
+        conditions.append("s.module_id = ?")
+        params.append(request.args['module_id'])
+   
+    # Date filters are turned into UTC bounds on the raw column so the
+    # created_at index still applies
+    try:
+        if request.args.get('start_date'):
+            datetime.strptime(request.args['start_date'], '%Y-%m-%d')
+            conditions.append(f"h.created_at >= datetime(?, '{PH_SQL_TO_UTC}')")
+            params.append(request.args['start_date'])
+        if request.args.get('end_date'):
+            datetime.strptime(request.args['end_date'], '%Y-%m-%d')
+            conditions.append(f"h.created_at < datetime(?, '+1 day', '{PH_SQL_TO_UTC}')")
+            params.append(request.args['end_date'])
+    except ValueError:
+        return jsonify({"error": "Invalid date format. Use YYYY-MM-DD"}), 400
    
-    return jsonify(result)
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = query_db(HISTORY_SELECT + where + " ORDER BY h.created_at DESC, h.history_id DESC",
+                        tuple(params))
+        return jsonify([dict(row) for row in rows])
+   
+    try:
+        limit = max(1, min(int(limit or 50), app.config['HISTORY_PAGE_MAX']))
+        if cursor:
+            created_at, history_id = decode_history_cursor(cursor)
+            conditions.append(f"(h.created_at, h.history_id) < (datetime(?, '{PH_SQL_TO_UTC}'), ?)")
+            params.extend([created_at, history_id])
+    except ValueError:
+        return jsonify({"error": "Invalid limit or cursor"}), 400
+   
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = query_db(HISTORY_SELECT + where + " ORDER BY h.created_at DESC, h.history_id DESC LIMIT ?",
+                    tuple(params) + (limit + 1,))
+    items = [dict(row) for row in rows[:limit]]
+    next_cursor = encode_history_cursor(items[-1]) if len(rows) > limit else None
+    return jsonify({"items": items, "next_cursor": next_cursor})
 
 @app.route("/history", methods=["POST"])
 def add_history():
     data = request.get_json()
-    query_db("INSERT INTO history (schedule_id) VALUES (?)",
-             (data["schedule_id"],))
+    with transaction() as con:
+        row = con.execute("INSERT INTO history (schedule_id) VALUES (?) RETURNING history_id",
+                          (data["schedule_id"],)).fetchall()[0]
+        apply_feed_rollups(con, "h.history_id = ?", (row['history_id'],))
+    publish_history(row['history_id'])
     return jsonify({"success": True})
 
 @app.route("/history/<int:history_id>", methods=["DELETE"])
 def delete_history(history_id):
-    query_db("DELETE FROM history WHERE history_id = ?", (history_id,))
+    with transaction() as con:
+        apply_feed_rollups(con, "h.history_id = ?", (history_id,), -1)
+        con.execute("DELETE FROM history WHERE history_id = ?", (history_id,))
+    change_feed.publish("history", "delete", history_id)
     return jsonify({"success": True})
 
 # ------------------ ANALYTICS ROUTES ------------------
@@ -603,12 +3416,11 @@ def delete_history(history_id):
 def get_analytics_summary():
     """Get summary statistics for analytics dashboard"""
    
-    today = datetime.now().strftime("%Y-%m-%d")
+    today = ph_now().strftime("%Y-%m-%d")
     total_fed = query_db("""
-        SELECT COALESCE(SUM(s.amount), 0) as total
-        FROM history h
-        JOIN schedules s ON h.schedule_id = s.schedule_id
-        WHERE DATE(h.created_at) = ?
+        SELECT COALESCE(SUM(amount), 0) as total
+        FROM feed_rollup_daily
+        WHERE bucket = ?
     """, (today,), one=True)
    
     active_modules = query_db("""
@@ -627,10 +3439,10 @@ def get_analytics_summary():
 
 @app.route("/analytics/weekly", methods=["GET"])
 def get_weekly_feeding():
-    """Get weekly feeding data for chart"""
-    rows = query_db("""
+    """Get weekly feeding data for chart (the last seven Manila days)"""
+    rows = query_db(f"""
         SELECT
-            CASE CAST(strftime('%w', h.created_at) AS INTEGER)
+            CASE CAST(strftime('%w', bucket) AS INTEGER)
                 WHEN 0 THEN 'Sun'
                 WHEN 1 THEN 'Mon'
                 WHEN 2 THEN 'Tue'
@@ -639,15 +3451,82 @@ def get_weekly_feeding():
                 WHEN 5 THEN 'Fri'
                 WHEN 6 THEN 'Sat'
             END as day,
-            COALESCE(SUM(s.amount), 0) as amount
-        FROM history h
-        JOIN schedules s ON h.schedule_id = s.schedule_id
-        WHERE h.created_at >= date('now', '-7 days')
-        GROUP BY strftime('%w', h.created_at)
-        ORDER BY strftime('%w', h.created_at)
+            COALESCE(SUM(amount), 0) as amount
+        FROM feed_rollup_daily
+        WHERE bucket >= date('now', '{PH_SQL_OFFSET}', '-6 days')
+        GROUP BY strftime('%w', bucket)
+        ORDER BY strftime('%w', bucket)
     """)
     return jsonify([dict(row) for row in rows])
 
+def rollup_bucket(bucket):
+    """(rollup table, SQL expression grouping its bucket column) for a bucket size.
+
+    Accepts hour, day, week (starting Monday), month, or <n>h / <n>d.
+    Raises ValueError for anything else.
+    """
+    named = {"hour": "1h", "day": "1d"}
+    if bucket == "week":
+        return "feed_rollup_daily", "date(bucket, '-' || ((strftime('%w', bucket) + 6) % 7) || ' days')"
+    if bucket == "month":
+        return "feed_rollup_daily", "strftime('%Y-%m-01', bucket)"
+    match = re.fullmatch(r"([1-9]\d{0,3})([hd])", named.get(bucket, bucket))
+    if not match:
+        raise ValueError(bucket)
+    size, unit = int(match.group(1)), match.group(2)
+    if unit == "h":
+        return "feed_rollup_hourly", (
+            f"strftime('%Y-%m-%d %H:00', (CAST(strftime('%s', bucket) AS INTEGER) / {size * 3600}) * {size * 3600}, 'unixepoch')")
+    return "feed_rollup_daily", (
+        f"date((CAST(strftime('%s', bucket) AS INTEGER) / {size * 86400}) * {size * 86400}, 'unixepoch')")
+
+@app.route("/analytics/feeding", methods=["GET"])
+@conditional("history", "schedules")
+def get_feeding_series():
+    """Feeds and grams per bucket, read only from the rollup tables.
+
+    Query: start_date, end_date (Manila dates, inclusive, required),
+    bucket (hour, day, week, month, <n>h or <n>d; default day), optional
+    module_id, and per_module=1 to split each bucket by module.
+    """
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    if not start_date or not end_date:
+        return jsonify({"error": "start_date and end_date are required"}), 400
+    try:
+        datetime.strptime(start_date, "%Y-%m-%d")
+        datetime.strptime(end_date, "%Y-%m-%d")
+        table, bucket_expr = rollup_bucket(request.args.get('bucket', 'day'))
+    except ValueError:
+        return jsonify({"error": "Invalid date or bucket"}), 400
+   
+    # Hourly buckets are 'YYYY-MM-DD HH:00', so compare against the next day
+    conditions = ["bucket >= ?", "bucket < date(?, '+1 day')"]
+    params = [start_date, end_date]
+    if request.args.get('module_id'):
+        conditions.append("module_id = ?")
+        params.append(request.args['module_id'])
+   
+    per_module = request.args.get('per_module') in ('1', 'true')
+    group = f"{bucket_expr}, module_id" if per_module else bucket_expr
+    rows = query_db(f"""
+        SELECT {bucket_expr} AS bucket, {'module_id, ' if per_module else ''}
+               SUM(feeds) AS feeds, SUM(amount) AS amount
+        FROM {table}
+        WHERE {' AND '.join(conditions)}
+        GROUP BY {group}
+        ORDER BY {group}
+    """, tuple(params))
+    return jsonify([dict(row) for row in rows])
+
+@app.route("/analytics/rollups/rebuild", methods=["POST"])
+def rebuild_rollups():
+    """Recompute the feeding rollups from history and schedules"""
+    with transaction() as con:
+        rebuild_feed_rollups(con)
+    change_feed.touch("history")
+    return jsonify({"success": True})
+
 @app.route("/analytics/module-status", methods=["GET"])
 def get_module_status():
     """Get module status distribution"""
@@ -660,7 +3539,123 @@ def get_module_status():
     """)
     return jsonify([dict(row) for row in rows])
 
+# ------------------ CHANGE FEED ROUTES ------------------
+event_streams = threading.BoundedSemaphore(app.config['CHANGE_FEED_MAX_STREAMS'])
+
+@app.route("/events", methods=["GET"])
+def change_events():
+    """Server-sent events stream of row changes for the dashboard.
+
+    Each change is an event named "change" whose data is
+    {"table", "op": insert|update|delete, "key", "row"}; update rows may be
+    partial. A "resync" event means changes were missed and the page should
+    reload its data.
+
+    At most CHANGE_FEED_MAX_STREAMS streams are open at once; past that, or
+    once shutdown has started, the request gets 503 with Retry-After. Each
+    stream ends after CHANGE_FEED_STREAM_SECONDS and the browser reconnects.
+    """
+    if change_feed.closed or not event_streams.acquire(blocking=False):
+        response = jsonify({"error": "Too many open event streams"})
+        response.headers["Retry-After"] = "30"
+        return response, 503
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        after = int(last_event_id) if last_event_id else change_feed.last_id
+    except ValueError:
+        after = change_feed.last_id
+    keepalive = app.config['CHANGE_FEED_KEEPALIVE']
+    ends = time.monotonic() + app.config['CHANGE_FEED_STREAM_SECONDS']
+
+    def stream():
+        nonlocal after
+        yield f"retry: 3000\nid: {after}\nevent: ready\ndata: {{}}\n\n"
+        while not change_feed.closed:
+            remaining = ends - time.monotonic()
+            if remaining <= 0:
+                return
+            events = change_feed.read(after, min(keepalive, remaining))
+            if events is None:
+                after = change_feed.last_id
+                yield f"id: {after}\nevent: resync\ndata: {{}}\n\n"
+            elif not events:
+                yield ": keep-alive\n\n"
+            else:
+                for event_id, data in events:
+                    yield f"id: {event_id}\nevent: change\ndata: {data}\n\n"
+                after = events[-1][0]
+
+    response = Response(stream(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Not a finally in stream(): a generator that never starts never runs it
+    response.call_on_close(event_streams.release)
+    return response
+
+# ------------------ STATS ROUTES ------------------
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    """In-process counters for the device-facing caches and buffers"""
+    return jsonify({
+        "database": db_pool.stats(),
+        "weight_buffer": weight_buffer.stats(),
+        "previews": previews.stats(),
+        "snapshot_archive": snapshot_archive.stats(),
+        "dispatch": dispatch.stats(),
+        "long_poll_waiting": due_index.waiting()
+    })
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus text format: route and query latency histograms plus pool and buffer gauges"""
+    database, dispatched = db_pool.stats(), dispatch.stats()
+    gauges = {
+        ("smartfeeder_db_connections_opened_total", "SQLite connections opened", "counter"): database["opened"],
+        ("smartfeeder_db_connections_idle", "Pooled connections waiting for reuse", "gauge"): database["idle"],
+        ("smartfeeder_db_connections_in_use", "Connections currently checked out", "gauge"): database["in_use"],
+        ("smartfeeder_db_lock_waits_total", "Write transactions that waited for the lock", "counter"):
+            database["lock_waits"],
+        ("smartfeeder_db_lock_wait_seconds_total", "Time spent waiting for the write lock", "counter"):
+            database["lock_wait_seconds"],
+        ("smartfeeder_db_lock_timeouts_total", "Write transactions that gave up on the lock", "counter"):
+            database["lock_timeouts"],
+        ("smartfeeder_weight_buffer_pending", "Weight readings not yet written", "gauge"):
+            weight_buffer.stats()["pending"],
+        ("smartfeeder_long_poll_waiting", "Device long-polls being held open", "gauge"): due_index.waiting(),
+        ("smartfeeder_dispatch_ready", "Modules with a precomputed dispense decision", "gauge"):
+            dispatched["ready"],
+        ("smartfeeder_dispatch_timers", "Pending decision changes on the scheduler heap", "gauge"):
+            dispatched["timers"],
+        ("smartfeeder_schedules_missed_total", "Schedules expired after their grace window", "counter"):
+            dispatched["missed"],
+        ("smartfeeder_log_suppressed_total", "Log lines dropped by the rate limit", "counter"): log.suppressed,
+    }
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
 # ------------------ FRONTEND ROUTES ------------------
+_static_versions = {}
+
+@app.context_processor
+def static_helpers():
+    def static_url(filename):
+        """/static URL with a content hash, e.g. scripts/chart.min.js?v=1a2b3c4d5e6f"""
+        path = os.path.join(app.static_folder, filename)
+        stat = os.stat(path)
+        key = (filename, stat.st_mtime_ns, stat.st_size)
+        version = _static_versions.get(key)
+        if version is None:
+            with open(path, 'rb') as f:
+                version = hashlib.sha256(f.read()).hexdigest()[:12]
+            _static_versions[key] = version
+        return f"/static/{filename}?v={version}"
+    return {"static_url": static_url}
+
+@app.after_request
+def cache_versioned_static(response):
+    # A versioned URL changes whenever the file does, so it can be cached forever
+    if request.endpoint == 'static' and 'v' in request.args and response.status_code == 200:
+        immutable(response)
+    return response
+
 @app.route("/")
 def serve_index():
     return render_template("index.html")
@@ -687,4 +3682,6 @@ def serve_camera():
 
 # ------------------ Run App ------------------
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True, threaded=True)
\ No newline at end of file
+    # Development server; FLASK_DEBUG=1 turns on the debugger and reloader.
+    # Use smartfeeder_launcher.py --production for devices.
+    app.run(host="0.0.0.0", port=8080, debug=app.debug, threaded=True)
\ No newline at end of file
@@ -0,0 +1,844 @@
+"""
+SmartFeeder benchmarks
+
+Runs the Flask app in-process against a throwaway instance folder, so the
+real database in instance/ is never touched.
+
+    python benchmark.py routes [--requests 500] [--modules 50]
+    python benchmark.py index [--rows 1000000] [--modules 1000]
+    python benchmark.py startup [--runs 5] [--exe dist/SmartFeeder/SmartFeeder.exe] [--max-ms 3000]
+    python benchmark.py fleet [--fleets 10x1,100x4,500x16] [--duration 10] [--url http://host:8080]
+    python benchmark.py fleet --gateway --long-polls 5000   # device routes via device_gateway.py
+    python benchmark.py stress [--schedules 500] [--threads 16] [--attempts 4]
+    python benchmark.py series [--modules 5] [--days 90] [--points 500]
+"""
+import argparse
+import asyncio
+import heapq
+import http.client
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+def load_app(instance_dir):
+    """Import app.py with its instance folder pointed at instance_dir"""
+    os.environ['SMARTFEEDER_INSTANCE_PATH'] = instance_dir
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+    return app_module
+
+def close_app(app_module):
+    """Flush buffered writes before the throwaway instance folder is deleted"""
+    app_module.weight_buffer.flush()
+    app_module.previews.shutdown()
+    app_module.db_pool.close_all()
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def print_table(title, results):
+    print(title)
+    print(f"  {'route':<22}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'req/s':>10}")
+    for route, samples in results.items():
+        mean = statistics.mean(samples) * 1000
+        print(f"  {route:<22}{mean:>10.3f}"
+              f"{percentile(samples, 50) * 1000:>10.3f}"
+              f"{percentile(samples, 95) * 1000:>10.3f}"
+              f"{len(samples) / sum(samples):>10.0f}")
+    print()
+
+# ------------------ Seed data ------------------
+def seed(app_module, modules, schedules_per_module):
+    today = app_module.ph_now().strftime("%Y-%m-%d")
+    with app_module.transaction() as con:
+        con.execute("INSERT OR IGNORE INTO camera (cam_id, status) VALUES ('BENCHCAM', 'active')")
+        for m in range(modules):
+            module_id = f"BENCH{m:04d}"
+            con.execute("""
+                INSERT OR IGNORE INTO modules (module_id, cam_id, status, weight)
+                VALUES (?, 'BENCHCAM', 'active', 500)
+            """, (module_id,))
+            con.executemany("""
+                INSERT INTO schedules (module_id, feed_date, feed_time, amount, status)
+                VALUES (?, ?, ?, 25, 'pending')
+            """, [(module_id, today, f"00:{s % 60:02d}") for s in range(schedules_per_module)])
+
+def pending_schedule_ids(app_module):
+    rows = app_module.query_db("SELECT schedule_id, module_id FROM schedules WHERE status='pending'")
+    return [(row['schedule_id'], row['module_id']) for row in rows]
+
+# ------------------ Unpooled baseline ------------------
+class UnpooledConnections:
+    """The original query_db behaviour: a fresh connection for every statement"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def acquire(self):
+        con = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        return con
+
+    def release(self, con):
+        con.close()
+
+    def close_all(self):
+        pass
+
+    def begin(self, con):
+        con.execute("BEGIN IMMEDIATE")
+
+    def stats(self):
+        return {}
+
+# ------------------ Route benchmark ------------------
+JPEG_BYTES = b"\xff\xd8\xff\xe0" + b"\x00" * 2048 + b"\xff\xd9"
+WARMUP = 20  # untimed requests per route before timing
+
+def bench_device_routes(app_module, count, modules, phase):
+    """Time each device route; phase makes this run's upload bytes its own.
+
+    Each run stores and previews its own frame instead of finding the last
+    run's, and the preview queue is drained before returning, so background
+    rendering isn't charged to whichever run comes first.
+    """
+    client = app_module.app.test_client()
+    module_ids = [f"BENCH{m:04d}" for m in range(modules)]
+    to_complete = pending_schedule_ids(app_module)[:count]
+    image = JPEG_BYTES[:-2] + phase.encode() + JPEG_BYTES[-2:]
+    results = {}
+
+    def timed(route, make_request, n, warmup=WARMUP):
+        for i in range(warmup):
+            make_request(i)
+        app_module.previews.shutdown()  # let renders queued by the warmup finish first
+        samples = []
+        for i in range(n):
+            start = time.perf_counter()
+            response = make_request(i)
+            samples.append(time.perf_counter() - start)
+            if response.status_code >= 500:
+                raise RuntimeError(f"{route} failed: {response.status_code} {response.data!r}")
+        results[route] = samples
+
+    timed("/health", lambda i: client.get("/health"), count)
+    timed("/check_schedule", lambda i: client.post(
+        "/check_schedule", data={"module_id": module_ids[i % modules]}), count)
+    timed("/weight_update", lambda i: client.post(
+        "/weight_update", data={"module_id": module_ids[i % modules], "weight": str(400 + i % 50)}), count)
+    timed("/complete_schedule", lambda i: client.post(
+        "/complete_schedule",
+        data={"schedule_id": str(to_complete[i][0]), "module_id": to_complete[i][1]}),
+        len(to_complete), warmup=0)  # each call uses up a schedule
+    timed("/upload_image", lambda i: client.post(
+        "/upload_image",
+        data={"camera_id": "BENCHCAM", "category": "during",
+              "image": (io.BytesIO(image), "frame.jpg")},
+        content_type="multipart/form-data"), max(1, count // 10))
+    timed("/upload_image (raw)", lambda i: client.post(
+        "/upload_image?camera_id=BENCHCAM&category=during",
+        data=image, content_type="image/jpeg"), max(1, count // 10))
+    app_module.previews.shutdown()
+    return results
+
+def cmd_routes(args):
+    workdir = tempfile.mkdtemp(prefix="smartfeeder-bench-")
+    try:
+        app_module = load_app(workdir)
+        seed(app_module, args.modules, max(1, (2 * args.requests) // args.modules + 1))
+
+        # Baseline: a copy of the same data in the default rollback-journal mode,
+        # opened and closed around every statement like the old query_db.
+        legacy_path = os.path.join(workdir, "legacy.db")
+        app_module.query_db("VACUUM INTO ?", (legacy_path,))
+        con = sqlite3.connect(legacy_path)
+        con.execute("PRAGMA journal_mode=DELETE")
+        con.close()
+
+        pooled = bench_device_routes(app_module, args.requests, args.modules, "pooled")
+
+        app_module.db_pool.close_all()
+        pooled_pool = app_module.db_pool
+        app_module.db_pool = UnpooledConnections(legacy_path)
+        try:
+            unpooled = bench_device_routes(app_module, args.requests, args.modules, "unpooled")
+        finally:
+            app_module.weight_buffer.flush()
+            app_module.db_pool = pooled_pool
+
+        print_table("Unpooled (connect per statement, rollback journal)", unpooled)
+        print_table("Pooled (long-lived WAL connections)", pooled)
+        print("Speedup (mean latency):")
+        for route in pooled:
+            ratio = statistics.mean(unpooled[route]) / statistics.mean(pooled[route])
+            print(f"  {route:<22}{ratio:>8.2f}x")
+        close_app(app_module)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# ------------------ Index benchmark ------------------
+DUE_QUERY = """
+    SELECT schedule_id, amount, feed_time, feed_date FROM schedules {hint}
+    WHERE module_id=?
+    AND feed_date=?
+    AND feed_time<=?
+    AND status='pending'
+    ORDER BY feed_time ASC
+    LIMIT 1
+"""
+
+def cmd_index(args):
+    workdir = tempfile.mkdtemp(prefix="smartfeeder-bench-")
+    try:
+        app_module = load_app(workdir)
+        days = max(1, args.rows // (args.modules * 4))
+        start = time.perf_counter()
+        with app_module.transaction() as con:
+            con.executemany("INSERT INTO modules (module_id, cam_id, status, weight) VALUES (?, 'CAM', 'active', 0)",
+                            [(f"M{m:05d}",) for m in range(args.modules)])
+            con.executemany(
+                "INSERT INTO schedules (module_id, feed_date, feed_time, amount, status) VALUES (?, date('now', ?), ?, 20, ?)",
+                ((f"M{i % args.modules:05d}", f"-{(i // args.modules) % days} days",
+                  f"{6 + (i // (args.modules * days)) % 4 * 4:02d}:00",
+                  "pending" if i % 3 else "done")
+                 for i in range(args.rows)))
+        app_module.query_db("ANALYZE")
+        print(f"Seeded {args.rows} schedules for {args.modules} modules "
+              f"in {time.perf_counter() - start:.1f}s")
+
+        today = time.strftime("%Y-%m-%d")
+        plan = app_module.query_db("EXPLAIN QUERY PLAN " + DUE_QUERY.format(hint=""),
+                                   ("M00001", today, "23:59"))
+        print("Query plan: " + "; ".join(row["detail"] for row in plan))
+
+        for label, hint, polls in (("indexed", "", args.polls),
+                                   ("full scan", "NOT INDEXED", max(1, args.polls // 100))):
+            samples = []
+            for i in range(polls):
+                module_id = f"M{i % args.modules:05d}"
+                t0 = time.perf_counter()
+                app_module.query_db(DUE_QUERY.format(hint=hint), (module_id, today, "23:59"), one=True)
+                samples.append(time.perf_counter() - t0)
+            print(f"  {label:<10} p50 {percentile(samples, 50) * 1000:8.3f} ms"
+                  f"   p99 {percentile(samples, 99) * 1000:8.3f} ms   ({polls} polls)")
+        close_app(app_module)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# ------------------ Startup benchmark ------------------
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORT_APP = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def time_import(instance_dir):
+    """Seconds to import app.py in a fresh interpreter"""
+    env = dict(os.environ, SMARTFEEDER_INSTANCE_PATH=instance_dir)
+    out = subprocess.run([sys.executable, "-c", IMPORT_APP], cwd=HERE, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+def time_launch(command, instance_dir, timeout=60):
+    """Seconds from starting a launcher process until its /health answers 200"""
+    port = free_port()
+    env = dict(os.environ, SMARTFEEDER_INSTANCE_PATH=instance_dir)
+    start = time.perf_counter()
+    process = subprocess.Popen(command + ["--no-browser", "--port", str(port)], cwd=HERE, env=env,
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"{command[0]} exited with {process.returncode}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, OSError):
+                time.sleep(0.01)
+        raise RuntimeError(f"{command[0]} did not answer /health within {timeout}s")
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def cmd_startup(args):
+    """Cold (new database) and warm (migrated database) start, each in a fresh process"""
+    targets = [("import app.py", time_import),
+               ("launcher (source)", lambda d: time_launch(
+                   [sys.executable, os.path.join(HERE, "smartfeeder_launcher.py")], d))]
+    exe = args.exe or os.path.join(HERE, "dist", "SmartFeeder",
+                                   "SmartFeeder.exe" if sys.platform == "win32" else "SmartFeeder")
+    if os.path.isfile(exe):
+        targets.append(("launcher (packaged)", lambda d: time_launch([exe], d)))
+    else:
+        print(f"No packaged build at {exe}; build it with: pyinstaller SmartFeeder.spec\n")
+
+    print(f"  {'target':<22}{'state':>6}{'p50 ms':>10}{'min ms':>10}{'max ms':>10}")
+    slow = []
+    for label, run in targets:
+        for state in ("cold", "warm"):
+            samples = []
+            for _ in range(args.runs):
+                workdir = tempfile.mkdtemp(prefix="smartfeeder-bench-")
+                try:
+                    if state == "warm":
+                        time_import(workdir)  # create and migrate the database first
+                    samples.append(run(workdir))
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+            p50 = percentile(samples, 50) * 1000
+            print(f"  {label:<22}{state:>6}{p50:>10.1f}"
+                  f"{min(samples) * 1000:>10.1f}{max(samples) * 1000:>10.1f}")
+            if args.max_ms and p50 > args.max_ms:
+                slow.append(f"{label} ({state}) p50 {p50:.0f} ms")
+    if slow:
+        print(f"\nOver the {args.max_ms:.0f} ms budget: " + "; ".join(slow))
+        sys.exit(1)
+
+# ------------------ Fleet benchmark ------------------
+def parse_fleets(text):
+    """'10x1,100x4' -> [(10, 1), (100, 4)]: modules x cameras per run"""
+    fleets = []
+    for part in text.split(","):
+        modules, _, cameras = part.strip().partition("x")
+        fleets.append((int(modules), int(cameras or 1)))
+    return fleets
+
+def camera_frames(count):
+    """Distinct JPEG frames to upload; real ones with Pillow, JPEG-framed noise without"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return [b"\xff\xd8\xff\xe0" + os.urandom(16 * 1024) + b"\xff\xd9" for _ in range(count)]
+    frames = []
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.effect_noise((320, 240), 48).convert("RGB").save(buffer, "JPEG", quality=70)
+        frames.append(buffer.getvalue())
+    return frames
+
+class FleetClient:
+    """One keep-alive HTTP connection to the server, reopened after errors"""
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.connection = None
+
+    def request(self, method, path, body=None, content_type=None):
+        headers = {"Content-Type": content_type} if content_type else {}
+        for attempt in (1, 2):  # a kept-alive connection the server closed is retried once
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (OSError, http.client.HTTPException):
+                self.connection.close()
+                self.connection = None
+                if attempt == 2:
+                    raise
+
+    def form(self, path, fields):
+        return self.request("POST", path, urllib.parse.urlencode(fields),
+                            "application/x-www-form-urlencoded")
+
+    def json(self, method, path, data, content_type="application/json"):
+        body = data if isinstance(data, str) else json.dumps(data)
+        status, payload = self.request(method, path, body, content_type)
+        if status >= 400:
+            raise RuntimeError(f"{method} {path} failed: {status} {payload[:200]!r}")
+        return json.loads(payload or b"null")
+
+def seed_fleet(client, prefix, modules, cameras, feeds):
+    """Register the fleet over HTTP, with `feeds` schedules per module already due"""
+    camera_ids = [f"{prefix}-CAM{c:03d}" for c in range(cameras)]
+    module_ids = [f"{prefix}-M{m:05d}" for m in range(modules)]
+    for camera_id in camera_ids:
+        client.json("POST", "/cameras", {"cam_id": camera_id, "status": "active"})
+    for i, module_id in enumerate(module_ids):
+        client.json("POST", "/modules", {"module_id": module_id, "cam_id": camera_ids[i % cameras],
+                                         "status": "active", "weight": 500})
+    # The server decides on Manila time and may mark schedules missed once
+    # DISPATCH_GRACE_MINUTES pass, so these fell due in the last few minutes
+    now = datetime.now(timezone(timedelta(hours=8)))
+    due = [now - timedelta(minutes=f + 1) for f in range(feeds)]
+    rows = "\n".join(json.dumps({"op": "create", "module_id": module_id, "feed_date": d.strftime("%Y-%m-%d"),
+                                 "feed_time": d.strftime("%H:%M"), "amount": 25})
+                      for module_id in module_ids for d in due)
+    if rows:
+        client.json("POST", "/schedules/bulk", rows, "application/x-ndjson")
+    return module_ids, camera_ids
+
+def database_stats(client):
+    try:
+        return client.json("GET", "/stats", None).get("database") or {}
+    except (RuntimeError, ValueError):
+        return {}
+
+def run_fleet(url, module_ids, camera_ids, frames, args):
+    """Drive the device protocol for args.duration seconds from args.clients connections.
+
+    Every module polls /check_schedule every poll interval and reports its
+    weight every weight interval, completing any schedule a poll hands it;
+    every camera uploads a burst of frames every burst interval. Start times
+    are jittered so devices don't fire in lockstep. Requests are issued at
+    their planned times (open loop), so a server that falls behind shows up
+    as latency and as client lag rather than as a lower request rate.
+    """
+    start = time.monotonic()
+    end = start + args.duration
+    plan = []  # (due, seq, kind, device)
+    seq = 0
+    for module_id in module_ids:
+        plan.append((start + random.uniform(0, args.poll_interval), seq, "poll", module_id))
+        plan.append((start + random.uniform(0, args.weight_interval), seq + 1, "weight", module_id))
+        seq += 2
+    for camera_id in camera_ids:
+        plan.append((start + random.uniform(0, args.burst_interval), seq, "burst", camera_id))
+        seq += 1
+    heapq.heapify(plan)
+    lock = threading.Condition()
+    samples = {}
+    errors = {}
+    lag = []
+
+    def schedule(due, kind, device):
+        nonlocal seq
+        with lock:
+            seq += 1
+            heapq.heappush(plan, (due, seq, kind, device))
+            lock.notify()
+
+    def record(route, elapsed, status):
+        with lock:
+            samples.setdefault(route, []).append(elapsed)
+            if status >= 500:
+                errors[route] = errors.get(route, 0) + 1
+
+    def timed(client, route, call):
+        t0 = time.perf_counter()
+        try:
+            status, body = call()
+        except (OSError, http.client.HTTPException):
+            status, body = 599, b""
+        record(route, time.perf_counter() - t0, status)
+        return status, body
+
+    def worker():
+        client = FleetClient(url)
+        frame = random.randrange(len(frames))
+        while True:
+            with lock:
+                while True:
+                    now = time.monotonic()
+                    if now >= end:
+                        return
+                    if plan and plan[0][0] <= now:
+                        due, _, kind, device = heapq.heappop(plan)
+                        lag.append(now - due)
+                        break
+                    lock.wait(min(end, plan[0][0] if plan else end) - now)
+            if kind == "poll":
+                status, body = timed(client, "/check_schedule", lambda: client.form(
+                    "/check_schedule", {"module_id": device}))
+                decision = json.loads(body) if status == 200 else {}
+                if decision.get("dispense"):
+                    schedule(time.monotonic(), "complete", (device, decision["schedule_id"]))
+                schedule(due + args.poll_interval, "poll", device)
+            elif kind == "weight":
+                timed(client, "/weight_update", lambda: client.form(
+                    "/weight_update", {"module_id": device, "weight": f"{random.uniform(100, 900):.1f}"}))
+                schedule(due + args.weight_interval, "weight", device)
+            elif kind == "complete":
+                module_id, schedule_id = device
+                timed(client, "/complete_schedule", lambda: client.form(
+                    "/complete_schedule", {"module_id": module_id, "schedule_id": schedule_id}))
+            elif kind == "burst":
+                for _ in range(args.burst):
+                    frame = (frame + 1) % len(frames)
+                    timed(client, "/upload_image", lambda: client.request(
+                        "POST", f"/upload_image?camera_id={device}&category=during",
+                        frames[frame], "image/jpeg"))
+                schedule(due + args.burst_interval, "burst", device)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, errors, lag
+
+class LongPollHolders:
+    """Idle feeders: connections that each keep a /check_schedule long-poll open.
+
+    All of them run on one asyncio loop in a background thread, so thousands
+    cost the load generator almost nothing. Their modules have no schedules,
+    so every poll is held until its wait runs out and is then sent again. A
+    poll a threaded server didn't hold (past LONG_POLL_MAX_WAITERS) carries
+    Retry-After, and is sent again after that many seconds, as a device would.
+    """
+
+    def __init__(self, url, module_ids, wait):
+        parsed = urllib.parse.urlsplit(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.module_ids = module_ids
+        self.wait = wait
+        self.open = 0
+        self.answered = 0
+        self.refused = 0
+        self.failed = 0
+        self._thread = None
+        self._loop = None
+        self._stop = None
+
+    def start(self):
+        ready = threading.Event()
+
+        async def main():
+            self._loop = asyncio.get_running_loop()
+            self._stop = asyncio.Event()
+            tasks = [asyncio.create_task(self._hold(module_id)) for module_id in self.module_ids]
+            ready.set()
+            await self._stop.wait()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self._thread = threading.Thread(target=asyncio.run, args=(main(),), daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
+
+    async def _hold(self, module_id):
+        body = urllib.parse.urlencode({"module_id": module_id, "wait": self.wait}).encode()
+        request = (b"POST /check_schedule HTTP/1.1\r\nHost: feeder\r\n"
+                   b"Content-Type: application/x-www-form-urlencoded\r\n"
+                   b"Content-Length: %d\r\n\r\n" % len(body)) + body
+        await asyncio.sleep(random.uniform(0, 1))  # don't connect all at once
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                self.open += 1
+                try:
+                    while True:
+                        writer.write(request)
+                        await writer.drain()
+                        head = await reader.readuntil(b"\r\n\r\n")
+                        length = re.search(rb"content-length:\s*(\d+)", head, re.IGNORECASE)
+                        await reader.readexactly(int(length.group(1)) if length else 0)
+                        self.answered += 1
+                        retry_after = re.search(rb"retry-after:\s*(\d+)", head, re.IGNORECASE)
+                        if retry_after:  # not held: every long-poll slot was taken
+                            self.refused += 1
+                            await asyncio.sleep(int(retry_after.group(1)))
+                finally:
+                    self.open -= 1
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                self.failed += 1
+                await asyncio.sleep(0.5)
+            finally:
+                if writer is not None:
+                    writer.close()
+
+def print_fleet(title, samples, errors, lag, duration, before, after):
+    print(title)
+    print(f"  {'route':<20}{'requests':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for route in ("/check_schedule", "/weight_update", "/complete_schedule", "/upload_image"):
+        route_samples = samples.get(route)
+        if not route_samples:
+            continue
+        print(f"  {route:<20}{len(route_samples):>9}{len(route_samples) / duration:>9.0f}"
+              f"{percentile(route_samples, 50) * 1000:>9.2f}"
+              f"{percentile(route_samples, 95) * 1000:>9.2f}"
+              f"{percentile(route_samples, 99) * 1000:>9.2f}{errors.get(route, 0):>8}")
+    total = sum(len(route_samples) for route_samples in samples.values())
+    print(f"  {'total':<20}{total:>9}{total / duration:>9.0f}")
+    if "lock_waits" in after:
+        waits = after["lock_waits"] - before.get("lock_waits", 0)
+        waited = after["lock_wait_seconds"] - before.get("lock_wait_seconds", 0)
+        timeouts = after["lock_timeouts"] - before.get("lock_timeouts", 0)
+        print(f"  SQLite lock waits: {waits} ({waited * 1000:.0f} ms total), timeouts: {timeouts}")
+    else:
+        print("  SQLite lock waits: not reported by this server")
+    if lag:
+        # Time requests spent queued in the load generator; if this grows the
+        # clients, not the server, were the bottleneck
+        print(f"  client lag p95: {percentile(lag, 95) * 1000:.1f} ms")
+    print()
+
+def cmd_fleet(args):
+    workdir = None
+    server = gateway = app_module = None
+    url = args.url
+    device_url = args.device_url or url
+    if url is None:
+        workdir = tempfile.mkdtemp(prefix="smartfeeder-bench-")
+        app_module = load_app(workdir)
+        from smartfeeder_launcher import make_server
+        port = free_port()
+        server = make_server(app_module.app, "127.0.0.1", port, args.threads, 75)
+        threading.Thread(target=server.serve, name="server", daemon=True).start()
+        url = device_url = f"http://127.0.0.1:{port}"
+        if args.gateway:
+            from device_gateway import DeviceGateway
+            gateway = DeviceGateway(app_module, "127.0.0.1", 0, args.threads)
+            threading.Thread(target=gateway.serve, name="gateway", daemon=True).start()
+            device_url = f"http://127.0.0.1:{gateway.port}"
+    try:
+        client = FleetClient(url)
+        frames = camera_frames(64)
+        prefix = f"FLEET{int(time.time()) % 100000}"
+        holders = None
+        if args.long_polls:
+            held_ids, _ = seed_fleet(client, f"{prefix}-HOLD", args.long_polls, 1, 0)
+            holders = LongPollHolders(device_url, held_ids, args.long_poll_wait)
+            holders.start()
+        for n, (modules, cameras) in enumerate(parse_fleets(args.fleets)):
+            module_ids, camera_ids = seed_fleet(client, f"{prefix}-{n}", modules, cameras, args.feeds)
+            before = database_stats(client)
+            samples, errors, lag = run_fleet(device_url, module_ids, camera_ids, frames, args)
+            print_fleet(f"{modules} modules x {cameras} cameras, {args.duration:.0f}s, "
+                        f"{args.clients} client connections"
+                        + (" via the device gateway" if gateway or args.device_url else ""),
+                        samples, errors, lag, args.duration, before, database_stats(client))
+            if holders is not None:
+                print(f"  held long-polls: {holders.open} open of {args.long_polls}, "
+                      f"{holders.answered} answered ({holders.refused} without being held), "
+                      f"{holders.failed} failed connections\n")
+        if holders is not None:
+            holders.stop()
+    finally:
+        if gateway is not None:
+            gateway.shutdown(5)
+        if server is not None:
+            server.shutdown(5)
+            close_app(app_module)
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+# ------------------ Completion stress test ------------------
+def cmd_stress(args):
+    """Complete every schedule from several threads at once and check exactly-once history.
+
+    Each schedule gets args.attempts concurrent /complete_schedule calls,
+    as from a device retrying over a flaky link; for half of the schedules
+    the retries share an Idempotency-Key, for the rest they carry none.
+    Afterwards every schedule must be done with exactly one history row,
+    exactly one call per schedule must have done the work, every keyed
+    retry must have been answered with success, and the rollups must agree
+    with history. Exits non-zero otherwise.
+    """
+    workdir = tempfile.mkdtemp(prefix="smartfeeder-bench-")
+    try:
+        app_module = load_app(workdir)
+        modules = max(1, args.schedules // 50)
+        seed(app_module, modules, 0)
+        today = app_module.ph_now().strftime("%Y-%m-%d")
+        with app_module.transaction() as con:
+            con.executemany("""
+                INSERT INTO schedules (module_id, feed_date, feed_time, amount, status)
+                VALUES (?, ?, ?, 25, 'pending')
+            """, [(f"BENCH{i % modules:04d}", today, f"{i // modules // 60 % 24:02d}:{i // modules % 60:02d}")
+                  for i in range(args.schedules)])
+        targets = pending_schedule_ids(app_module)
+
+        # A schedule's attempts sit next to each other in the queue, so the
+        # threads pick them up at the same moment and race each other
+        jobs = [(schedule_id, module_id, f"key-{schedule_id}" if n % 2 == 0 else None)
+                for n, (schedule_id, module_id) in enumerate(targets) for _ in range(args.attempts)]
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            client = app_module.app.test_client()
+            while True:
+                with lock:
+                    if not jobs:
+                        return
+                    schedule_id, module_id, key = jobs.pop()
+                response = client.post("/complete_schedule",
+                                       data={"schedule_id": str(schedule_id), "module_id": module_id},
+                                       headers={"Idempotency-Key": key} if key else {})
+                replayed = response.headers.get("Idempotent-Replayed") == "true"
+                with lock:
+                    results.append((schedule_id, key, response.status_code, replayed))
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        failures = []
+        wrote = {}
+        for schedule_id, key, status, replayed in results:
+            if status == 200 and not replayed:
+                wrote[schedule_id] = wrote.get(schedule_id, 0) + 1
+            if key and status != 200:
+                failures.append(f"schedule {schedule_id}: keyed retry got {status}")
+            if status >= 500:
+                failures.append(f"schedule {schedule_id}: {status}")
+        failures += [f"schedule {schedule_id}: completed {count} times"
+                     for schedule_id, count in wrote.items() if count != 1]
+        failures += [f"schedule {schedule_id}: never completed"
+                     for schedule_id, _ in targets if schedule_id not in wrote]
+        for row in app_module.query_db("""
+            SELECT s.schedule_id, s.status, COUNT(h.history_id) AS rows
+            FROM schedules s LEFT JOIN history h ON h.schedule_id = s.schedule_id
+            GROUP BY s.schedule_id HAVING rows != 1 OR s.status != 'done'
+        """):
+            failures.append(f"schedule {row['schedule_id']}: status {row['status']}, {row['rows']} history rows")
+        history = app_module.query_db("SELECT COUNT(*) FROM history", one=True)[0]
+        for table in app_module.ROLLUP_TABLES:
+            feeds = app_module.query_db(f"SELECT COALESCE(SUM(feeds), 0) FROM {table}", one=True)[0]
+            if feeds != history:
+                failures.append(f"{table}: {feeds} feeds for {history} history rows")
+
+        print(f"{len(results)} completion calls for {len(targets)} schedules from "
+              f"{args.threads} threads in {elapsed:.2f}s ({len(results) / elapsed:.0f} calls/s)")
+        print(f"  history rows: {history}, replayed keyed retries: "
+              f"{sum(1 for result in results if result[3])}")
+        close_app(app_module)
+        if failures:
+            print("FAILED exactly-once:")
+            for failure in failures[:20]:
+                print(f"  {failure}")
+            sys.exit(1)
+        print("exactly-once: OK")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# ------------------ Weight series benchmark ------------------
+SERIES_WINDOWS = (("1 hour", 3600), ("1 day", 86400), ("7 days", 7 * 86400),
+                  ("30 days", 30 * 86400), ("90 days", 90 * 86400))
+
+def cmd_series(args):
+    """Seed days of weight readings, then time chart queries over growing windows"""
+    workdir = tempfile.mkdtemp(prefix="smartfeeder-bench-")
+    try:
+        app_module = load_app(workdir)
+        now = int(time.time())
+        start = time.perf_counter()
+        # Hoppers that empty over ten hours, then are refilled
+        samples = [(f"M{m:05d}", t, 1000 - (t // args.interval) % (36000 // args.interval))
+                   for m in range(args.modules)
+                   for t in range(now - args.days * 86400, now, args.interval)]
+        with app_module.transaction() as con:
+            app_module.weight_series.record(con, samples)  # also prunes past retention
+        print(f"Seeded {len(samples)} readings for {args.modules} modules over {args.days} days "
+              f"in {time.perf_counter() - start:.1f}s")
+        for tier, table, _ in app_module.weight_series.TIERS:
+            rows = app_module.query_db(f"SELECT COUNT(*) FROM {table}", one=True)[0]
+            print(f"  {tier:<8}{rows:>10} rows")
+        print()
+
+        print(f"  {'window':<10}{'resolution':>12}{'step s':>8}{'points':>8}{'readings':>10}{'p50 ms':>9}")
+        for label, span in SERIES_WINDOWS:
+            if span > args.days * 86400:
+                break
+            samples = []
+            for i in range(args.queries):
+                t0 = time.perf_counter()
+                tier, step, rows = app_module.weight_series.query(
+                    f"M{i % args.modules:05d}", now - span, now, args.points)
+                samples.append(time.perf_counter() - t0)
+            print(f"  {label:<10}{tier:>12}{step:>8}{len(rows):>8}{sum(row[4] for row in rows):>10}"
+                  f"{percentile(samples, 50) * 1000:>9.2f}")
+        close_app(app_module)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    routes = sub.add_parser("routes", help="device route latency, pooled vs unpooled")
+    routes.add_argument("--requests", type=int, default=500)
+    routes.add_argument("--modules", type=int, default=50)
+    routes.set_defaults(func=cmd_routes)
+
+    index = sub.add_parser("index", help="device poll query on a large schedules table")
+    index.add_argument("--rows", type=int, default=1000000)
+    index.add_argument("--modules", type=int, default=1000)
+    index.add_argument("--polls", type=int, default=2000)
+    index.set_defaults(func=cmd_index)
+
+    startup = sub.add_parser("startup", help="cold and warm start of app.py and the launchers")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--exe", help="packaged launcher (default: dist/SmartFeeder/SmartFeeder[.exe])")
+    startup.add_argument("--max-ms", type=float,
+                         help="exit non-zero when any median start time exceeds this")
+    startup.set_defaults(func=cmd_startup)
+
+    fleet = sub.add_parser("fleet", help="simulated feeders and cameras over HTTP at several fleet sizes")
+    fleet.add_argument("--fleets", default="10x1,100x4,500x16",
+                       help="comma-separated MODULESxCAMERAS runs")
+    fleet.add_argument("--duration", type=float, default=10, help="seconds per fleet size")
+    fleet.add_argument("--poll-interval", type=float, default=1.0, help="seconds between module polls")
+    fleet.add_argument("--weight-interval", type=float, default=5.0)
+    fleet.add_argument("--burst", type=int, default=3, help="frames per camera burst")
+    fleet.add_argument("--burst-interval", type=float, default=5.0)
+    fleet.add_argument("--feeds", type=int, default=3, help="due schedules seeded per module")
+    fleet.add_argument("--clients", type=int, default=32, help="concurrent client connections")
+    fleet.add_argument("--threads", type=int, default=16, help="server threads (in-process server)")
+    fleet.add_argument("--url", help="benchmark a running server instead of an in-process one")
+    fleet.add_argument("--gateway", action="store_true",
+                       help="send device traffic to an in-process device_gateway.py")
+    fleet.add_argument("--device-url", help="device gateway of the running server given by --url")
+    fleet.add_argument("--long-polls", type=int, default=0,
+                       help="extra idle feeders holding long-polls open; a threaded server holds at most"
+                            " LONG_POLL_MAX_WAITERS and answers the rest at once (many need a high ulimit -n)")
+    fleet.add_argument("--long-poll-wait", type=float, default=30)
+    fleet.set_defaults(func=cmd_fleet)
+
+    stress = sub.add_parser("stress", help="concurrent /complete_schedule retries; checks exactly-once history")
+    stress.add_argument("--schedules", type=int, default=500)
+    stress.add_argument("--threads", type=int, default=16)
+    stress.add_argument("--attempts", type=int, default=4, help="concurrent calls per schedule")
+    stress.set_defaults(func=cmd_stress)
+
+    series = sub.add_parser("series", help="weight chart queries over the multi-resolution time series")
+    series.add_argument("--modules", type=int, default=5)
+    series.add_argument("--days", type=int, default=90)
+    series.add_argument("--interval", type=int, default=60, help="seconds between seeded readings")
+    series.add_argument("--points", type=int, default=500, help="most points per chart")
+    series.add_argument("--queries", type=int, default=50, help="queries timed per window")
+    series.set_defaults(func=cmd_series)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
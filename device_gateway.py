@@ -0,0 +1,421 @@
+"""
+SmartFeeder device gateway
+
+An asyncio HTTP server for the routes the ESP32 feeders and cameras call,
+so a slow Wi-Fi connection costs a coroutine instead of a server thread:
+
+    /health  /check_schedule  /complete_schedule  /weight_update  /upload_image
+
+Requests and responses are exactly those of app.py. Each request is read and
+its body spooled (memory, then a temp file) on the event loop; only then is
+it handed to the Flask app on a small, bounded thread pool for the SQLite
+work. /check_schedule long-polls (wait=) are held on the event loop, not in
+a thread. Uploads may use at most half of the threads, so a burst of
+cameras can't starve schedule polls. Dashboard routes are not served here.
+
+Run it next to the dashboard, in the same process, with the launcher:
+
+    python smartfeeder_launcher.py --production --gateway-port 8081
+
+or on its own while another process serves the dashboard:
+
+    python device_gateway.py [--port 8081] [--workers 8]
+
+Holding many connections needs a high open-file limit (ulimit -n) on Linux.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import unquote
+
+DEVICE_ROUTES = {
+    "/health": ("GET", "HEAD"),
+    "/check_schedule": ("POST",),
+    "/complete_schedule": ("POST",),
+    "/weight_update": ("POST",),
+    "/upload_image": ("POST",),
+}
+MAX_HEADER_BYTES = 16 * 1024
+FORM_MAX_BYTES = 64 * 1024         # bodies of every device route but /upload_image
+MULTIPART_OVERHEAD = 64 * 1024     # form fields and boundaries around an uploaded image
+SPOOL_MEMORY = 256 * 1024          # body bytes kept in memory before spilling to a temp file
+
+class BadRequest(Exception):
+    """A request the gateway answers itself, then closes the connection"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def parse_head(head):
+    """(method, target, version, headers) from the request line and header block"""
+    try:
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, version = lines[0].split(" ")
+    except (UnicodeDecodeError, ValueError):
+        raise BadRequest(400, "Malformed request line")
+    if version not in ("HTTP/1.0", "HTTP/1.1"):
+        raise BadRequest(505, "HTTP version not supported")
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise BadRequest(400, "Malformed header")
+        name, value = name.strip().lower(), value.strip()
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    return method, target, version, headers
+
+# ------------------ Gateway ------------------
+class DeviceGateway:
+    """Serves the device routes of app.py on an asyncio event loop.
+
+    Same interface as the launcher's servers: the socket is bound when the
+    gateway is created, serve() blocks in its thread, shutdown() stops it.
+    """
+
+    def __init__(self, app_module, host, port, workers=8, keepalive=75, header_timeout=30):
+        self.app_module = app_module
+        self.app = app_module.app
+        self.workers = workers
+        self.keepalive = keepalive
+        self.header_timeout = header_timeout
+        self.upload_limit = self.app.config['UPLOAD_MAX_BYTES'] + MULTIPART_OVERHEAD
+        self.chunk_size = self.app.config['UPLOAD_CHUNK_SIZE']
+        self.sock = socket.create_server((host, port), backlog=1024)
+        self.host, self.port = host, self.sock.getsockname()[1]
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gateway")
+        self._loop = None
+        self._stop = None
+        self._grace = 30
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+        self._handlers = set()
+        self._idle = set()       # writers of connections waiting for their next request
+        self._held = set()       # events of held long-polls
+        self.connections = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.long_polls = 0
+
+    def serve(self):
+        try:
+            asyncio.run(self._main())
+        finally:
+            self._stopped.set()
+
+    def shutdown(self, timeout):
+        """Stop accepting, let requests in flight finish for up to timeout, then close"""
+        self._grace = timeout
+        if self._started.wait(5):
+            self._loop.call_soon_threadsafe(self._stop.set)
+            self._stopped.wait(timeout + 5)
+
+    def stats(self):
+        return {"connections": self.connections, "requests": self.requests,
+                "in_flight": self.in_flight, "long_polls": self.long_polls}
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._upload_slots = asyncio.Semaphore(max(1, self.workers // 2))
+        server = await asyncio.start_server(self._connection, sock=self.sock, limit=MAX_HEADER_BYTES)
+        self._started.set()
+        async with server:
+            await self._stop.wait()
+            server.close()
+            # Idle keep-alive connections are closed and held long-polls
+            # answered now; requests being handled get the grace period.
+            for writer in list(self._idle):
+                writer.close()
+            for changed in list(self._held):
+                changed.set()
+            if self._handlers:
+                _, pending = await asyncio.wait(list(self._handlers), timeout=self._grace)
+                for task in pending:
+                    task.cancel()
+        self.executor.shutdown(wait=True)
+
+    async def _run(self, func, *args, upload=False):
+        """Run blocking (SQLite) work on the thread pool, never more than it has threads"""
+        if upload:
+            async with self._upload_slots, self._slots:
+                return await self._loop.run_in_executor(self.executor, func, *args)
+        async with self._slots:
+            return await self._loop.run_in_executor(self.executor, func, *args)
+
+    # ------------------ Connections ------------------
+    async def _connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        self.connections += 1
+        timeout = self.header_timeout
+        try:
+            while not self._stop.is_set():
+                self._idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                except asyncio.LimitOverrunError:
+                    await self._error(writer, 431, "Request headers too large", keep_alive=False)
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                finally:
+                    self._idle.discard(writer)
+                self.in_flight += 1
+                try:
+                    keep_alive = await self._request(head, reader, writer)
+                finally:
+                    self.in_flight -= 1
+                if not keep_alive:
+                    break
+                timeout = self.keepalive
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.connections -= 1
+            self._handlers.discard(task)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _request(self, head, reader, writer):
+        """Handle one request; returns whether the connection stays open"""
+        self.requests += 1
+        try:
+            method, target, version, headers = parse_head(head)
+            path, _, query = target.partition("?")
+            methods = DEVICE_ROUTES.get(path)
+            if methods is None:
+                raise BadRequest(404, "Not found")
+            if method not in methods:
+                raise BadRequest(405, "Method not allowed")
+            limit = self.upload_limit if path == "/upload_image" else FORM_MAX_BYTES
+            body, length = await self._read_body(reader, writer, headers, limit)
+        except BadRequest as e:
+            await self._error(writer, e.status, str(e), keep_alive=False)
+            return False
+
+        connection = headers.get("connection", "").lower()
+        keep_alive = (connection != "close") if version == "HTTP/1.1" else (connection == "keep-alive")
+        environ = self._environ(method, path, query, version, headers, body, length, writer)
+        try:
+            if path == "/check_schedule":
+                status, response_headers, payload = await self._check_schedule(environ)
+            else:
+                status, response_headers, payload = await self._run(
+                    self._call_app, environ, upload=path == "/upload_image")
+        finally:
+            body.close()
+        await self._write(writer, status, response_headers,
+                          b"" if method == "HEAD" else payload, keep_alive)
+        return keep_alive
+
+    async def _read_body(self, reader, writer, headers, limit):
+        """Spool the request body, chunk by chunk; returns (file, length)"""
+        chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        try:
+            length = 0 if chunked else int(headers.get("content-length") or 0)
+        except ValueError:
+            raise BadRequest(400, "Invalid Content-Length")
+        if length > limit:
+            raise BadRequest(413, f"Body larger than {limit} bytes")
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+        try:
+            if chunked:
+                while True:
+                    size_line = await asyncio.wait_for(reader.readline(), self.header_timeout)
+                    try:
+                        size = int(size_line.split(b";")[0], 16)
+                    except ValueError:
+                        raise BadRequest(400, "Malformed chunk")
+                    if size == 0:
+                        while (await asyncio.wait_for(reader.readline(), self.header_timeout)).strip():
+                            pass  # trailers
+                        break
+                    length += size
+                    if length > limit:
+                        raise BadRequest(413, f"Body larger than {limit} bytes")
+                    chunk = await asyncio.wait_for(reader.readexactly(size + 2), self.header_timeout)
+                    body.write(chunk[:-2])
+            else:
+                remaining = length
+                while remaining:
+                    chunk = await asyncio.wait_for(reader.read(min(self.chunk_size, remaining)),
+                                                   self.header_timeout)
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b"", remaining)
+                    body.write(chunk)
+                    remaining -= len(chunk)
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return body, length
+
+    def _environ(self, method, path, query, version, headers, body, length, writer):
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, "latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0],
+            "REMOTE_PORT": str(peer[1]),
+            "CONTENT_LENGTH": str(length),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+            elif name not in ("content-length", "transfer-encoding"):  # the body is already de-chunked
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        return environ
+
+    def _call_app(self, environ):
+        """Run one request through the Flask app (in a pool thread)"""
+        captured = {}
+
+        def start_response(status, headers, exc_info=None):
+            captured["status"], captured["headers"] = status, headers
+
+        result = self.app(environ, start_response)
+        try:
+            payload = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return captured["status"], captured["headers"], payload
+
+    async def _write(self, writer, status, headers, payload, keep_alive):
+        lines = [f"HTTP/1.1 {status}"]
+        lines += [f"{name}: {value}" for name, value in headers
+                  if name.lower() not in ("content-length", "connection")]
+        lines.append(f"Content-Length: {len(payload)}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+
+    async def _error(self, writer, status, message, keep_alive):
+        status = HTTPStatus(status)
+        await self._write(writer, f"{status.value} {status.phrase}", [("Content-Type", "application/json")],
+                          json.dumps({"error": message}, separators=(",", ":")).encode() + b"\n", keep_alive)
+
+    # ------------------ Long-polls ------------------
+    def _poll_request(self, environ):
+        """(module_id, wait) for a /check_schedule long-poll, else the app's own response"""
+        from werkzeug.wrappers import Request
+
+        form = Request(environ).form
+        module_id = form.get("module_id")
+        wait = self.app_module.parse_wait(form.get("wait"))
+        if module_id and wait:
+            self.app_module.rule_materializer.ensure()
+            return (module_id, wait), None
+        environ["wsgi.input"].seek(0)
+        return None, self._call_app(environ)
+
+    async def _check_schedule(self, environ):
+        """Like app.check_schedule, but a held long-poll waits on the event loop"""
+        started = time.perf_counter()
+        long_poll, response = await self._run(self._poll_request, environ)
+        if response is not None:
+            return response
+
+        app_module = self.app_module
+        module_id, wait = long_poll
+        changed = asyncio.Event()
+
+        def wake():
+            try:
+                self._loop.call_soon_threadsafe(changed.set)
+            except RuntimeError:  # the loop has closed
+                pass
+
+        # Registered before the first check so no change can slip in between
+        app_module.due_index.add_listener(module_id, wake)
+        self._held.add(changed)
+        self.long_polls += 1
+        try:
+            deadline = self._loop.time() + wait
+            while True:
+                changed.clear()
+                body, code, until_due = await self._run(app_module.poll_module, module_id)
+                remaining = deadline - self._loop.time()
+                if code != 200 or body["dispense"] or remaining <= 0 or self._stop.is_set():
+                    break
+                try:
+                    await asyncio.wait_for(changed.wait(), app_module.long_poll_wake(remaining, until_due))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.long_polls -= 1
+            self._held.discard(changed)
+            app_module.due_index.remove_listener(module_id, wake)
+
+        response = self.app.json.response(body)
+        response.status_code = code
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        app_module.metrics.observe_request("/check_schedule", "POST", code, time.perf_counter() - started)
+        return response.status, list(response.headers.items()), response.get_data()
+
+# ------------------ Standalone ------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SmartFeeder asyncio device gateway")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--workers", type=int, default=8, help="threads for SQLite work")
+    parser.add_argument("--keepalive", type=int, default=75,
+                        help="seconds an idle keep-alive connection stays open")
+    parser.add_argument("--grace", type=int, default=30,
+                        help="seconds in-flight requests get to finish on shutdown")
+    args = parser.parse_args(argv)
+
+    # The dashboard runs in another process, so skip caches it can't invalidate
+    os.environ["SMARTFEEDER_SHARED_PROCESSES"] = "true"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+
+    gateway = DeviceGateway(app_module, args.host, args.port, args.workers, args.keepalive)
+    threading.Thread(target=gateway.serve, name="gateway", daemon=True).start()
+    print(f"Device gateway listening on {args.host}:{gateway.port} ({args.workers} worker threads)")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    while not stop.wait(1):
+        pass
+
+    print("Shutting down...")
+    gateway.shutdown(args.grace)
+    app_module.weight_buffer.flush()
+    app_module.previews.shutdown()
+    app_module.db_pool.close_all()
+
+if __name__ == "__main__":
+    main()
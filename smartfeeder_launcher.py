@@ -1,65 +1,148 @@
 """
 SmartFeeder Launcher - All-in-One
-Starts Flask server and opens browser automatically
+Starts the SmartFeeder server and opens browser automatically
+
+    python smartfeeder_launcher.py                     # desktop: local server + browser
+    python smartfeeder_launcher.py --production        # serve devices on 0.0.0.0:8080
+    python smartfeeder_launcher.py --production --threads 32 --keepalive 75
+    python smartfeeder_launcher.py --production --workers 4   # processes (gunicorn, Linux/macOS)
+    python smartfeeder_launcher.py --production --gateway-port 8081   # + asyncio device gateway
+
+Threads are served by waitress when it is installed (pip install waitress),
+otherwise by Werkzeug's threaded server. --workers > 1 needs gunicorn; each
+worker process then reads SQLite directly instead of keeping in-process
+caches, so workers never serve each other's stale data. --gateway-port also
+serves the device routes from an asyncio gateway in the same process (see
+device_gateway.py), for fleets with many slow or long-polling connections:
+the threaded servers only hold a quarter of --threads long-polls at once and
+answer the rest straight away with "held": false and a Retry-After header.
 """
+import argparse
 import webbrowser
 import time
 import sys
 import os
-from threading import Thread
+import signal
+import urllib.request
+import urllib.error
+from threading import Event, Thread
 import subprocess
 
-def start_flask_inline():
-    """Start Flask app directly in this process"""
-    try:
-        # Import Flask app
-        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-        
-        # Import the Flask app from app.py
-        from app import app
-        
-        # Run Flask in a separate thread
-        def run_flask():
-            app.run(host='127.0.0.1', port=8080, debug=False, use_reloader=False)
-        
-        flask_thread = Thread(target=run_flask, daemon=True)
-        flask_thread.start()
-        
-        return True
-    except Exception as e:
-        print(f"ERROR starting Flask: {e}")
-        return False
+def load_app(threads=None):
+    """Import the Flask app from app.py, sized for `threads` request threads"""
+    if threads:
+        # Held long-polls each park a request thread; leave most for everything else
+        os.environ.setdefault("SMARTFEEDER_LONG_POLL_MAX_WAITERS", str(max(1, threads // 4)))
+        # ...and so do open /events streams
+        os.environ.setdefault("SMARTFEEDER_CHANGE_FEED_MAX_STREAMS", str(max(1, threads // 4)))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+    return app_module
+
+# ------------------ Servers ------------------
+class WaitressServer:
+    """waitress: a production WSGI server with a fixed pool of request threads"""
+
+    def __init__(self, app, host, port, threads, keepalive):
+        from waitress.server import create_server
+        self.server = create_server(app, host=host, port=port, threads=threads,
+                                    channel_timeout=keepalive, ident="SmartFeeder")
+
+    def serve(self):
+        self.server.run()
+
+    def shutdown(self, timeout):
+        # Let requests already queued finish while the server can still send
+        # their responses (a held long-poll writes through the server's
+        # trigger, which close() shuts), then close it
+        self.server.task_dispatcher.shutdown(cancel_pending=False, timeout=timeout)
+        self.server.close()
+
+class WerkzeugServer:
+    """Fallback when waitress is not installed: Werkzeug's threaded server"""
+
+    def __init__(self, app, host, port, threads, keepalive):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"  # keep-alive
+        self.server = make_server(host, port, app, threaded=True)
+        self.server.timeout = keepalive
 
-def wait_for_server(url="http://127.0.0.1:8080", timeout=30):
-    """Wait for Flask server to become available"""
+    def serve(self):
+        self.server.serve_forever()
+
+    def shutdown(self, timeout):
+        self.server.shutdown()
+        self.server.server_close()
+
+def make_server(app, host, port, threads, keepalive):
     try:
-        import requests
+        return WaitressServer(app, host, port, threads, keepalive)
     except ImportError:
-        print("Installing requests library...")
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "requests"])
-        import requests
-    
+        print("waitress is not installed; using Werkzeug's threaded server")
+        return WerkzeugServer(app, host, port, threads, keepalive)
+
+def run_gunicorn(args):
+    """Serve with gunicorn worker processes; blocks until gunicorn exits"""
+    from gunicorn.app.base import BaseApplication
+
+    # Read by app.py in every worker: skip caches another process can't invalidate
+    os.environ["SMARTFEEDER_SHARED_PROCESSES"] = "true"
+
+    class SmartFeederApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("keepalive", args.keepalive)
+            self.cfg.set("graceful_timeout", args.grace)
+            self.cfg.set("timeout", 120)  # long-polls hold requests for up to a minute
+
+        def load(self):
+            return load_app(args.threads).app
+
+    SmartFeederApplication().run()
+
+def shutdown_app(app_module):
+    """Write buffered weights and close database connections"""
+    app_module.weight_buffer.flush()
+    app_module.previews.shutdown()
+    app_module.db_pool.close_all()
+
+def start_server(args):
+    """Start the server in a background thread; returns (server, app module) or (None, None)"""
+    try:
+        app_module = load_app(args.threads)
+        server = make_server(app_module.app, args.host, args.port, args.threads, args.keepalive)
+    except Exception as e:
+        print(f"ERROR starting server: {e}")
+        return None, None
+    Thread(target=server.serve, name="server", daemon=True).start()
+    return server, app_module
+
+def wait_for_server(url="http://127.0.0.1:8080/health", timeout=30):
+    """Wait until /health answers 200 (the app is up and its database opens)"""
     print("Waiting for server to start...")
-    for i in range(timeout * 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
         try:
-            response = requests.get(url, timeout=0.5)
-            if response.status_code == 200:
-                return True
-        except requests.exceptions.RequestException:
-            time.sleep(0.1)
+            with urllib.request.urlopen(url, timeout=0.5) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.1)
     return False
 
-def open_browser():
+def open_browser(url="http://127.0.0.1:8080"):
     """Open application in browser or Chrome app mode"""
-    url = "http://127.0.0.1:8080"
-    
     # Try Chrome app mode first
     chrome_paths = [
         r"C:\Program Files\Google\Chrome\Application\chrome.exe",
         r"C:\Program Files (x86)\Google\Chrome\Application\chrome.exe",
         os.path.expanduser(r"~\AppData\Local\Google\Chrome\Application\chrome.exe")
     ]
-    
+
     for chrome_path in chrome_paths:
         if os.path.exists(chrome_path):
             try:
@@ -71,52 +154,114 @@ def open_browser():
                 return True
             except:
                 pass
-    
+
     # Fallback to default browser
     webbrowser.open(url)
     return True
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SmartFeeder server launcher")
+    parser.add_argument("--production", action="store_true",
+                        help="listen on all interfaces for devices and don't open a browser")
+    parser.add_argument("--host", help="address to bind (default 127.0.0.1, or 0.0.0.0 with --production)")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--threads", type=int, default=16, help="request threads (per worker)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes (gunicorn)")
+    parser.add_argument("--keepalive", type=int, default=75,
+                        help="seconds an idle keep-alive connection stays open")
+    parser.add_argument("--grace", type=int, default=30,
+                        help="seconds in-flight requests get to finish on shutdown")
+    parser.add_argument("--gateway-port", type=int,
+                        help="also serve the device routes from the asyncio gateway on this port")
+    parser.add_argument("--gateway-workers", type=int, default=8,
+                        help="gateway threads for SQLite work")
+    parser.add_argument("--no-browser", action="store_true")
+    args = parser.parse_args(argv)
+    if args.host is None:
+        args.host = "0.0.0.0" if args.production else "127.0.0.1"
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    local_url = f"http://127.0.0.1:{args.port}"
+
     print("=" * 60)
     print("    SMART FEEDER SYSTEM")
     print("=" * 60)
     print()
-    
-    print("Starting Flask server...")
-    if not start_flask_inline():
-        print("\nERROR: Failed to start Flask server")
-        input("\nPress Enter to exit...")
+
+    if args.workers > 1:
+        if sys.platform == "win32":
+            print("ERROR: --workers needs gunicorn, which does not run on Windows; use --threads")
+            sys.exit(1)
+        if args.gateway_port:
+            print("ERROR: --gateway-port runs in-process; with --workers start device_gateway.py on its own")
+            sys.exit(1)
+        print(f"Starting {args.workers} worker processes on {args.host}:{args.port}...")
+        run_gunicorn(args)
+        return
+
+    print("Starting server...")
+    server, app_module = start_server(args)
+    if server is None:
+        print("\nERROR: Failed to start server")
+        if not args.production:
+            input("\nPress Enter to exit...")
         sys.exit(1)
-    
+
     # Wait for server to be ready
-    if not wait_for_server():
-        print("\nERROR: Flask server did not respond in time")
-        input("\nPress Enter to exit...")
+    if not wait_for_server(f"{local_url}/health"):
+        print("\nERROR: Server did not become ready in time")
+        if not args.production:
+            input("\nPress Enter to exit...")
         sys.exit(1)
-    
+
     print("✓ Server started successfully!")
-    print("✓ Opening application...")
-    
-    # Open browser
-    open_browser()
-    
+
+    gateway = None
+    if args.gateway_port:
+        try:
+            from device_gateway import DeviceGateway
+            gateway = DeviceGateway(app_module, args.host, args.gateway_port,
+                                    args.gateway_workers, args.keepalive)
+        except OSError as e:
+            print(f"\nERROR starting device gateway: {e}")
+            server.shutdown(args.grace)
+            shutdown_app(app_module)
+            sys.exit(1)
+        Thread(target=gateway.serve, name="gateway", daemon=True).start()
+        print(f"✓ Device gateway on port {args.gateway_port}")
+
+    if not (args.production or args.no_browser):
+        print("✓ Opening application...")
+        open_browser(local_url)
+
     print()
     print("=" * 60)
     print("  ✓ SMART FEEDER IS NOW RUNNING!")
-    print("  ✓ Access at: http://127.0.0.1:8080")
+    print(f"  ✓ Access at: http://{args.host}:{args.port}")
     print("=" * 60)
     print()
     print("Press Ctrl+C to stop the application")
     print("Or close this window to exit")
     print()
-    
-    # Keep running
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        print("\n\nShutting down...")
-        sys.exit(0)
+
+    # Keep running until Ctrl+C or SIGTERM, then shut down gracefully
+    stop = Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    while not stop.wait(1):
+        pass
+
+    print("\n\nShutting down...")
+    # /events streams otherwise run for minutes: end them now rather than
+    # waiting out --grace for them
+    app_module.change_feed.close()
+    if gateway is not None:
+        gateway.shutdown(args.grace)
+    server.shutdown(args.grace)
+    shutdown_app(app_module)
+    sys.exit(0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
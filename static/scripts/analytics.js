@@ -166,8 +166,33 @@ function printAnalyticsPDF() {
         .save();
 }
 
-// Load analytics on page load
-loadAnalytics();
+// Re-run the analytics queries only when something they depend on changes,
+// batching bursts of changes into a single refresh
+let analyticsRefreshTimer = null;
 
-// Refresh analytics every 10 seconds
-setInterval(loadAnalytics, 10000);
\ No newline at end of file
+function scheduleAnalyticsRefresh() {
+    if (analyticsRefreshTimer) {
+        return;
+    }
+    analyticsRefreshTimer = setTimeout(() => {
+        analyticsRefreshTimer = null;
+        loadAnalytics();
+    }, 1000);
+}
+
+ChangeFeed.onResync(loadAnalytics);
+ChangeFeed.on('history', scheduleAnalyticsRefresh);
+ChangeFeed.on('schedules', change => {
+    if (change.op !== 'insert') {
+        scheduleAnalyticsRefresh();
+    }
+});
+ChangeFeed.on('modules', change => {
+    // Weight readings do not affect any chart
+    if (change.op !== 'update' || 'status' in change.row) {
+        scheduleAnalyticsRefresh();
+    }
+});
+
+// "Total fed today" rolls over at midnight without any change event
+setInterval(loadAnalytics, 5 * 60 * 1000);
\ No newline at end of file
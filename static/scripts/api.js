@@ -0,0 +1,26 @@
+// fetch() for the JSON list endpoints that sends the last ETag back as
+// If-None-Match. On 304 the previous response is reused, so an idle page
+// costs the server almost nothing.
+const jsonValidators = new Map();
+
+function fetchJSON(url) {
+    const cached = jsonValidators.get(url);
+    const headers = cached ? { 'If-None-Match': cached.etag } : {};
+
+    // The browser's own HTTP cache is bypassed so a 304 always reaches us
+    return fetch(url, { headers, cache: 'no-store' }).then(response => {
+        if (response.status === 304 && cached) {
+            return cached.data;
+        }
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const etag = response.headers.get('ETag');
+        return response.json().then(data => {
+            if (etag) {
+                jsonValidators.set(url, { etag, data });
+            }
+            return data;
+        });
+    });
+}
@@ -1,7 +1,34 @@
-// Load snapshots when page loads
-document.addEventListener('DOMContentLoaded', function() {
-    loadSnapshots();
-});
+// Load snapshots once the change feed is connected, then apply uploads and
+// deletes as they happen
+ChangeFeed.onResync(loadSnapshots);
+ChangeFeed.on('snapshots', applySnapshotChange);
+
+function galleryFor(category) {
+    return document.getElementById(category === 'during' ? 'duringFeedingGallery' : 'afterFeedingGallery');
+}
+
+function removeGalleryItem(filename) {
+    document.querySelectorAll('.gallery-item').forEach(item => {
+        if (item.dataset.filename === filename) {
+            const gallery = item.parentElement;
+            item.remove();
+            if (!gallery.querySelector('.gallery-item')) {
+                showEmptyState(gallery, gallery.id === 'duringFeedingGallery' ? 'during' : 'after');
+            }
+        }
+    });
+}
+
+// Apply one snapshots change from the feed
+function applySnapshotChange(change) {
+    if (change.op === 'delete') {
+        removeGalleryItem(change.key);
+    } else if (change.op === 'insert' && (change.row.category === 'during' || change.row.category === 'after')) {
+        const gallery = galleryFor(change.row.category);
+        gallery.querySelectorAll('.empty-state, .loading').forEach(el => el.remove());
+        gallery.prepend(createGalleryItem(change.row));
+    }
+}
 
 // Load all snapshots from server
 function loadSnapshots() {
@@ -11,8 +38,7 @@ function loadSnapshots() {
     duringGallery.innerHTML = '<div class="loading">Loading images...</div>';
     afterGallery.innerHTML = '<div class="loading">Loading images...</div>';
    
-    fetch('/api/snapshots')
-        .then(response => response.json())
+    fetchJSON('/api/snapshots')
         .then(data => {
             console.log('API Response:', data);
            
@@ -81,6 +107,7 @@ function showEmptyState(gallery, type) {
 function createGalleryItem(imageData) {
     const div = document.createElement('div');
     div.className = 'gallery-item';
+    div.dataset.filename = imageData.filename;
    
     const filename = imageData.filename;
     const cameraId = imageData.camera_id || 'Unknown';
@@ -90,7 +117,7 @@ function createGalleryItem(imageData) {
     console.log('Creating gallery item:', filename, 'Category:', category);
    
     div.innerHTML = `
-        <img src="/snapshots/${filename}" alt="${filename}" onclick="openModal('${filename}'); event.stopPropagation();">
+        <img src="/previews/thumb/${filename}" alt="${filename}" loading="lazy" decoding="async" onclick="openModal('${filename}'); event.stopPropagation();">
         <div class="info">
             <p class="timestamp">${formatTimestamp(timestamp)}</p>
             <p>📷 ${cameraId}</p>
@@ -137,7 +164,7 @@ function deleteImage(filename) {
         .then(data => {
             if (data.success) {
                 alert('✓ Image deleted successfully!');
-                refreshGallery();
+                removeGalleryItem(filename);
             } else {
                 alert('✗ Failed to delete image: ' + (data.error || 'Unknown error'));
             }
@@ -169,7 +196,7 @@ function openModal(filename) {
     }
    
     const modalImg = document.getElementById('modalImage');
-    modalImg.src = `/snapshots/${filename}`;
+    modalImg.src = `/previews/medium/${filename}`;
     modal.style.display = 'block';
 }
 
@@ -201,6 +228,14 @@ function printCameraPDF() {
     // Remove all delete buttons from cloned galleries
     duringGallery.querySelectorAll('button').forEach(btn => btn.remove());
     afterGallery.querySelectorAll('button').forEach(btn => btn.remove());
+
+    // Print the medium previews and load them all up front, not lazily
+    [duringGallery, afterGallery].forEach(gallery => {
+        gallery.querySelectorAll('img').forEach(img => {
+            img.src = img.getAttribute('src').replace('/previews/thumb/', '/previews/medium/');
+            img.removeAttribute('loading');
+        });
+    });
    
     element.innerHTML = `
         <h1 style="color: #ff6b35; text-align: center;">Camera Monitoring Report</h1>
@@ -0,0 +1,58 @@
+// Shared change feed: one server-sent events connection per page.
+// Pages register handlers with ChangeFeed.on(table, handler) and reload
+// their data from ChangeFeed.onResync(handler), which also runs once the
+// stream is connected, so nothing written in between is missed.
+const ChangeFeed = (() => {
+    const handlers = {};
+    const resyncHandlers = [];
+    let connected = false;
+
+    function resync() {
+        resyncHandlers.forEach(handler => handler());
+    }
+
+    function connect() {
+        const source = new EventSource('/events');
+        let ready = false;
+
+        source.addEventListener('ready', () => {
+            // EventSource reconnects on its own and resumes from Last-Event-ID,
+            // so only a new connection needs a full load
+            if (!ready) {
+                ready = connected = true;
+                resync();
+            }
+        });
+
+        source.addEventListener('resync', resync);
+
+        source.addEventListener('change', event => {
+            const change = JSON.parse(event.data);
+            (handlers[change.table] || []).forEach(handler => handler(change));
+        });
+
+        source.onerror = () => {
+            // The server refused the stream (too many open) and the browser
+            // gave up: load the data now and try streaming again later
+            if (source.readyState === EventSource.CLOSED) {
+                connected = true;
+                resync();
+                setTimeout(connect, 30000);
+            }
+        };
+    }
+
+    connect();
+
+    return {
+        on(table, handler) {
+            (handlers[table] = handlers[table] || []).push(handler);
+        },
+        onResync(handler) {
+            resyncHandlers.push(handler);
+            if (connected) {
+                handler();
+            }
+        }
+    };
+})();
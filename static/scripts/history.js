@@ -1,50 +1,123 @@
 // Get the API URL dynamically from the current page location
 const API_URL = `${window.location.protocol}//${window.location.host}`;
 
-let autoRefreshInterval = null;
+const HISTORY_PAGE_SIZE = 50;
 
+let historyRecords = [];
+let nextHistoryCursor = null;
+let historyGeneration = 0;
+let loadingHistoryPage = false;
+
+// Start over from the newest page; older pages load as the table is scrolled
 function loadHistory() {
-    fetch(`${API_URL}/history`)
-        .then(response => {
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-            return response.json();
-        })
-        .then(data => {
-            const tbody = document.getElementById('historyTableBody');
-            tbody.innerHTML = '';
-           
-            if (data.length === 0) {
-                tbody.innerHTML = '<tr><td colspan="9">No history records found</td></tr>';
-                return;
-            }
-           
-            data.forEach(record => {
-                const row = document.createElement('tr');
-                row.innerHTML = `
-                    <td>${record.history_id}</td>
-                    <td>${formatDateTime(record.created_at)}</td>
-                    <td>${record.schedule_id || 'N/A'}</td>
-                    <td>${record.module_id || 'N/A'}</td>
-                    <td>${formatDate(record.feed_date)}</td>
-                    <td>${record.feed_time || 'N/A'}</td>
-                    <td>${record.amount ? record.amount + 'g' : 'N/A'}</td>
-                    <td><span class="status-badge status-${record.status}">${record.status || 'N/A'}</span></td>
-                    <td>
-                        <button class="btn-delete" onclick="deleteHistory(${record.history_id})">Delete</button>
-                    </td>
-                `;
-                tbody.appendChild(row);
-            });
+    historyGeneration++;
+    historyRecords = [];
+    nextHistoryCursor = null;
+    loadingHistoryPage = false;
+    loadHistoryPage();
+}
+
+function loadHistoryPage() {
+    if (loadingHistoryPage) return;
+    loadingHistoryPage = true;
+
+    const generation = historyGeneration;
+    const cursor = nextHistoryCursor ? `&cursor=${encodeURIComponent(nextHistoryCursor)}` : '';
+
+    fetchJSON(`${API_URL}/history?limit=${HISTORY_PAGE_SIZE}${cursor}`)
+        .then(page => {
+            if (generation !== historyGeneration) return;
+            // Rows pushed by the change feed may already be on the page
+            const known = new Set(historyRecords.map(record => record.history_id));
+            historyRecords = historyRecords.concat(page.items.filter(record => !known.has(record.history_id)));
+            nextHistoryCursor = page.next_cursor;
+            renderHistory();
         })
         .catch(error => {
             console.error('Error loading history:', error);
             document.getElementById('historyTableBody').innerHTML =
                 `<tr><td colspan="9">Error loading history: ${error.message}</td></tr>`;
+        })
+        .finally(() => {
+            if (generation !== historyGeneration) return;
+            loadingHistoryPage = false;
+            loadMoreIfVisible();
         });
 }
 
+// Sentinel below the table; when it scrolls into view the next page loads
+const historySentinel = document.createElement('div');
+document.querySelector('table').after(historySentinel);
+
+function loadMoreIfVisible() {
+    if (nextHistoryCursor && historySentinel.getBoundingClientRect().top < window.innerHeight + 200) {
+        loadHistoryPage();
+    }
+}
+
+new IntersectionObserver(entries => {
+    if (entries[0].isIntersecting) {
+        loadMoreIfVisible();
+    }
+}, { rootMargin: '200px' }).observe(historySentinel);
+
+function renderHistory() {
+    const tbody = document.getElementById('historyTableBody');
+    tbody.innerHTML = '';
+   
+    if (historyRecords.length === 0) {
+        tbody.innerHTML = '<tr><td colspan="9">No history records found</td></tr>';
+        return;
+    }
+   
+    historyRecords.forEach(record => {
+        const row = document.createElement('tr');
+        row.innerHTML = `
+            <td>${record.history_id}</td>
+            <td>${formatDateTime(record.created_at)}</td>
+            <td>${record.schedule_id || 'N/A'}</td>
+            <td>${record.module_id || 'N/A'}</td>
+            <td>${formatDate(record.feed_date)}</td>
+            <td>${record.feed_time || 'N/A'}</td>
+            <td>${record.amount ? record.amount + 'g' : 'N/A'}</td>
+            <td><span class="status-badge status-${record.status}">${record.status || 'N/A'}</span></td>
+            <td>
+                <button class="btn-delete" onclick="deleteHistory(${record.history_id})">Delete</button>
+            </td>
+        `;
+        tbody.appendChild(row);
+    });
+}
+
+// Apply history and schedule changes pushed by the server
+function applyHistoryChange(change) {
+    if (change.op === 'delete') {
+        historyRecords = historyRecords.filter(record => record.history_id !== change.key);
+    } else if (!historyRecords.some(record => record.history_id === change.key)) {
+        historyRecords.unshift(change.row);
+    }
+    renderHistory();
+}
+
+function applyScheduleChange(change) {
+    const emptied = { module_id: null, feed_date: null, feed_time: null, amount: null, status: null };
+    let touched = false;
+    historyRecords = historyRecords.map(record => {
+        if (record.schedule_id !== change.key) {
+            return record;
+        }
+        touched = true;
+        if (change.op === 'delete') {
+            return { ...record, ...emptied, schedule_id: null };
+        }
+        const { schedule_id, ...fields } = change.row;
+        return { ...record, ...fields };
+    });
+    if (touched) {
+        renderHistory();
+    }
+}
+
 function formatDateTime(dateTimeString) {
     if (!dateTimeString) return 'N/A';
     try {
@@ -83,11 +156,6 @@ function deleteHistory(historyId) {
    
     console.log('Attempting to delete history ID:', historyId);
    
-    // Pause auto-refresh during delete operation
-    if (autoRefreshInterval) {
-        clearInterval(autoRefreshInterval);
-    }
-   
     fetch(`${API_URL}/history/${historyId}`, {
         method: 'DELETE',
         headers: {
@@ -106,23 +174,15 @@ function deleteHistory(historyId) {
         console.log('Delete response data:', data);
        
         if (data.success) {
+            // The row itself disappears when the change feed reports the delete
             showNotification('History record deleted successfully', 'success');
-           
-            // Wait a bit before reloading to ensure database is updated
-            setTimeout(() => {
-                loadHistory();
-                // Resume auto-refresh
-                startAutoRefresh();
-            }, 300);
         } else {
             showNotification('Failed to delete: ' + (data.message || data.error || 'Unknown error'), 'error');
-            startAutoRefresh();
         }
     })
     .catch(error => {
         console.error('Error deleting history:', error);
         showNotification('Error deleting history record: ' + error.message, 'error');
-        startAutoRefresh();
     });
 }
 
@@ -150,15 +210,6 @@ function showNotification(message, type = 'info') {
     }, 3000);
 }
 
-function startAutoRefresh() {
-    // Clear any existing interval first
-    if (autoRefreshInterval) {
-        clearInterval(autoRefreshInterval);
-    }
-    // Start new auto-refresh every 5 seconds
-    autoRefreshInterval = setInterval(loadHistory, 5000);
-}
-
 function printHistoryPDF() {
     const element = document.createElement('div');
     element.style.padding = '20px';
@@ -248,8 +299,7 @@ style.textContent = `
 `;
 document.head.appendChild(style);
 
-// Load history on page load
-loadHistory();
-
-// Start auto-refresh
-startAutoRefresh();
\ No newline at end of file
+// Load history once connected, then apply changes as the server pushes them
+ChangeFeed.onResync(loadHistory);
+ChangeFeed.on('history', applyHistoryChange);
+ChangeFeed.on('schedules', applyScheduleChange);
\ No newline at end of file
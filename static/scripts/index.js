@@ -1,34 +1,13 @@
 // Get the API URL dynamically from the current page location
 const API_URL = `${window.location.protocol}//${window.location.host}`;
 let previousModules = [];
+let modulesById = new Map();
 
 function loadModules() {
-    fetch(`${API_URL}/modules`)
-        .then(response => {
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-            return response.json();
-        })
+    fetchJSON(`${API_URL}/modules`)
         .then(data => {
-            const tbody = document.getElementById('moduleTableBody');
-            tbody.innerHTML = '';
-            
-            if (data.length === 0) {
-                tbody.innerHTML = '<tr><td colspan="4">No modules found</td></tr>';
-                return;
-            }
-            
-            data.forEach(module => {
-                const row = document.createElement('tr');
-                row.innerHTML = `
-                    <td>${module.module_id}</td>
-                    <td>${module.cam_id}</td>
-                    <td>${module.status}</td>
-                    <td>${module.weight ? module.weight + 'g' : 'N/A'}</td>
-                `;
-                tbody.appendChild(row);
-            });
+            modulesById = new Map(data.map(module => [module.module_id, module]));
+            renderModules();
 
             // Check if weight has changed
             checkWeightChanges(data);
@@ -41,6 +20,45 @@ function loadModules() {
         });
 }
 
+function renderModules() {
+    const tbody = document.getElementById('moduleTableBody');
+    tbody.innerHTML = '';
+
+    if (modulesById.size === 0) {
+        tbody.innerHTML = '<tr><td colspan="4">No modules found</td></tr>';
+        return;
+    }
+
+    modulesById.forEach(module => {
+        const row = document.createElement('tr');
+        row.innerHTML = `
+            <td>${module.module_id}</td>
+            <td>${module.cam_id}</td>
+            <td>${module.status}</td>
+            <td>${module.weight ? module.weight + 'g' : 'N/A'}</td>
+        `;
+        tbody.appendChild(row);
+    });
+}
+
+// Apply a row change pushed by the server
+function applyModuleChange(change) {
+    if (change.op === 'delete') {
+        modulesById.delete(change.key);
+    } else {
+        const current = modulesById.get(change.key);
+        if (!current && change.op === 'update' && !('cam_id' in change.row)) {
+            return; // partial update for a module this page has not seen yet
+        }
+        modulesById.set(change.key, { ...current, ...change.row });
+    }
+
+    const data = Array.from(modulesById.values());
+    renderModules();
+    checkWeightChanges(data);
+    previousModules = data;
+}
+
 function checkWeightChanges(currentModules) {
     currentModules.forEach(currentModule => {
         const previousModule = previousModules.find(m => m.module_id === currentModule.module_id);
@@ -90,8 +108,6 @@ style.textContent = `
 `;
 document.head.appendChild(style);
 
-// Load modules on page load
-loadModules();
-
-// Auto-refresh every 2 seconds to detect weight changes
-setInterval(loadModules, 2000);
\ No newline at end of file
+// Load modules once connected, then apply changes as the server pushes them
+ChangeFeed.onResync(loadModules);
+ChangeFeed.on('modules', applyModuleChange);
\ No newline at end of file
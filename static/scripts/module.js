@@ -149,8 +149,7 @@ async function loadModules() {
     if (isEditing) return; // Don't reload while editing
     
     try {
-        const res = await fetch(API_URL);
-        const data = await res.json();
+        const data = await fetchJSON(API_URL);
         
         const tbody = document.getElementById('moduleTableBody');
         tbody.innerHTML = '';
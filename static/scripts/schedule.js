@@ -48,14 +48,8 @@ function loadSchedules() {
    
     // Load modules and schedules with date filtering
     Promise.all([
-        fetch(`${API_URL}/modules`).then(res => {
-            if (!res.ok) throw new Error(`Modules API error: ${res.status}`);
-            return res.json();
-        }),
-        fetch(`${API_URL}/schedules?start_date=${dateRange.start}&end_date=${dateRange.end}`).then(res => {
-            if (!res.ok) throw new Error(`Schedules API error: ${res.status}`);
-            return res.json();
-        })
+        fetchJSON(`${API_URL}/modules`),
+        fetchJSON(`${API_URL}/schedules?start_date=${dateRange.start}&end_date=${dateRange.end}`)
     ])
     .then(([modules, schedules]) => {
         const tbody = document.getElementById('schedulesTable');
@@ -415,6 +409,10 @@ style.textContent = `
         background: #f8d7da;
         color: #721c24;
     }
+    .status-missed {
+        background: #e2e3e5;
+        color: #383d41;
+    }
     .btn-edit, .btn-add {
         background: #2196F3;
         color: white;
@@ -488,12 +486,28 @@ style.textContent = `
 `;
 document.head.appendChild(style);
 
-// Load schedules on page load
-loadSchedules();
+// Reload from the change feed (when not editing), batching bursts of
+// changes such as a bulk upload into a single refresh
+let scheduleRefreshTimer = null;
 
-// Auto-refresh every 10 seconds (when not editing)
-setInterval(() => {
-    if (!isEditing) {
+function scheduleRefresh() {
+    if (scheduleRefreshTimer) {
+        return;
+    }
+    scheduleRefreshTimer = setTimeout(() => {
+        scheduleRefreshTimer = null;
         loadSchedules();
+    }, 1000);
+}
+
+ChangeFeed.onResync(loadSchedules);
+ChangeFeed.on('schedules', scheduleRefresh);
+ChangeFeed.on('modules', change => {
+    // Weight readings do not change the table
+    if (change.op !== 'update' || 'status' in change.row) {
+        scheduleRefresh();
     }
-}, 10000);
\ No newline at end of file
+});
+
+// "Today" and the 30-day window move at midnight without any change event
+setInterval(loadSchedules, 5 * 60 * 1000);
\ No newline at end of file
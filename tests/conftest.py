@@ -0,0 +1,53 @@
+"""Shared fixtures: app.py imported once against a throwaway instance folder"""
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+INSTANCE_DIR = tempfile.mkdtemp(prefix="smartfeeder-test-")
+os.environ["SMARTFEEDER_INSTANCE_PATH"] = INSTANCE_DIR
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+_ids = itertools.count(1)
+
+def pytest_sessionfinish(session, exitstatus):
+    app_module.weight_buffer.flush()
+    app_module.db_pool.close_all()
+    shutil.rmtree(INSTANCE_DIR, ignore_errors=True)
+
+@pytest.fixture
+def app():
+    return app_module
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+@pytest.fixture
+def module_id(client):
+    """A fresh active module (and camera), unique to the test"""
+    n = next(_ids)
+    cam_id, module_id = f"TESTCAM{n}", f"TESTMOD{n}"
+    client.post("/cameras", json={"cam_id": cam_id, "status": "active"})
+    client.post("/modules", json={"module_id": module_id, "cam_id": cam_id, "status": "active", "weight": 0})
+    return module_id
+
+@pytest.fixture
+def add_schedule(client):
+    """Create a pending schedule and return its id"""
+    def add(module_id, feed_date, feed_time="00:00", amount=10):
+        response = client.post("/schedules", json={"module_id": module_id, "feed_date": feed_date,
+                                                   "feed_time": feed_time, "amount": amount})
+        assert response.status_code == 200, response.json
+        row = app_module.query_db("""
+            SELECT schedule_id FROM schedules
+            WHERE module_id = ? AND feed_date = ? AND feed_time = ?
+            ORDER BY schedule_id DESC LIMIT 1
+        """, (module_id, feed_date, feed_time), one=True)
+        return row["schedule_id"]
+    return add
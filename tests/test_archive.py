@@ -0,0 +1,59 @@
+import hashlib
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEED = textwrap.dedent("""
+    import hashlib, os, app
+    os.makedirs(app.IMAGES_DIR, exist_ok=True)
+    with app.transaction() as con:
+        for n in range(200):
+            data = os.urandom(1000 + n)
+            name = f"old{n:04d}.jpg"
+            with open(os.path.join(app.IMAGES_DIR, name), "wb") as f:
+                f.write(data)
+            con.execute('''INSERT INTO image_metadata
+                               (filename, camera_id, timestamp, category, size, sha256, storage_name)
+                           VALUES (?, 'CAM', ?, 'after', ?, ?, ?)''',
+                        (name, 1000 + n, len(data), hashlib.sha256(data).hexdigest(), name))
+""")
+
+COMPACT = textwrap.dedent("""
+    import os, sys, time, app
+    while not os.path.exists(sys.argv[1]):
+        time.sleep(0.01)
+    print(app.snapshot_archive.compact())
+""")
+
+def run_workers(instance, count):
+    env = dict(os.environ, SMARTFEEDER_INSTANCE_PATH=str(instance), SMARTFEEDER_SHARED_PROCESSES="true",
+               SMARTFEEDER_ARCHIVE_BATCH="5")
+    subprocess.run([sys.executable, "-c", SEED], cwd=ROOT, env=env, check=True)
+    go = instance / "go"
+    workers = [subprocess.Popen([sys.executable, "-c", COMPACT, str(go)], cwd=ROOT, env=env,
+                                stdout=subprocess.PIPE, text=True)
+               for _ in range(count)]
+    go.touch()
+    return [int(worker.communicate(timeout=60)[0]) for worker in workers]
+
+def test_worker_processes_compact_without_overlapping(tmp_path):
+    packed = run_workers(tmp_path, 4)
+    assert sum(packed) == 200
+
+    import sqlite3
+    con = sqlite3.connect(tmp_path / "animal_feeder.db")
+    rows = con.execute("""
+        SELECT pack_id, pack_offset, size, sha256 FROM image_metadata ORDER BY pack_id, pack_offset
+    """).fetchall()
+    assert len(rows) == 200
+    end = {}
+    for pack_id, offset, size, sha256 in rows:
+        assert offset >= end.get(pack_id, 0)
+        end[pack_id] = offset + size
+        with open(tmp_path / "packs" / f"pack-{pack_id:06d}.pack", "rb") as f:
+            f.seek(offset)
+            assert hashlib.sha256(f.read(size)).hexdigest() == sha256
+    assert not [name for name in os.listdir(tmp_path / "images") if name.startswith("old")]
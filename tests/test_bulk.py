@@ -0,0 +1,59 @@
+import http.client
+import json
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+def ndjson(*rows):
+    return "".join(json.dumps(row) + "\n" for row in rows).encode()
+
+def test_bulk_upsert_and_cancel(client, module_id):
+    body = ndjson({"module_id": module_id, "feed_date": "2030-01-01", "feed_time": "07:00", "amount": 5},
+                  {"op": "cancel", "module_id": module_id, "feed_date": "2030-01-01", "feed_time": "07:00"},
+                  {"op": "bogus"})
+    response = client.post("/schedules/bulk", data=body, content_type="application/x-ndjson")
+    assert response.json["summary"] == {"created": 1, "cancelled": 1, "error": 1}
+
+def test_slow_bulk_body_does_not_block_writers(client, module_id, add_schedule, app):
+    """A client that stalls mid-upload must not hold the database write lock"""
+    schedule_id = add_schedule(module_id, app.ph_now().strftime("%Y-%m-%d"))
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=30)
+    try:
+        connection.putrequest("POST", "/schedules/bulk")
+        connection.putheader("Content-Type", "application/x-ndjson")
+        connection.putheader("Transfer-Encoding", "chunked")
+        connection.endheaders()
+        line = ndjson({"module_id": module_id, "feed_date": "2030-01-02", "feed_time": "07:00", "amount": 5})
+        connection.send(b"%x\r\n%s\r\n" % (len(line), line))
+        time.sleep(0.3)  # the server is now staging the first row and waiting for more
+
+        completion = {}
+        completer = threading.Thread(target=lambda: completion.update(response=client.post(
+            "/complete_schedule", data={"schedule_id": schedule_id, "module_id": module_id})))
+        completer.start()
+        completer.join(5)
+        assert not completer.is_alive(), "completion waited on the bulk upload's write lock"
+        assert completion["response"].status_code == 200
+
+        line = ndjson({"module_id": module_id, "feed_date": "2030-01-02", "feed_time": "08:00", "amount": 5})
+        connection.send(b"%x\r\n%s\r\n0\r\n\r\n" % (len(line), line))
+        response = connection.getresponse()
+        assert json.loads(response.read())["summary"] == {"created": 2}
+    finally:
+        connection.close()
+        server.shutdown()
+
+def test_bulk_create_does_not_overwrite_a_pending_schedule(client, module_id, add_schedule, app):
+    add_schedule(module_id, "2030-01-03", "07:00", amount=10)
+    body = ndjson({"op": "create", "module_id": module_id, "feed_date": "2030-01-03", "feed_time": "07:00", "amount": 99},
+                  {"op": "create", "module_id": module_id, "feed_date": "2030-01-04", "feed_time": "07:00", "amount": 5},
+                  {"op": "create", "module_id": module_id, "feed_date": "2030-01-04", "feed_time": "07:00", "amount": 6})
+    results = client.post("/schedules/bulk", data=body, content_type="application/x-ndjson").json["results"]
+    assert [result.get("result", result.get("error")) for result in results] == [
+        app.SLOT_TAKEN, "created", app.SLOT_TAKEN]
+    amounts = app.query_db("SELECT feed_date, amount FROM schedules WHERE module_id = ? ORDER BY feed_date",
+                           (module_id,))
+    assert [tuple(row) for row in amounts] == [("2030-01-03", 10), ("2030-01-04", 5)]
@@ -0,0 +1,62 @@
+import threading
+import uuid
+
+def complete(client, schedule_id, key):
+    return client.post("/complete_schedule", data={"schedule_id": schedule_id},
+                       headers={"Idempotency-Key": key})
+
+def history_rows(app, schedule_ids):
+    return app.query_db(f"""
+        SELECT COUNT(*) FROM history WHERE schedule_id IN ({','.join('?' * len(schedule_ids))})
+    """, tuple(schedule_ids), one=True)[0]
+
+def test_same_key_is_replayed(client, module_id, add_schedule, app):
+    schedule_id = add_schedule(module_id, "2030-01-01")
+    key = str(uuid.uuid4())
+    first = complete(client, schedule_id, key)
+    again = complete(client, schedule_id, key)
+    assert first.status_code == again.status_code == 200
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.json == first.json
+    assert history_rows(app, [schedule_id]) == 1
+
+def test_key_reused_for_another_schedule_is_refused(client, module_id, add_schedule):
+    first, second = add_schedule(module_id, "2030-01-01"), add_schedule(module_id, "2030-01-02")
+    key = str(uuid.uuid4())
+    assert complete(client, first, key).status_code == 200
+    response = complete(client, second, key)
+    assert response.status_code == 422
+    assert response.json == {"error": f"Idempotency-Key was already used for schedule {first}"}
+
+def test_key_taken_while_waiting_for_the_lock(client, module_id, add_schedule, app, monkeypatch):
+    first, second = add_schedule(module_id, "2030-01-01"), add_schedule(module_id, "2030-01-02")
+    key = str(uuid.uuid4())
+    assert complete(client, first, key).status_code == 200
+
+    # As if the other completion committed between the key check and BEGIN
+    query_db = app.query_db
+    monkeypatch.setattr(app, "query_db", lambda *args, name=None, **kwargs:
+                        None if name == "complete_schedule.key" else query_db(*args, name=name, **kwargs))
+    response = complete(client, second, key)
+    assert response.status_code == 422
+    assert app.query_db("SELECT status FROM schedules WHERE schedule_id = ?", (second,), one=True)[0] == "pending"
+    assert history_rows(app, [second]) == 0
+
+def test_racing_completions_with_one_key(module_id, add_schedule, app):
+    schedule_ids = [add_schedule(module_id, f"2030-02-{day:02d}") for day in range(1, 9)]
+    key = str(uuid.uuid4())
+    barrier = threading.Barrier(len(schedule_ids))
+    codes = []
+
+    def race(schedule_id):
+        client = app.app.test_client()
+        barrier.wait()
+        codes.append(complete(client, schedule_id, key).status_code)
+
+    threads = [threading.Thread(target=race, args=(schedule_id,)) for schedule_id in schedule_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert sorted(codes) == [200] + [422] * (len(schedule_ids) - 1)
+    assert history_rows(app, schedule_ids) == 1
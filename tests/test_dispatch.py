@@ -0,0 +1,72 @@
+from datetime import timedelta
+
+def status(app, schedule_id):
+    return app.query_db("SELECT status FROM schedules WHERE schedule_id = ?", (schedule_id,), one=True)[0]
+
+def test_late_schedules_are_dispensed_by_default(client, module_id, add_schedule, app):
+    today = app.ph_now().strftime("%Y-%m-%d")
+    schedule_id = add_schedule(module_id, today, "00:00")
+    app.dispatch.expire()
+
+    response = client.post("/check_schedule", data={"module_id": module_id})
+    assert response.json["dispense"] is True
+    assert response.json["schedule_id"] == schedule_id
+    assert status(app, schedule_id) == "pending"
+
+def test_grace_only_expires_schedules_due_since_startup(client, module_id, add_schedule, app, monkeypatch):
+    now = app.ph_now()
+    monkeypatch.setattr(app.dispatch, "grace", timedelta(minutes=60))
+    monkeypatch.setattr(app.dispatch, "since", (now - timedelta(hours=3)).replace(second=0, microsecond=0))
+    before_start = now - timedelta(days=2)
+    overdue = now - timedelta(hours=2)
+    old_id = add_schedule(module_id, before_start.strftime("%Y-%m-%d"), before_start.strftime("%H:%M"))
+    overdue_id = add_schedule(module_id, overdue.strftime("%Y-%m-%d"), overdue.strftime("%H:%M"))
+
+    app.dispatch.expire()
+    assert status(app, old_id) == "pending"
+    assert status(app, overdue_id) == "missed"
+
+def test_schedule_added_late_for_before_startup_is_dispensed(client, module_id, add_schedule, app, monkeypatch):
+    monkeypatch.setattr(app.dispatch, "grace", timedelta(minutes=60))
+    today = app.ph_now().strftime("%Y-%m-%d")
+    schedule_id = add_schedule(module_id, today, "00:00")
+
+    response = client.post("/check_schedule", data={"module_id": module_id})
+    assert response.json["schedule_id"] == schedule_id
+    assert status(app, schedule_id) == "pending"
+
+def test_feed_time_is_validated_and_normalized(client, module_id, add_schedule, app):
+    response = client.post("/schedules", json={"module_id": module_id, "feed_date": "2030-01-01",
+                                               "feed_time": "25:00", "amount": 5})
+    assert response.status_code == 400
+    schedule_id = add_schedule(module_id, "2030-01-01", "07:05")
+    assert client.post("/schedules", json={"module_id": module_id, "feed_date": "2030-01-02",
+                                           "feed_time": "7:05", "amount": 5}).status_code == 200
+    rows = app.query_db("SELECT feed_time FROM schedules WHERE module_id = ?", (module_id,))
+    assert {row[0] for row in rows} == {"07:05"}
+
+    update = {"module_id": module_id, "feed_date": "2030-01-01", "amount": 5, "status": "pending"}
+    assert client.put(f"/schedules/{schedule_id}", json={**update, "feed_time": "noon"}).status_code == 400
+    assert client.put(f"/schedules/{schedule_id}", json={**update, "feed_time": "8:0"}).status_code == 200
+    assert app.query_db("SELECT feed_time FROM schedules WHERE schedule_id = ?", (schedule_id,), one=True)[0] == "08:00"
+
+def insert_raw(app, module_id, feed_date, feed_time):
+    """A schedule stored before feed times were validated"""
+    with app.transaction() as con:
+        return con.execute("""
+            INSERT INTO schedules (module_id, feed_date, feed_time, amount, status)
+            VALUES (?, ?, ?, 10, 'pending') RETURNING schedule_id
+        """, (module_id, feed_date, feed_time)).fetchone()[0]
+
+def test_unpadded_and_unparseable_stored_times(client, module_id, app):
+    insert_raw(app, module_id, "2030-01-01", "10:00")
+    early = insert_raw(app, module_id, "2030-01-01", "7:05")
+    insert_raw(app, module_id, "2030-01-01", "soon")
+    _, next_schedule = app.DueScheduleIndex(cache=False).lookup(module_id, "2030-01-01")
+    assert next_schedule[:2] == ("07:05", early)
+
+    bad = insert_raw(app, module_id, app.ph_now().strftime("%Y-%m-%d"), "soon")
+    app.due_index.invalidate_module(module_id)
+    response = client.post("/check_schedule", data={"module_id": module_id})
+    assert response.json == {"dispense": False}
+    assert status(app, bad) == "pending"
@@ -0,0 +1,29 @@
+import threading
+
+def test_streams_past_the_cap_are_refused(client, app, monkeypatch):
+    monkeypatch.setattr(app, "event_streams", threading.BoundedSemaphore(1))
+    stream = client.get("/events", buffered=False)
+    assert stream.status_code == 200
+    assert next(stream.response).startswith(b"retry:")
+
+    response = app.app.test_client().get("/events")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
+
+    # Closing the stream gives its slot back
+    stream.close()
+    response = app.app.test_client().get("/events", buffered=False)
+    assert response.status_code == 200
+    response.close()
+
+def test_close_ends_open_streams(client, app, monkeypatch):
+    monkeypatch.setattr(app, "change_feed", app.ChangeFeed(10))
+    stream = client.get("/events", buffered=False)
+    chunks = iter(stream.response)
+    next(chunks)
+
+    threading.Timer(0.2, app.change_feed.close).start()
+    rest = list(chunks)  # returns once the feed is closed, not after the keep-alive
+    assert len(rest) <= 1
+    stream.close()
+    assert client.get("/events").status_code == 503
@@ -0,0 +1,48 @@
+import threading
+import time
+
+def test_long_polls_past_the_cap_are_answered_at_once(client, module_id, app, monkeypatch):
+    monkeypatch.setattr(app, "long_poll_slots", threading.BoundedSemaphore(1))
+    held = {}
+
+    def hold():
+        started = time.monotonic()
+        held["response"] = app.app.test_client().post(
+            "/check_schedule", data={"module_id": module_id, "wait": 2})
+        held["seconds"] = time.monotonic() - started
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    time.sleep(0.3)  # the first long-poll now holds the only slot
+
+    started = time.monotonic()
+    response = client.post("/check_schedule", data={"module_id": module_id, "wait": 30})
+    assert time.monotonic() - started < 1
+    assert response.json == {"dispense": False, "held": False}
+    assert response.headers["Retry-After"] == str(app.app.config["LONG_POLL_RETRY_AFTER"])
+
+    # A plain poll is never marked
+    response = client.post("/check_schedule", data={"module_id": module_id})
+    assert response.json == {"dispense": False}
+    assert "Retry-After" not in response.headers
+
+    holder.join(10)
+    assert held["response"].json == {"dispense": False}
+    assert held["seconds"] >= 1.5
+
+def test_long_poll_wakes_when_a_schedule_is_added(client, module_id, app):
+    result = {}
+
+    def hold():
+        result["response"] = app.app.test_client().post(
+            "/check_schedule", data={"module_id": module_id, "wait": 10})
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    time.sleep(0.3)
+    now = app.ph_now()
+    client.post("/schedules", json={"module_id": module_id, "feed_date": now.strftime("%Y-%m-%d"),
+                                    "feed_time": now.strftime("%H:%M"), "amount": 5})
+    holder.join(5)
+    assert not holder.is_alive()
+    assert result["response"].json["dispense"] is True
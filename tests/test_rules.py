@@ -0,0 +1,43 @@
+from datetime import timedelta
+
+import pytest
+
+@pytest.mark.parametrize("feed_time", ["25:00", "7am", "08:61", "08:00:00"])
+def test_rule_feed_time_must_be_hh_mm(client, module_id, feed_time):
+    response = client.post("/schedules/recurring", json={
+        "module_id": module_id, "feed_time": feed_time, "amount": 10, "start_date": "2030-01-01"})
+    assert response.status_code == 400
+    assert response.json == {"error": "Invalid feed_time format. Use HH:MM"}
+
+def test_rule_feed_time_is_normalized(client, module_id, app):
+    start = (app.ph_now() + timedelta(days=1)).strftime("%Y-%m-%d")
+    response = client.post("/schedules/recurring", json={
+        "module_id": module_id, "feed_time": "7:05", "amount": 10, "start_date": start, "days_ahead": 2})
+    assert response.json["created_count"] == 2
+    rule_id = response.json["rule_id"]
+    schedules = client.get("/schedules", query_string={"module_id": module_id}).json
+    assert {row["feed_time"] for row in schedules} == {"07:05"}
+
+    response = client.put(f"/schedules/rules/{rule_id}", json={"feed_time": "8:0"})
+    assert response.status_code == 200
+    rules = client.get("/schedules/rules", query_string={"module_id": module_id}).json
+    assert rules[0]["feed_time"] == "08:00"
+
+    response = client.put(f"/schedules/rules/{rule_id}", json={"feed_time": "noon"})
+    assert response.status_code == 400
+
+@pytest.mark.parametrize("days_ahead", ["abc", -3, [7], 0, "0"])
+def test_bad_days_ahead_is_rejected(client, module_id, days_ahead):
+    response = client.post("/schedules/recurring", json={
+        "module_id": module_id, "feed_time": "08:00", "amount": 10, "start_date": "2030-01-01",
+        "days_ahead": days_ahead})
+    assert response.status_code == 400
+    assert "days_ahead" in response.json["error"]
+
+def test_zero_days_ahead_creates_nothing(client, module_id):
+    response = client.post("/schedules/recurring", json={
+        "module_id": module_id, "feed_time": "08:00", "amount": 10, "start_date": "2030-01-01",
+        "days_ahead": 0})
+    assert response.status_code == 400
+    assert client.get("/schedules/rules", query_string={"module_id": module_id}).json == []
+    assert client.get("/schedules", query_string={"module_id": module_id}).json == []
@@ -0,0 +1,56 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+@pytest.fixture
+def camera_id(client, module_id):
+    return module_id.replace("TESTMOD", "TESTCAM")
+
+def jpeg():
+    """A small JPEG no earlier test has uploaded"""
+    out = io.BytesIO()
+    Image.frombytes("RGB", (16, 16), os.urandom(16 * 16 * 3)).save(out, "JPEG")
+    return out.getvalue()
+
+def upload(client, camera_id, data):
+    return client.post("/upload_image", data=data, content_type="image/jpeg",
+                       query_string={"camera_id": camera_id, "category": "after"})
+
+def test_upload_restores_a_copy_deleted_while_it_was_in_flight(client, camera_id, app, monkeypatch):
+    data = jpeg()
+    first = upload(client, camera_id, data).json["filename"]
+
+    # dhash runs between storing the upload and recording it: delete the only
+    # row sharing those bytes there, which releases the stored copy
+    client.put(f"/cameras/{camera_id}", json={"similar_frames": "flag"})
+    monkeypatch.setattr(app, "dhash", lambda path: client.delete(f"/api/snapshots/{first}") and None)
+    second = upload(client, camera_id, data).json
+    assert second["duplicate"] is False
+
+    response = client.get(f"/snapshots/{second['filename']}")
+    assert response.status_code == 200
+    assert response.data == data
+    assert not [name for name in os.listdir(app.IMAGES_DIR) if name.startswith(".upload-")]
+
+def test_delete_keeps_a_copy_still_shared(client, camera_id):
+    data = jpeg()
+    first = upload(client, camera_id, data).json["filename"]
+    second = upload(client, camera_id, data).json["filename"]
+    assert client.delete(f"/api/snapshots/{first}").status_code == 200
+    assert client.get(f"/snapshots/{second}").data == data
+
+def test_sizes_of_legacy_snapshots_are_backfilled(camera_id, app):
+    data = os.urandom(3000)
+    with open(os.path.join(app.IMAGES_DIR, f"{camera_id}_legacy.jpg"), "wb") as f:
+        f.write(data)
+    with app.transaction() as con:
+        con.execute("""
+            INSERT INTO image_metadata (filename, camera_id, timestamp, category, storage_name)
+            VALUES (?, ?, 1, 'after', ?)
+        """, (f"{camera_id}_legacy.jpg", camera_id, f"{camera_id}_legacy.jpg"))
+        app._backfill_snapshot_sizes(con)
+    stats = app.dedup_stats(camera_id)
+    assert stats["bytes"] == stats["stored_bytes"] == 3000
+    assert stats["ratio"] == 1.0
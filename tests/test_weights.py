@@ -0,0 +1,45 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+
+@contextmanager
+def database_down(*args, **kwargs):
+    raise sqlite3.OperationalError("disk I/O error")
+    yield
+
+def test_backlog_from_a_failed_flush_does_not_keep_the_buffer_full(app, monkeypatch):
+    buffer = app.WeightBuffer(interval=60, max_pending=5)
+    buffer._thread = True  # no flusher thread: this test flushes by hand
+    for n in range(5):
+        buffer.put("M1", n)
+    assert buffer._wakeup.is_set()
+
+    buffer._wakeup.clear()
+    monkeypatch.setattr(app, "transaction", database_down)
+    try:
+        buffer.flush()
+    except sqlite3.OperationalError:
+        pass
+    assert buffer.stats()["samples_pending"] == 5
+
+    buffer.put("M1", 5)
+    assert not buffer._wakeup.is_set()
+    for n in range(4):
+        buffer.put("M1", n)
+    assert buffer._wakeup.is_set()
+
+def test_failed_flushes_back_off(app):
+    class FailingBuffer(app.WeightBuffer):
+        attempts = 0
+
+        def flush(self):
+            self.attempts += 1
+            raise sqlite3.OperationalError("disk I/O error")
+
+    buffer = FailingBuffer(interval=0.05, max_pending=1)
+    deadline = time.monotonic() + 1.0
+    while time.monotonic() < deadline:
+        buffer.put("M1", 1)  # every put asks for a flush
+        time.sleep(0.001)
+    # 0.05 s, then 0.2, 0.4, 0.8 apart: a tight loop would have tried hundreds of times
+    assert 2 <= buffer.attempts <= 5